@@ -1,9 +1,19 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, has_app_context, has_request_context, Response, stream_with_context
 import pandas as pd
+import numpy as np
 import os
 import re
+import csv
+import io
+import click
+from array import array
+from bisect import bisect_left
 from flask_cors import CORS  # type: ignore
 import psycopg2  # type: ignore
+import psycopg2.pool  # type: ignore
+import psycopg2.extensions  # type: ignore
+from psycopg2.extras import execute_values  # type: ignore
+from contextlib import contextmanager
 import urllib.parse as up
 from dotenv import load_dotenv
 from datetime import datetime, timezone, timedelta
@@ -11,21 +21,91 @@ from supabase import create_client
 from werkzeug.utils import secure_filename
 import time
 import logging
-import traceback
 import requests
-from math import radians, sin, cos, sqrt, atan2
 import json
 import openai
 from youtube_search import YoutubeSearch
 import secrets
+import hashlib
+import threading
+import contextvars
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
 import sqlite3
+import sys
+import random
 import re
 from werkzeug.security import generate_password_hash, check_password_hash
 
-logging.basicConfig(level=logging.DEBUG)
-
 load_dotenv()
 
+# The batch solver's pool processes import this module only for the optimizer
+# (see "Batch optimization") and skip the start-up work: loading the ZIP
+# centroids and warming caches
+SOLVER_PROCESS = multiprocessing.parent_process() is not None
+
+
+# Logging
+#
+# One JSON object per line on stdout (LOG_FORMAT=text for plain lines while
+# developing), at LOG_LEVEL (default INFO). Messages use %-style arguments so
+# nothing is formatted unless the record is emitted; code that would build
+# large values just for a debug line checks log.isEnabledFor(logging.DEBUG)
+# first. LOG_SAMPLE_RATE keeps that fraction of requests' below-warning
+# records (all records of a sampled request are kept together); warnings and
+# errors are always logged.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+
+_LOG_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as JSON, including any fields passed with extra={...}."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in _LOG_RECORD_FIELDS:
+                entry[key] = value
+        if has_request_context():
+            entry.setdefault("path", request.path)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Drop a share of below-warning records, deciding once per request."""
+
+    def filter(self, record):
+        if LOG_SAMPLE_RATE >= 1 or record.levelno >= logging.WARNING:
+            return True
+        if has_request_context():
+            if "log_sampled" not in g:
+                g.log_sampled = random.random() < LOG_SAMPLE_RATE
+            return g.log_sampled
+        return random.random() < LOG_SAMPLE_RATE
+
+
+_log_handler = logging.StreamHandler(sys.stdout)
+_log_handler.setFormatter(
+    JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+)
+_log_handler.addFilter(SamplingFilter())
+logging.basicConfig(level=LOG_LEVEL, handlers=[_log_handler], force=True)
+
+log = logging.getLogger("grocery_smart")
+
 app = Flask(__name__)
 
 # Configure CORS
@@ -33,7 +113,7 @@ CORS(app, resources={
     r"/*": {
         "origins": ["http://localhost:3000", "https://grocery-smart.vercel.app"],
         "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-        "allow_headers": ["Content-Type", "Authorization"],
+        "allow_headers": ["Content-Type", "Authorization", "If-None-Match"],
         "supports_credentials": True
     }
 })
@@ -45,42 +125,296 @@ def add_cors_headers(response):
     origin = request.headers.get('Origin')
     if origin in ["http://localhost:3000", "https://grocery-smart.vercel.app"]:
         response.headers["Access-Control-Allow-Origin"] = origin
+        response.headers["Timing-Allow-Origin"] = origin
     response.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, OPTIONS"
-    response.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
+    response.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization, If-None-Match"
     response.headers["Access-Control-Allow-Credentials"] = "true"
+    response.headers["Access-Control-Expose-Headers"] = "X-Cache, Server-Timing, ETag, Link, X-Next-Cursor"
+    return response
+
+
+# Request timing
+#
+# Every request's duration is recorded in a histogram per route, method and
+# status, and the hot paths inside it (DB checkout, each SQL statement,
+# geocoding, the optimizer strategies, OpenAI and YouTube calls) are timed
+# with `timed(phase)` into a histogram per route and phase. Both are served in
+# the Prometheus text format on /metrics; like the upstream stats they are per
+# worker process. Work handed to the external-call pool is attributed to the
+# request that submitted it. With SERVER_TIMING=true each response also
+# carries a Server-Timing header with the request's per-phase totals.
+SERVER_TIMING = os.getenv("SERVER_TIMING", "false").lower() == "true"
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+METRICS = []
+# (route, {phase: [seconds, calls]}) for the current request
+_request_timing = contextvars.ContextVar("request_timing", default=("background", None))
+_request_timing_lock = threading.Lock()
+
+
+def _metric_labels(names, values):
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return ",".join(f'{name}="{escape(value)}"' for name, value in zip(names, values))
+
+
+class Histogram:
+    """A Prometheus histogram with one series per combination of label values."""
+
+    def __init__(self, name, description, labels, buckets=METRICS_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}  # label values -> [count per bucket..., count above the last, sum]
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def observe(self, value, *label_values):
+        slot = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[slot] += 1
+            series[-1] += value
+
+    def drain(self):
+        """Take every series recorded so far, leaving the histogram empty."""
+        with self._lock:
+            series, self._series = self._series, {}
+        return series
+
+    def merge(self, series):
+        """Add series drained from another process's copy of this histogram."""
+        with self._lock:
+            for values, counts in series.items():
+                mine = self._series.setdefault(values, [0] * (len(self.buckets) + 1) + [0.0])
+                for slot, count in enumerate(counts):
+                    mine[slot] += count
+
+    def render(self):
+        with self._lock:
+            snapshot = sorted((values, list(series)) for values, series in self._series.items())
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for values, series in snapshot:
+            labels = _metric_labels(self.labels, values)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                le = bound if isinstance(bound, str) else f"{bound:g}"
+                lines.append(f'{self.name}_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{labels}}} {series[-1]:.6f}")
+            lines.append(f"{self.name}_count{{{labels}}} {cumulative}")
+        return lines
+
+
+request_duration = Histogram(
+    "grocery_smart_request_duration_seconds", "Time spent handling requests.", ("route", "method", "status")
+)
+phase_duration = Histogram(
+    "grocery_smart_phase_duration_seconds", "Time spent in each phase of a request.", ("route", "phase")
+)
+
+
+@contextmanager
+def timed(phase):
+    """Time a block (or, used as a decorator, a function) as `phase` of the current request."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        route, phases = _request_timing.get()
+        phase_duration.observe(elapsed, route, phase)
+        if phases is not None:
+            with _request_timing_lock:
+                totals = phases.setdefault(phase, [0.0, 0])
+                totals[0] += elapsed
+                totals[1] += 1
+
+
+@app.before_request
+def start_request_timing():
+    g.request_started = time.perf_counter()
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    _request_timing.set((route, {}))
+
+
+@app.after_request
+def add_server_timing(response):
+    g.response_status = response.status_code
+    _, phases = _request_timing.get()
+    if SERVER_TIMING and phases is not None:
+        with _request_timing_lock:
+            entries = [
+                f'{phase};desc="{calls}x";dur={seconds * 1000:.1f}'
+                for phase, (seconds, calls) in phases.items()
+            ]
+        entries.append(f"total;dur={(time.perf_counter() - g.request_started) * 1000:.1f}")
+        response.headers["Server-Timing"] = ", ".join(entries)
     return response
 
 
+@app.teardown_request
+def record_request_timing(exception=None):
+    # Runs once the response has been sent, so streamed responses are timed to their last byte
+    started = g.pop("request_started", None)
+    if started is None:
+        return
+    route, _ = _request_timing.get()
+    request_duration.observe(time.perf_counter() - started, route, request.method, g.get("response_status", 500))
+    _request_timing.set(("background", None))
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """Cursor that times every statement as the db_query phase."""
+
+    def execute(self, query, vars=None):
+        with timed("db_query"):
+            return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        with timed("db_query"):
+            return super().executemany(query, vars_list)
+
+
 # PostgreSQL connection
 
 DB_CONFIG = os.getenv("DATABASE_URL")  # Use environment variable
-print("DB Config:", DB_CONFIG)
+
+
+# Connections come from a process-wide pool. DB_POOL_MIN connections are kept
+# open between requests; up to DB_POOL_MAX can be checked out at once.
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # seconds to wait for a free connection
+DB_POOL_PING_AFTER = float(os.getenv("DB_POOL_PING_AFTER", "30"))  # ping connections idle longer than this
+DB_SSLMODE = os.getenv("DB_SSLMODE", "require")  # "disable" for a local PostgreSQL
+
+_db_pool = None
+_db_pool_pid = None
+_db_pool_slots = None
+_db_pool_lock = threading.Lock()
+_db_last_used = {}  # id(conn) -> when it was last returned to the pool
+
+
+def _get_db_pool():
+    """Create the pool on first use (and again in a forked worker)."""
+    global _db_pool, _db_pool_pid, _db_pool_slots
+
+    if _db_pool is not None and _db_pool_pid == os.getpid():
+        return _db_pool
+
+    with _db_pool_lock:
+        if _db_pool is None or _db_pool_pid != os.getpid():
+            url = up.urlparse(DB_CONFIG)
+            _db_pool = psycopg2.pool.ThreadedConnectionPool(
+                DB_POOL_MIN,
+                DB_POOL_MAX,
+                database=url.path[1:],
+                user=url.username,
+                password=url.password,
+                host=url.hostname,
+                port=url.port,
+                sslmode=DB_SSLMODE,
+                cursor_factory=TimedCursor
+            )
+            _db_pool_pid = os.getpid()
+            _db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+            _db_last_used.clear()
+            log.info("Database pool ready (%d-%d connections)", DB_POOL_MIN, DB_POOL_MAX)
+    return _db_pool
+
+
+def _connection_is_healthy(conn):
+    if conn.closed:
+        return False
+    if time.time() - _db_last_used.get(id(conn), 0) < DB_POOL_PING_AFTER:
+        return True
+
+    # Idle for a while (or brand new): make sure the server is still there
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1")
+        cur.close()
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+@timed("db_connect")
+def _checkout_connection():
+    pool = _get_db_pool()
+    if not _db_pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise psycopg2.pool.PoolError("Timed out waiting for a database connection")
+
+    try:
+        # Discard dead connections until we get a live one (or a fresh connect)
+        for _ in range(DB_POOL_MAX + 1):
+            conn = pool.getconn()
+            if _connection_is_healthy(conn):
+                return conn
+            _db_last_used.pop(id(conn), None)
+            pool.putconn(conn, close=True)
+        raise psycopg2.OperationalError("No healthy database connection available")
+    except Exception:
+        _db_pool_slots.release()
+        raise
+
+
+def _release_connection(conn):
+    """Return a connection to the pool; any open transaction is rolled back."""
+    try:
+        _db_last_used[id(conn)] = time.time()
+        _db_pool.putconn(conn, close=bool(conn.closed))
+    finally:
+        _db_pool_slots.release()
+
+
+@contextmanager
+def db_connection():
+    """Check a pooled connection out for the duration of a with-block.
+
+    For code that runs outside a request (startup, CLI commands, background
+    jobs). The connection goes back to the pool even if the block raises.
+    """
+    conn = _checkout_connection()
+    try:
+        yield conn
+    finally:
+        _release_connection(conn)
 
 
 def get_db_connection():
+    """Return the current request's pooled connection, or None if unavailable.
+
+    The connection is checked out once per request (or CLI app context) and
+    returned to the pool when the context ends, including on errors, so
+    callers must not close it.
+    """
     if not DB_CONFIG:
-        print("ERROR: DATABASE_URL is not set!")
+        log.error("DATABASE_URL is not set")
         return None
 
-    print("Connecting to DB:", DB_CONFIG)  # Debugging: Check if the function runs
+    if not has_app_context():
+        raise RuntimeError("get_db_connection() needs an app context, use db_connection() instead")
 
-    try:
-        up.uses_netloc.append("postgres")
-        url = up.urlparse(DB_CONFIG)
-
-        conn = psycopg2.connect(
-            database=url.path[1:],
-            user=url.username,
-            password=url.password,
-            host=url.hostname,
-            port=url.port,
-            sslmode="require"
-        )
-        print("Successfully connected to the database!")
-        return conn
-    except Exception as e:
-        print(f"Database connection failed: {e}")
-        return None
+    if "db_conn" not in g:
+        try:
+            g.db_conn = _checkout_connection()
+        except Exception as e:
+            log.error("Database connection failed: %s", e)
+            return None
+    return g.db_conn
+
+
+@app.teardown_appcontext
+def release_db_connection(exception=None):
+    conn = g.pop("db_conn", None)
+    if conn is not None:
+        _release_connection(conn)
 
 
 # Initialize Supabase
@@ -89,58 +423,535 @@ SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
 
 
+# Response caches
+
+class TTLCache:
+    """Thread-safe in-process LRU cache whose entries expire after `ttl` seconds.
+
+    Entries can carry tags (e.g. canonical product names) so everything
+    derived from a product can be dropped at once with invalidate_tag().
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value, tags)
+        self._tags = {}  # tag -> keys
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                self._remove(key)
+                return None
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, tags=(), ttl=None):
+        tags = tuple(str(tag) for tag in tags)
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (time.time() + (self.ttl if ttl is None else ttl), value, tags)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._data) > self.maxsize:
+                self._remove(next(iter(self._data)))
+
+    def invalidate_tag(self, *tags):
+        with self._lock:
+            for tag in tags:
+                for key in list(self._tags.get(str(tag), ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._tags.clear()
+
+    def _remove(self, key):
+        _, _, tags = self._data.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+class SQLiteTTLCache:
+    """TTLCache with the same interface, kept in a SQLite file so every worker
+    process on the host shares entries and invalidations. Values must be JSON
+    serializable."""
+
+    def __init__(self, path, maxsize, ttl, table="cache"):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.table = table
+        self._local = threading.local()
+
+    def _conn(self):
+        # sqlite3 connections can't cross threads or forks, so keep one per thread per process
+        if getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            with conn:
+                conn.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {self.table} (
+                        key TEXT PRIMARY KEY,
+                        value TEXT NOT NULL,
+                        expires_at REAL NOT NULL,
+                        last_used REAL NOT NULL
+                    )
+                """)
+                conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_last_used ON {self.table} (last_used)")
+                conn.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {self.table}_tags (
+                        tag TEXT NOT NULL,
+                        key TEXT NOT NULL,
+                        PRIMARY KEY (tag, key)
+                    )
+                """)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return self._local.conn
+
+    def get(self, key):
+        now = time.time()
+        conn = self._conn()
+        row = conn.execute(
+            f"SELECT value FROM {self.table} WHERE key = ? AND expires_at > ?", (key, now)
+        ).fetchone()
+        if row is None:
+            return None
+        with conn:
+            conn.execute(f"UPDATE {self.table} SET last_used = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key, value, tags=(), ttl=None):
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), expires_at, now)
+            )
+            conn.execute(f"DELETE FROM {self.table}_tags WHERE key = ?", (key,))
+            conn.executemany(
+                f"INSERT OR IGNORE INTO {self.table}_tags (tag, key) VALUES (?, ?)",
+                [(str(tag), key) for tag in tags]
+            )
+
+            # Drop expired entries, then the least recently used beyond maxsize
+            conn.execute(f"DELETE FROM {self.table} WHERE expires_at <= ?", (now,))
+            conn.execute(f"""
+                DELETE FROM {self.table} WHERE key IN (
+                    SELECT key FROM {self.table} ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.maxsize,))
+            conn.execute(f"DELETE FROM {self.table}_tags WHERE key NOT IN (SELECT key FROM {self.table})")
+
+    def invalidate_tag(self, *tags):
+        conn = self._conn()
+        with conn:
+            conn.executemany(
+                f"DELETE FROM {self.table} WHERE key IN (SELECT key FROM {self.table}_tags WHERE tag = ?)",
+                [(str(tag),) for tag in tags]
+            )
+            conn.execute(f"DELETE FROM {self.table}_tags WHERE key NOT IN (SELECT key FROM {self.table})")
+
+    def clear(self):
+        conn = self._conn()
+        with conn:
+            conn.execute(f"DELETE FROM {self.table}")
+            conn.execute(f"DELETE FROM {self.table}_tags")
+
+
+# Outbound calls
+#
+# Every third-party API goes through an Upstream, which gives it a cap on
+# concurrent calls, a token-bucket rate limit and a circuit breaker. After
+# `failure_threshold` consecutive failures (errors, or calls slower than the
+# upstream's timeout) the circuit opens and calls fail fast with
+# UpstreamUnavailable; once `reset_timeout` has passed a single probe call is
+# let through (half-open) and its outcome closes or re-opens the circuit.
+# Limits are per worker process. Settings can be overridden with
+# UPSTREAM_<NAME>_<SETTING>, e.g. UPSTREAM_OPENAI_CONCURRENCY=4.
+UPSTREAMS = {}
+
+
+class UpstreamUnavailable(Exception):
+    """An upstream call was refused locally (circuit open, rate limited or saturated)."""
+
+
+class Upstream:
+    def __init__(self, name, timeout, concurrency=8, rate=5.0, burst=10,
+                 failure_threshold=5, reset_timeout=30.0, queue_timeout=1.0):
+        def setting(key, default, cast=float):
+            return cast(os.getenv(f"UPSTREAM_{name.upper()}_{key}", default))
+
+        self.name = name
+        self.timeout = timeout
+        self.concurrency = setting("CONCURRENCY", concurrency, int)
+        self.rate = setting("RATE", rate)  # tokens per second
+        self.burst = setting("BURST", burst)
+        self.failure_threshold = setting("FAILURE_THRESHOLD", failure_threshold, int)
+        self.reset_timeout = setting("RESET_TIMEOUT", reset_timeout)
+        self.queue_timeout = setting("QUEUE_TIMEOUT", queue_timeout)
+
+        self._slots = threading.BoundedSemaphore(self.concurrency)
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._refilled_at = time.monotonic()
+        self._state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._stats = {
+            "calls": 0, "successes": 0, "failures": 0, "slow_calls": 0,
+            "rejected_circuit_open": 0, "rejected_rate_limited": 0, "rejected_saturated": 0,
+            "in_flight": 0, "max_in_flight": 0, "total_seconds": 0.0, "circuit_opened": 0
+        }
+        UPSTREAMS[name] = self
+
+    def _admit(self):
+        """Check the circuit and take a rate-limit token; returns True for a half-open probe."""
+        with self._lock:
+            now = time.monotonic()
+            probe = False
+            if self._state == "open":
+                if now - self._opened_at < self.reset_timeout or self._probing:
+                    self._stats["rejected_circuit_open"] += 1
+                    raise UpstreamUnavailable(f"{self.name} circuit is open")
+                self._state = "half_open"
+            if self._state == "half_open":
+                if self._probing:
+                    self._stats["rejected_circuit_open"] += 1
+                    raise UpstreamUnavailable(f"{self.name} circuit is half-open")
+                probe = self._probing = True
+
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+            self._refilled_at = now
+            if self._tokens < 1:
+                if probe:
+                    self._probing = False
+                self._stats["rejected_rate_limited"] += 1
+                raise UpstreamUnavailable(f"{self.name} rate limit exceeded")
+            self._tokens -= 1
+            return probe
+
+    def _record(self, ok, elapsed, probe):
+        with self._lock:
+            self._stats["in_flight"] -= 1
+            self._stats["total_seconds"] += elapsed
+            self._stats["successes" if ok else "failures"] += 1
+            if probe:
+                self._probing = False
+            if ok:
+                self._failures = 0
+                self._state = "closed"
+                return
+            self._failures += 1
+            if probe or self._failures >= self.failure_threshold:
+                if self._state != "open":
+                    self._stats["circuit_opened"] += 1
+                    log.warning("Circuit for %s opened after %d failures", self.name, self._failures,
+                                extra={"upstream": self.name})
+                self._state = "open"
+                self._opened_at = time.monotonic()
+
+    @contextmanager
+    def request(self, check_duration=True):
+        """Guard one call (including reading a streamed response) to this upstream.
+
+        check_duration=False is for streamed responses, which may legitimately
+        take longer than the timeout in total."""
+        probe = self._admit()
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            with self._lock:
+                if probe:
+                    self._probing = False
+                self._stats["rejected_saturated"] += 1
+            raise UpstreamUnavailable(f"{self.name} is at its concurrency limit")
+
+        with self._lock:
+            self._stats["calls"] += 1
+            self._stats["in_flight"] += 1
+            self._stats["max_in_flight"] = max(self._stats["max_in_flight"], self._stats["in_flight"])
+        started = time.monotonic()
+        ok = False
+        try:
+            yield self
+            ok = True
+        except GeneratorExit:
+            # The caller stopped reading a stream (e.g. the client went away); not the upstream's fault
+            ok = True
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            if ok and check_duration and elapsed > self.timeout:
+                # Answers that arrive after the caller's timeout count against the upstream too
+                ok = False
+                with self._lock:
+                    self._stats["slow_calls"] += 1
+            self._slots.release()
+            self._record(ok, elapsed, probe)
+
+    def call(self, fn, *args, **kwargs):
+        with self.request():
+            return fn(*args, **kwargs)
+
+    def metrics(self):
+        with self._lock:
+            tokens = min(self.burst, self._tokens + (time.monotonic() - self._refilled_at) * self.rate)
+            return {
+                **self._stats,
+                "state": self._state,
+                "concurrency_limit": self.concurrency,
+                "rate_per_second": self.rate,
+                "tokens_available": round(tokens, 2),
+                "timeout": self.timeout
+            }
+
+
+def make_cache(name, maxsize, ttl, path=None):
+    """An in-process cache, or a host-wide SQLite one when `path` is set."""
+    if path:
+        return SQLiteTTLCache(path, maxsize, ttl, table=name)
+    return TTLCache(maxsize, ttl)
+
+
+# Store listings
+#
+# /stores and /store/<id> answer in full by default. ?limit=<n> pages through
+# stores (or a store's products) in ID order; the next page's cursor comes
+# back in X-Next-Cursor and a Link rel="next" header, to be passed as
+# ?after=<cursor>. ?fields= picks the fields to return. Responses carry an
+# ETag derived from the data's version (stores.updated_at, and for one store
+# its content_version, which triggers bump whenever its products or flyers
+# change), so a request with a matching If-None-Match gets a 304 without the
+# rows being read or serialized.
+STORE_PAGE_MAX = int(os.getenv("STORE_PAGE_MAX", "1000"))
+STORE_FIELDS = ("id", "name", "zip_code", "latitude", "longitude")
+STORE_DEFAULT_FIELDS = ("id", "name", "zip_code")
+PRODUCT_FIELDS = ("name", "price", "quantity")
+
+
+def _parse_fields(value, allowed, default):
+    """Fields requested with ?fields=a,b in `allowed` order (`default` when absent); raises ValueError for unknown ones."""
+    if not value:
+        return list(default)
+    requested = {field.strip() for field in value.split(",") if field.strip()}
+    if not requested or requested - set(allowed):
+        raise ValueError
+    return [field for field in allowed if field in requested]
+
+
+def _parse_page_args():
+    """(limit, after) from the query string; limit is capped at STORE_PAGE_MAX."""
+    limit = _parse_positive_arg(request.args.get("limit"), int)
+    after = _parse_positive_arg(request.args.get("after"), int)
+    if limit == 0:
+        raise ValueError
+    return (min(limit, STORE_PAGE_MAX) if limit else None), after
+
+
+def _listing_etag(*version):
+    """ETag for a listing at `version`, distinct per query string."""
+    key = json.dumps([*version, sorted(request.args.items(multi=True))], default=str)
+    return hashlib.sha1(key.encode()).hexdigest()[:20]
+
+
+def _not_modified(etag):
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
+def _listing_response(body, etag, next_cursor=None):
+    response = jsonify(body)
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"  # cache, but revalidate with If-None-Match
+    if next_cursor is not None:
+        args = request.args.to_dict()
+        args["after"] = next_cursor
+        response.headers["X-Next-Cursor"] = str(next_cursor)
+        response.headers["Link"] = f'<{request.base_url}?{up.urlencode(args)}>; rel="next"'
+    return response
+
+
+def normalize_flyer_url(url):
+    """Collapse the duplicate slashes storage URLs used to be built with (keeping the scheme's //)."""
+    return re.sub(r'(?<!:)//', '/', url)
+
+
 # Get list of all stores
 @app.route('/stores', methods=['GET'])
 def get_stores():
+    try:
+        fields = _parse_fields(request.args.get("fields"), STORE_FIELDS, STORE_DEFAULT_FIELDS)
+        limit, after = _parse_page_args()
+    except ValueError:
+        return jsonify({"error": f"fields must be some of {', '.join(STORE_FIELDS)}; "
+                                 "limit and after must be positive integers"}), 400
+
     conn = get_db_connection()
     if not conn:
         return jsonify({"error": "Database connection failed"}), 500
 
     cur = conn.cursor()
-    cur.execute("SELECT * FROM stores ORDER BY id;")
-    stores = [{"id": row[0], "name": row[1], "zip_code": row[2]} for row in cur.fetchall()]
-    cur.close()
-    conn.close()
+    try:
+        cur.execute("SELECT count(*), max(updated_at) FROM stores")
+        etag = _listing_etag("stores", *cur.fetchone())
+        not_modified = _not_modified(etag)
+        if not_modified:
+            return not_modified
+
+        query = f"SELECT {', '.join(['id'] + fields)} FROM stores"
+        params = []
+        if after is not None:
+            query += " WHERE id > %s"
+            params.append(after)
+        query += " ORDER BY id"
+        if limit is not None:
+            query += " LIMIT %s"
+            params.append(limit + 1)  # one more tells us whether there is a next page
+        cur.execute(query, params)
+        rows = cur.fetchall()
+    finally:
+        cur.close()
+
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1][0]
+    stores = [dict(zip(fields, row[1:])) for row in rows]
+    return _listing_response(stores, etag, next_cursor)
+
+
+# Create a store, geocoding its ZIP once so distance queries never have to
+@app.route('/stores', methods=['POST'])
+def create_store():
+    data = request.get_json() or {}
+    name, zip_code = data.get("name"), data.get("zip_code")
+
+    if not name or not zip_code:
+        return jsonify({"error": "Missing required fields"}), 400
+
+    coords = get_zip_coordinates(zip_code)
+    if not coords:
+        return jsonify({"error": "Invalid ZIP code"}), 400
+
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({"error": "Database connection failed"}), 500
+
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            INSERT INTO stores (name, zip_code, latitude, longitude)
+            VALUES (%s, %s, %s, %s)
+            RETURNING id;
+        """, (name, zip_code, coords["lat"], coords["lng"]))
+        store_id = cur.fetchone()[0]
+        conn.commit()
+        invalidate_store_index()
+        invalidate_price_snapshot()
+        return jsonify({
+            "id": store_id,
+            "name": name,
+            "zip_code": zip_code,
+            "latitude": coords["lat"],
+            "longitude": coords["lng"]
+        }), 201
+
+    except Exception as e:
+        conn.rollback()
+        return jsonify({"error": str(e)}), 500
 
-    return jsonify(stores)
+    finally:
+        cur.close()
 
 
 # Get store details, products, and flyers
 @app.route('/store/<int:store_id>', methods=['GET'])
 def get_store_data(store_id):
+    allowed = ("name", "products", "flyers") + tuple(f"products.{field}" for field in PRODUCT_FIELDS)
+    try:
+        fields = _parse_fields(request.args.get("fields"), allowed, ("name", "products", "flyers"))
+        limit, after = _parse_page_args()
+    except ValueError:
+        return jsonify({"error": f"fields must be some of {', '.join(allowed)}; "
+                                 "limit and after must be positive integers"}), 400
+
+    # ?fields=products.name,products.price narrows the product objects
+    product_fields = [field for field in PRODUCT_FIELDS if f"products.{field}" in fields]
+    if "products" in fields or product_fields:
+        product_fields = product_fields or list(PRODUCT_FIELDS)
+
     conn = get_db_connection()
+    if not conn:
+        return jsonify({"error": "Database connection failed"}), 500
     cur = conn.cursor()
 
     try:
         # Fetch store details
-        cur.execute("SELECT name FROM stores WHERE id = %s", (store_id,))
+        cur.execute("SELECT name, content_version, updated_at FROM stores WHERE id = %s", (store_id,))
         store = cur.fetchone()
 
         if not store:
             return jsonify({"error": "Store not found"}), 404
 
-        store_name = store[0]
-
-        # Fetch products from this store (including quantity)
-        cur.execute("SELECT name, price, quantity FROM products WHERE store_id = %s", (store_id,))
-        products = [{"name": row[0], "price": row[1], "quantity": row[2]} for row in cur.fetchall()]
-
-        # Fetch flyers for this store
-        cur.execute("SELECT image_url FROM flyers WHERE store_id = %s", (store_id,))
-        flyers = [{"image_url": re.sub(r'(?<!:)//', '/', row[0])} for row in cur.fetchall()]  # List of flyer image URLs
-
-        return jsonify({
-            "name": store_name,
-            "products": products,
-            "flyers": flyers  # Added flyers
-        })
+        store_name, content_version, updated_at = store
+        etag = _listing_etag("store", store_id, content_version, updated_at)
+        not_modified = _not_modified(etag)
+        if not_modified:
+            return not_modified
+
+        body = {}
+        if "name" in fields:
+            body["name"] = store_name
+
+        # Fetch products from this store (including quantity), a page at a time with ?limit
+        next_cursor = None
+        if product_fields:
+            query = f"SELECT id, {', '.join(product_fields)} FROM products WHERE store_id = %s"
+            params = [store_id]
+            if after is not None:
+                query += " AND id > %s"
+                params.append(after)
+            query += " ORDER BY id"
+            if limit is not None:
+                query += " LIMIT %s"
+                params.append(limit + 1)
+            cur.execute(query, params)
+            rows = cur.fetchall()
+            if limit is not None and len(rows) > limit:
+                rows = rows[:limit]
+                next_cursor = rows[-1][0]
+            body["products"] = [dict(zip(product_fields, row[1:])) for row in rows]
+
+        # Fetch flyers for this store (sent with the first page only)
+        if "flyers" in fields:
+            flyers = []
+            if after is None:
+                cur.execute("SELECT image_url FROM flyers WHERE store_id = %s ORDER BY id", (store_id,))
+                flyers = [{"image_url": row[0]} for row in cur.fetchall()]  # List of flyer image URLs
+            body["flyers"] = flyers
+
+        return _listing_response(body, etag, next_cursor)
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
     finally:
         cur.close()
-        conn.close()
 
 
 # Upload product data (Crowdsourced)
@@ -148,48 +959,201 @@ def get_store_data(store_id):
 def upload_product():
     data = request.json
     name, store_id, price, quantity = data.get("name"), data.get("store_id"), data.get("price"), data.get("quantity")
+    # Stripped like bulk uploads, so both find the same (store, name, quantity) row
+    quantity = str(quantity).strip() if quantity is not None else None
 
     if not all([name, store_id, price, quantity]):
         return jsonify({"error": "Missing required fields"}), 400
+    try:
+        price = float(price)
+    except (TypeError, ValueError):
+        price = float("nan")
+    if not np.isfinite(price) or price <= 0:
+        return jsonify({"error": "invalid price"}), 400
 
     conn = get_db_connection()
+    if not conn:
+        return jsonify({"error": "Database connection failed"}), 500
     cur = conn.cursor()
 
     try:
-        # Check if the store exists
-        cur.execute("SELECT id FROM stores WHERE id = %s;", (store_id,))
-        if cur.fetchone() is None:
+        # Insert the product, or update its price if this store already has the
+        # same name (ignoring case) and quantity. Nothing is inserted if the
+        # store doesn't exist.
+        cur.execute("""
+            INSERT INTO products (name, store_id, price, quantity, canonical_id)
+            SELECT %(name)s, s.id, %(price)s, %(quantity)s,
+                   (SELECT canonical_id FROM product_aliases WHERE alias = LOWER(TRIM(%(name)s)))
+            FROM stores s
+            WHERE s.id = %(store_id)s
+            ON CONFLICT (store_id, normalized_name, quantity)
+            DO UPDATE SET price = EXCLUDED.price
+            RETURNING id, canonical_id, (xmax = 0) AS inserted,
+                      (SELECT name FROM canonical_products c WHERE c.id = products.canonical_id);
+        """, {"name": name, "store_id": store_id, "price": price, "quantity": quantity})
+        row = cur.fetchone()
+        if row is None:
             return jsonify({"error": "Store ID does not exist"}), 400
 
-        # Check if the product with exact same name and quantity exists for this store
-        cur.execute("""
-            SELECT id FROM products 
-            WHERE name = %s AND store_id = %s AND quantity = %s;
-        """, (name, store_id, quantity))
-        existing_product = cur.fetchone()
+        product_id, canonical_id, inserted, canonical_name = row
+        if canonical_id is None:
+            # A name we've never seen: register it as its own canonical product
+            cur.execute("""
+                UPDATE products SET canonical_id = %s WHERE id = %s
+                RETURNING (SELECT name FROM canonical_products c WHERE c.id = products.canonical_id)
+            """, (resolve_canonical_product_id(cur, name), product_id))
+            canonical_name = cur.fetchone()[0]
+        message = "New product added successfully" if inserted else "Product price updated successfully"
+
+        conn.commit()
+        compare_cache.invalidate_tag(canonical_name)
+        invalidate_price_snapshot()
+        return jsonify({"message": message, "product_id": product_id}), 201
+
+    except Exception as e:
+        conn.rollback()
+        return jsonify({"error": str(e)}), 500
+
+    finally:
+        cur.close()
+
+
+BULK_UPLOAD_COLUMNS = ["name", "store_id", "price", "quantity"]
+
+
+def _read_bulk_products():
+    """Parse a CSV or JSON price sheet from the request into a DataFrame of strings/numbers."""
+    upload = request.files.get("file")
+    if upload is not None:
+        raw, filename, content_type = upload.read(), upload.filename or "", upload.content_type or ""
+    else:
+        raw, filename, content_type = request.get_data(), "", request.content_type or ""
+
+    if filename.lower().endswith(".json") or "json" in content_type:
+        records = json.loads(raw)
+        if isinstance(records, dict):
+            records = records.get("products", [])
+        if not isinstance(records, list):
+            raise ValueError("Expected a JSON array of products")
+        return pd.DataFrame.from_records(records)
+
+    return pd.read_csv(io.BytesIO(raw), dtype=str, skipinitialspace=True)
+
+
+def _validate_bulk_products(df, known_store_ids):
+    """Vectorized validation; returns (accepted rows, rejected rows with a reason)."""
+    df = df.reset_index(drop=True)
+    df["row"] = df.index
+    df["name"] = df["name"].astype("string").str.strip()
+    df["quantity"] = df["quantity"].astype("string").str.strip()
+    df["store_id"] = pd.to_numeric(df["store_id"], errors="coerce")
+    df["price"] = pd.to_numeric(df["price"], errors="coerce")
+
+    # First failing check wins
+    reason = pd.Series(np.select(
+        [
+            df["name"].isna() | (df["name"] == ""),
+            df["quantity"].isna() | (df["quantity"] == ""),
+            df["store_id"].isna() | (df["store_id"] % 1 != 0),
+            ~np.isfinite(df["price"]) | (df["price"] <= 0),
+            ~df["store_id"].isin(known_store_ids),
+        ],
+        ["missing name", "missing quantity", "invalid store_id", "invalid price", "Store ID does not exist"],
+        default=""
+    ), index=df.index)
+
+    # Several rows for the same product: the last one wins
+    key = pd.DataFrame({"store_id": df["store_id"], "name": df["name"].str.lower(), "quantity": df["quantity"]})
+    superseded = (reason == "") & key.where(reason == "").duplicated(keep="last")
+    reason[superseded] = "superseded by a later row for the same product"
+
+    accepted = df[reason == ""].copy()
+    accepted["store_id"] = accepted["store_id"].astype(int)
+    rejected = pd.DataFrame({"row": df["row"][reason != ""], "error": reason[reason != ""]})
+    return accepted, rejected
+
+
+# Bulk upload product prices (CSV or JSON price sheets)
+@app.route('/upload_products', methods=['POST'])
+def upload_products():
+    try:
+        df = _read_bulk_products()
+    except (ValueError, pd.errors.ParserError, UnicodeDecodeError) as e:
+        return jsonify({"error": f"Could not parse upload: {e}"}), 400
+
+    missing = [column for column in BULK_UPLOAD_COLUMNS if column not in df.columns]
+    if missing:
+        return jsonify({"error": f"Missing required columns: {', '.join(missing)}"}), 400
+    if df.empty:
+        return jsonify({"error": "No products provided"}), 400
+
+    conn = get_db_connection()
+    if not conn:
+        return jsonify({"error": "Database connection failed"}), 500
+
+    cur = conn.cursor()
+    try:
+        store_ids = pd.to_numeric(df["store_id"], errors="coerce").dropna()
+        store_ids = [int(store_id) for store_id in store_ids.unique() if store_id % 1 == 0]
+        cur.execute("SELECT id FROM stores WHERE id = ANY(%s)", (store_ids,))
+        known_store_ids = [row[0] for row in cur.fetchall()]
+
+        accepted, rejected = _validate_bulk_products(df[BULK_UPLOAD_COLUMNS].copy(), known_store_ids)
 
-        if existing_product:
-            # Update existing product only if name and quantity match exactly
+        inserted = updated = 0
+        if not accepted.empty:
+            # COPY the sheet into a staging table, then upsert it in one statement
             cur.execute("""
-                UPDATE products 
-                SET price = %s 
-                WHERE id = %s
-                RETURNING id;
-            """, (price, existing_product[0]))
-            product_id = existing_product[0]
-            message = "Product price updated successfully"
-        else:
-            # Insert new product if no exact match found
+                CREATE TEMP TABLE products_staging (
+                    name TEXT, store_id INTEGER, price NUMERIC, quantity TEXT
+                ) ON COMMIT DROP
+            """)
+            buffer = io.StringIO()
+            accepted[BULK_UPLOAD_COLUMNS].to_csv(buffer, index=False, header=False)
+            buffer.seek(0)
+            cur.copy_expert("COPY products_staging (name, store_id, price, quantity) FROM STDIN WITH (FORMAT csv)", buffer)
+
+            # Names we've never seen become canonical products of their own
+            cur.execute("""
+                INSERT INTO canonical_products (name)
+                SELECT DISTINCT LOWER(TRIM(st.name)) FROM products_staging st
+                WHERE NOT EXISTS (SELECT 1 FROM product_aliases a WHERE a.alias = LOWER(TRIM(st.name)))
+                ON CONFLICT (name) DO NOTHING
+            """)
             cur.execute("""
-                INSERT INTO products (name, store_id, price, quantity) 
-                VALUES (%s, %s, %s, %s) 
-                RETURNING id;
-            """, (name, store_id, price, quantity))
-            product_id = cur.fetchone()[0]
-            message = "New product added successfully"
+                INSERT INTO product_aliases (alias, canonical_id)
+                SELECT c.name, c.id
+                FROM canonical_products c
+                JOIN (SELECT DISTINCT LOWER(TRIM(name)) AS alias FROM products_staging) st ON st.alias = c.name
+                ON CONFLICT (alias) DO NOTHING
+            """)
+
+            cur.execute("""
+                INSERT INTO products (name, store_id, price, quantity, canonical_id)
+                SELECT st.name, st.store_id, st.price, st.quantity, a.canonical_id
+                FROM products_staging st
+                LEFT JOIN product_aliases a ON a.alias = LOWER(TRIM(st.name))
+                ON CONFLICT (store_id, normalized_name, quantity)
+                DO UPDATE SET price = EXCLUDED.price
+                RETURNING (xmax = 0) AS inserted,
+                          (SELECT name FROM canonical_products c WHERE c.id = products.canonical_id)
+            """)
+            results = cur.fetchall()
+            inserted = sum(row[0] for row in results)
+            updated = len(results) - inserted
+            canonical_names = {row[1] for row in results}
 
         conn.commit()
-        return jsonify({"message": message, "product_id": product_id}), 201
+        if not accepted.empty:
+            compare_cache.invalidate_tag(*canonical_names)
+        invalidate_price_snapshot()
+        return jsonify({
+            "accepted": len(accepted),
+            "inserted": inserted,
+            "updated": updated,
+            "rejected": len(rejected),
+            "errors": rejected.to_dict(orient="records")
+        }), 200
 
     except Exception as e:
         conn.rollback()
@@ -197,13 +1161,12 @@ def upload_product():
 
     finally:
         cur.close()
-        conn.close()
 
 
 # Upload flyer image
 @app.route('/upload_flyer', methods=['POST'])
 def upload_flyer():
-    logging.debug(f"Request received: {request.form}, Files: {request.files}")
+    log.debug("Flyer upload received: %s, files: %s", request.form, request.files)
     if 'file' not in request.files or 'store_id' not in request.form:
         return jsonify({"error": "Missing required fields"}), 400
 
@@ -215,7 +1178,7 @@ def upload_flyer():
 
     # Secure the filename and generate a unique name
     filename = secure_filename(f"{int(time.time())}_{file.filename}")
-    print(f"File to be uploaded: {filename}")
+    log.debug("File to be uploaded: %s", filename)
     # Upload to Supabase Storage
     try:
         # Verify if Supabase Upload is Working
@@ -228,8 +1191,8 @@ def upload_flyer():
             file_options={"content-type": file.content_type}  # Ensure correct MIME type
         )
 
-        image_url = f"{SUPABASE_URL}/storage/v1/object/public/flyers/{filename}"
-        print(f"Image URL: {image_url}")
+        image_url = normalize_flyer_url(f"{SUPABASE_URL}/storage/v1/object/public/flyers/{filename}")
+        log.debug("Image URL: %s", image_url)
         updated_at = datetime.now(timezone.utc)
 
         # Insert flyer details into the database
@@ -242,12 +1205,11 @@ def upload_flyer():
 
         flyer_id = cur.fetchone()
         if not flyer_id:
-            print("Database insertion failed!")
+            log.error("Flyer insertion returned no ID")
         else:
-            print(f"Flyer inserted with ID: {flyer_id[0]}")
+            log.info("Flyer inserted with ID %s", flyer_id[0], extra={"store_id": store_id})
         conn.commit()
         cur.close()
-        conn.close()
 
         return jsonify({
             "message": "Flyer uploaded successfully",
@@ -258,16 +1220,74 @@ def upload_flyer():
         }), 201
 
     except Exception as e:
-        print("Upload error:", str(e))
-        traceback.print_exc()  # Prints full error traceback
+        log.exception("Flyer upload failed: %s", e)
         return jsonify({"error": str(e)}), 500
 
 
-# Function to get ZIP code coordinates
-def get_zip_coordinates(zip_code):
+# Offline ZIP centroid index
+#
+# ZIP centroids are loaded once per process from a bundled CSV (zip,lat,lng)
+# into three parallel arrays sorted by integer ZIP, so a lookup is a single
+# bisect with no network. The remote API is only used for ZIPs the dataset
+# doesn't know about, and those answers are remembered for the process.
+ZIP_CENTROIDS_PATH = os.getenv(
+    "ZIP_CENTROIDS_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "zip_centroids.csv")
+)
+ZIP_API_FALLBACK = os.getenv("ZIP_API_FALLBACK", "true").lower() in ("1", "true", "yes")
+ZIP_API_TIMEOUT = float(os.getenv("ZIP_API_TIMEOUT", "3"))
+zip_api = Upstream("zippopotam", ZIP_API_TIMEOUT, concurrency=4, rate=5, burst=10)
+
+_zip_keys = array('l')
+_zip_lats = array('d')
+_zip_lngs = array('d')
+_zip_fallback_cache = {}
+_zip_api_session = requests.Session()
+
+
+def load_zip_centroids(path=ZIP_CENTROIDS_PATH):
+    """Load the ZIP centroid CSV into the sorted in-process index."""
+    global _zip_keys, _zip_lats, _zip_lngs
+
+    if not os.path.exists(path):
+        log.warning("ZIP centroid dataset not found at %s, using remote lookups only", path)
+        return 0
+
+    rows = []
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            try:
+                rows.append((int(row["zip"]), float(row["lat"]), float(row["lng"])))
+            except (KeyError, TypeError, ValueError):
+                continue
+    rows.sort()
+
+    _zip_keys = array('l', (r[0] for r in rows))
+    _zip_lats = array('d', (r[1] for r in rows))
+    _zip_lngs = array('d', (r[2] for r in rows))
+    log.info("Loaded %d ZIP centroids from %s", len(_zip_keys), path)
+    return len(_zip_keys)
+
+
+def _zip_to_int(zip_code):
+    """Normalize '02139', '02139-4307' or 2139 to an integer ZIP (or None)."""
+    if isinstance(zip_code, int):
+        return zip_code if 0 <= zip_code <= 99999 else None
+    zip5 = str(zip_code).strip()[:5]
+    if len(zip5) != 5 or not zip5.isdigit():
+        return None
+    return int(zip5)
+
+
+def _fetch_zip_coordinates(zip_code):
+    """Remote fallback for ZIPs missing from the bundled dataset."""
     try:
-        # Using the free ZIP code API
-        response = requests.get(f"https://api.zippopotam.us/us/{zip_code}")
+        with zip_api.request():
+            response = _zip_api_session.get(
+                f"https://api.zippopotam.us/us/{zip_code}", timeout=ZIP_API_TIMEOUT
+            )
+            if response.status_code >= 500:
+                response.raise_for_status()
         if response.status_code == 200:
             data = response.json()
             return {
@@ -276,71 +1296,260 @@ def get_zip_coordinates(zip_code):
             }
         return None
     except Exception as e:
-        print(f"Error getting coordinates for ZIP code: {e}")
+        log.warning("Error getting coordinates for ZIP code %s: %s", zip_code, e)
+        return None
+
+
+# Function to get ZIP code coordinates
+@timed("geocode")
+def get_zip_coordinates(zip_code):
+    key = _zip_to_int(zip_code)
+    if key is None:
         return None
 
+    i = bisect_left(_zip_keys, key)
+    if i < len(_zip_keys) and _zip_keys[i] == key:
+        return {"lat": _zip_lats[i], "lng": _zip_lngs[i]}
+
+    if not ZIP_API_FALLBACK:
+        return None
 
-# Calculate distance between two ZIP codes using Haversine formula
-def calculate_distance(lat1, lon1, lat2, lon2):
+    if key not in _zip_fallback_cache:
+        coords = _fetch_zip_coordinates(f"{key:05d}")
+        if coords is None:
+            # Don't remember transient failures, only answers
+            return None
+        _zip_fallback_cache[key] = coords
+    return _zip_fallback_cache[key]
+
+
+if not SOLVER_PROCESS:
+    load_zip_centroids()
+
+
+@app.cli.command("import-zip-centroids")
+@click.argument("gazetteer_path")
+@click.option("--output", default=ZIP_CENTROIDS_PATH, help="Where to write the zip,lat,lng CSV")
+def import_zip_centroids(gazetteer_path, output):
+    """Build the bundled ZIP centroid CSV from a Census ZCTA gazetteer file.
+
+    The gazetteer (2020_Gaz_zcta_national.txt) is tab separated with GEOID,
+    INTPTLAT and INTPTLONG columns.
+    """
+    df = pd.read_csv(gazetteer_path, sep="\t", dtype={"GEOID": str})
+    df.columns = [c.strip() for c in df.columns]
+    out = pd.DataFrame({
+        "zip": df["GEOID"].str.zfill(5),
+        "lat": df["INTPTLAT"].round(6),
+        "lng": df["INTPTLONG"].round(6),
+    }).sort_values("zip")
+
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    out.to_csv(output, index=False)
+    click.echo(f"Wrote {len(out)} ZIP centroids to {output}")
+    load_zip_centroids(output)
+
+
+# Vectorized Haversine from one point to many stores (miles, unrounded)
+def calculate_distances(lat, lng, lats, lngs):
+    """Distances from (lat, lng) to every (lats[i], lngs[i]); NaN coordinates give NaN."""
     R = 3959.87433  # Earth's radius in miles
 
-    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
+    lat1, lng1 = np.radians(lat), np.radians(lng)
+    lat2 = np.radians(np.asarray(lats, dtype=float))
+    lng2 = np.radians(np.asarray(lngs, dtype=float))
+
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    a = np.clip(a, 0.0, 1.0)
+    return R * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def nearest_indices(distances, k=None):
+    """Indices of the k smallest distances, closest first (all of them if k is None)."""
+    distances = np.asarray(distances, dtype=float)
+    if k is None or k >= len(distances):
+        return np.argsort(distances, kind="stable")
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+
+    # Partition out the k closest, then only sort those
+    nearest = np.argpartition(distances, k - 1)[:k]
+    return nearest[np.argsort(distances[nearest], kind="stable")]
+
+
+# In-memory spatial index over store coordinates
+#
+# Stores are bucketed into a fixed lat/lng grid. Radius queries only look at
+# the cells overlapping the circle's bounding box and k-nearest queries widen
+# the search radius until enough stores are found, so the cost grows with the
+# number of nearby stores rather than the size of the catalog.
+STORE_INDEX_CELL_DEGREES = float(os.getenv("STORE_INDEX_CELL_DEGREES", "0.25"))
+STORE_INDEX_TTL = int(os.getenv("STORE_INDEX_TTL", "300"))  # seconds, picks up other workers' changes
+
+MILES_PER_DEGREE_LAT = 69.0
+
+
+class StoreSpatialIndex:
+    """Grid index for radius and k-nearest queries over geocoded stores."""
+
+    def __init__(self, stores, cell_degrees=STORE_INDEX_CELL_DEGREES):
+        stores = list(stores)
+        self.cell_degrees = cell_degrees
+        self.ids = [row[0] for row in stores]
+        self.names = [row[1] for row in stores]
+        self.zip_codes = [row[2] for row in stores]
+        self.lats = np.array([row[3] for row in stores], dtype=float)
+        self.lngs = np.array([row[4] for row in stores], dtype=float)
+
+        # Group store positions by grid cell: cell -> array of positions
+        self._cells = {}
+        if stores:
+            cell_rows = np.floor(self.lats / cell_degrees).astype(np.int64)
+            cell_cols = np.floor(self.lngs / cell_degrees).astype(np.int64)
+            order = np.lexsort((cell_cols, cell_rows))
+            keys = np.stack((cell_rows[order], cell_cols[order]), axis=1)
+            starts = np.flatnonzero(np.any(np.diff(keys, axis=0) != 0, axis=1)) + 1
+            for group in np.split(order, starts):
+                self._cells[(int(cell_rows[group[0]]), int(cell_cols[group[0]]))] = group
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _candidates(self, lat, lng, radius):
+        """Positions of stores in the grid cells overlapping the radius' bounding box."""
+        dlat = radius / MILES_PER_DEGREE_LAT
+        dlng = radius / (MILES_PER_DEGREE_LAT * max(np.cos(np.radians(lat)), 0.01))
+
+        row_lo, row_hi = int(np.floor((lat - dlat) / self.cell_degrees)), int(np.floor((lat + dlat) / self.cell_degrees))
+        col_lo, col_hi = int(np.floor((lng - dlng) / self.cell_degrees)), int(np.floor((lng + dlng) / self.cell_degrees))
+
+        # A box bigger than the populated grid is cheaper to scan outright
+        if (row_hi - row_lo + 1) * (col_hi - col_lo + 1) >= len(self._cells):
+            return np.arange(len(self.ids))
+
+        groups = [
+            self._cells[(r, c)]
+            for r in range(row_lo, row_hi + 1)
+            for c in range(col_lo, col_hi + 1)
+            if (r, c) in self._cells
+        ]
+        return np.concatenate(groups) if groups else np.empty(0, dtype=np.intp)
+
+    def query(self, lat, lng, radius=None, limit=None):
+        """Stores near (lat, lng), closest first, as (positions, distances).
+
+        With radius, only stores within that many miles are returned; with
+        limit, at most that many. With neither, every store is ranked.
+        """
+        if not self.ids or limit == 0:
+            return np.empty(0, dtype=np.intp), np.empty(0)
+
+        if radius is None and limit is not None:
+            # Widen the search until it holds `limit` stores within its radius
+            radius = self.cell_degrees * MILES_PER_DEGREE_LAT
+            while True:
+                candidates = self._candidates(lat, lng, radius)
+                distances = calculate_distances(lat, lng, self.lats[candidates], self.lngs[candidates])
+                if np.count_nonzero(distances <= radius) >= limit or len(candidates) == len(self.ids):
+                    break
+                radius *= 2
+            radius = None
+        elif radius is not None:
+            candidates = self._candidates(lat, lng, radius)
+            distances = calculate_distances(lat, lng, self.lats[candidates], self.lngs[candidates])
+        else:
+            candidates = np.arange(len(self.ids))
+            distances = calculate_distances(lat, lng, self.lats, self.lngs)
+
+        if radius is not None:
+            within = distances <= radius
+            candidates, distances = candidates[within], distances[within]
 
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
+        nearest = nearest_indices(distances, limit)
+        return candidates[nearest], distances[nearest]
 
-    a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
-    c = 2 * atan2(sqrt(a), sqrt(1 - a))
-    distance = R * c
+    def nearby_store_ids(self, lat, lng, radius=None, limit=None):
+        positions, _ = self.query(lat, lng, radius=radius, limit=limit)
+        return [self.ids[i] for i in positions]
 
-    return round(distance, 2)
+
+_store_index = None
+_store_index_built_at = 0.0
+_store_index_lock = threading.Lock()
+
+
+def get_store_index(conn):
+    """Return the process-wide store index, rebuilding it if stale."""
+    global _store_index, _store_index_built_at
+
+    with _store_index_lock:
+        if _store_index is None or time.time() - _store_index_built_at > STORE_INDEX_TTL:
+            cur = conn.cursor()
+            cur.execute("""
+                SELECT id, name, zip_code, latitude, longitude
+                FROM stores
+                WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+            """)
+            _store_index = StoreSpatialIndex(cur.fetchall())
+            _store_index_built_at = time.time()
+            cur.close()
+        return _store_index
+
+
+def invalidate_store_index():
+    """Force the next get_store_index call to rebuild (call after stores change)."""
+    global _store_index
+    with _store_index_lock:
+        _store_index = None
+
+
+def _parse_positive_arg(value, cast):
+    """Parse an optional positive query/body parameter; raises ValueError if invalid."""
+    if value is None or value == "":
+        return None
+    value = cast(value)
+    if value < 0:
+        raise ValueError
+    return value
 
 
 # Get stores sorted by distance from user's ZIP code
 @app.route('/stores/by-distance/<user_zip>', methods=['GET'])
 def get_stores_by_distance(user_zip):
     try:
+        try:
+            radius = _parse_positive_arg(request.args.get("radius"), float)
+            limit = _parse_positive_arg(request.args.get("limit"), int)
+        except ValueError:
+            return jsonify({"error": "radius and limit must be positive numbers"}), 400
+
         # Get user's coordinates
         user_coords = get_zip_coordinates(user_zip)
         if not user_coords:
             return jsonify({"error": "Invalid ZIP code"}), 400
 
         conn = get_db_connection()
-        cur = conn.cursor()
-
-        # Get all stores
-        cur.execute("SELECT id, name, zip_code FROM stores")
-        stores = cur.fetchall()
-
-        # Calculate distances and sort stores
-        stores_with_distance = []
-        for store in stores:
-            store_id, store_name, store_zip = store
-            store_coords = get_zip_coordinates(store_zip)
-
-            if store_coords:
-                distance = calculate_distance(
-                    user_coords["lat"], user_coords["lng"],
-                    store_coords["lat"], store_coords["lng"]
-                )
-
-                stores_with_distance.append({
-                    "id": store_id,
-                    "name": store_name,
-                    "zip_code": store_zip,
-                    "distance": distance
-                })
+        if not conn:
+            return jsonify({"error": "Database connection failed"}), 500
+        index = get_store_index(conn)
 
-        # Sort stores by distance
-        stores_with_distance.sort(key=lambda x: x["distance"])
+        # Only the stores inside the radius / limit are ranked and serialized
+        positions, distances = index.query(user_coords["lat"], user_coords["lng"], radius=radius, limit=limit)
 
-        cur.close()
-        conn.close()
+        stores_with_distance = [
+            {
+                "id": index.ids[i],
+                "name": index.names[i],
+                "zip_code": index.zip_codes[i],
+                "distance": round(float(distance), 2)
+            }
+            for i, distance in zip(positions, distances)
+        ]
 
         return jsonify(stores_with_distance)
 
     except Exception as e:
-        print(f"Error in get_stores_by_distance: {e}")
+        log.exception("Error in get_stores_by_distance: %s", e)
         return jsonify({"error": str(e)}), 500
 
 
@@ -374,113 +1583,478 @@ PRODUCT_SYNONYMS = {
     "red chili powder": ["red chilli powder", "lal mirch powder"]
 }
 
-def get_product_synonyms(product_name):
-    """Get all possible names for a product including synonyms"""
-    product_name = product_name.lower().strip()
-    synonyms = [product_name]
-    
-    # Check if the product is in our synonyms mapping
-    for key, values in PRODUCT_SYNONYMS.items():
-        if product_name == key or product_name in values:
-            synonyms.extend([key] + values)
-            break
-    
-    return list(set(synonyms))  # Remove duplicates
+# PRODUCT_SYNONYMS seeds the product_aliases table, which is the source of
+# truth for which names refer to the same canonical product. Each worker keeps
+# an in-memory alias index, reloaded by the code that reads it once it is
+# SYNONYMS_RELOAD_INTERVAL seconds old.
+SYNONYMS_RELOAD_INTERVAL = float(os.getenv("SYNONYMS_RELOAD_INTERVAL", "60"))
 
-@app.route('/api/compare-prices', methods=['POST'])
-def compare_prices():
-    try:
-        data = request.get_json()
-        print("Received request data:", data)  # Debug log
 
-        items = data.get('items', [])
-        user_zip = data.get('userZip')
+def build_synonym_index(synonyms):
+    """Build the alias -> canonical name index (a canonical name maps to itself).
 
-        print(f"Processing items: {items}, user_zip: {user_zip}")  # Debug log
+    If an alias appears under several products the first one wins, which is
+    what the old linear scan over PRODUCT_SYNONYMS did.
+    """
+    alias_index = {}
+    for canonical, aliases in synonyms.items():
+        canonical = canonical.lower().strip()
+        alias_index.setdefault(canonical, canonical)
+        for alias in aliases:
+            alias_index.setdefault(alias.lower().strip(), canonical)
+    return alias_index
 
-        if not items:
-            return jsonify({"error": "No items provided"}), 400
 
-        conn = get_db_connection()
+_alias_index = build_synonym_index(PRODUCT_SYNONYMS)
+_synonyms_loaded_at = 0.0
+_synonyms_lock = threading.Lock()
+
+
+def _load_synonyms_from_db(conn):
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT c.name, a.alias
+        FROM product_aliases a
+        JOIN canonical_products c ON c.id = a.canonical_id
+    """)
+    synonyms = {}
+    for canonical, alias in cur.fetchall():
+        synonyms.setdefault(canonical, []).append(alias)
+    cur.close()
+    return synonyms
+
+
+def reload_product_synonyms(synonyms=None, conn=None):
+    """Rebuild the synonym index from `synonyms`, or from the product_aliases table."""
+    global _alias_index, _synonyms_loaded_at
+
+    if synonyms is None:
+        if conn is None:
+            with db_connection() as conn:
+                synonyms = _load_synonyms_from_db(conn)
+        else:
+            synonyms = _load_synonyms_from_db(conn)
+
+    _alias_index = build_synonym_index(synonyms)
+    _synonyms_loaded_at = time.time()
+    log.info("Loaded %d products with %d names into the synonym index", len(synonyms), len(_alias_index))
+
+
+def product_alias_index(conn=None):
+    """This worker's alias -> canonical name index, reloaded first (picking up
+    alias changes made by other workers) if it is older than SYNONYMS_RELOAD_INTERVAL."""
+    global _synonyms_loaded_at
+
+    if time.time() - _synonyms_loaded_at < SYNONYMS_RELOAD_INTERVAL:
+        return _alias_index
+
+    with _synonyms_lock:
+        if time.time() - _synonyms_loaded_at < SYNONYMS_RELOAD_INTERVAL:
+            return _alias_index
+        if conn is None and has_app_context():
+            conn = get_db_connection()
         if not conn:
-            return jsonify({"error": "Database connection failed"}), 500
+            return _alias_index
+        try:
+            reload_product_synonyms(conn=conn)
+        except psycopg2.Error as e:
+            conn.rollback()
+            _synonyms_loaded_at = time.time()  # keep the old index, try again next interval
+            log.warning("Could not reload product synonyms: %s", e)
+    return _alias_index
+
+
+def canonical_product_name(product_name, conn=None):
+    """The canonical name for a product (the name itself if it has no synonyms)."""
+    product_name = product_name.lower().strip()
+    return product_alias_index(conn).get(product_name, product_name)
+
+
+def store_product_synonyms(cursor, synonyms, overwrite=False):
+    """Write {canonical: [aliases]} into canonical_products/product_aliases.
+
+    With overwrite, aliases already pointing at another product are moved and
+    existing products are re-pointed to their new canonical product.
+    """
+    canonical_names = [canonical.lower().strip() for canonical in synonyms]
+    execute_values(
+        cursor,
+        "INSERT INTO canonical_products (name) VALUES %s ON CONFLICT (name) DO NOTHING",
+        [(name,) for name in canonical_names]
+    )
+    cursor.execute("SELECT name, id FROM canonical_products WHERE name = ANY(%s)", (canonical_names,))
+    canonical_ids = dict(cursor.fetchall())
+
+    alias_rows = {}
+    for canonical, aliases in synonyms.items():
+        canonical = canonical.lower().strip()
+        for alias in [canonical] + list(aliases):
+            alias_rows.setdefault(alias.lower().strip(), canonical_ids[canonical])
+
+    on_conflict = "UPDATE SET canonical_id = EXCLUDED.canonical_id" if overwrite else "NOTHING"
+    execute_values(
+        cursor,
+        f"INSERT INTO product_aliases (alias, canonical_id) VALUES %s ON CONFLICT (alias) DO {on_conflict}",
+        list(alias_rows.items())
+    )
+
+    if overwrite:
+        cursor.execute("""
+            UPDATE products p
+            SET canonical_id = a.canonical_id
+            FROM product_aliases a
+            WHERE a.alias = p.normalized_name AND p.canonical_id IS DISTINCT FROM a.canonical_id
+        """)
+
+
+def resolve_canonical_product_id(cursor, name):
+    """Canonical product ID for a product name, registering unknown names as new products."""
+    alias = name.lower().strip()
+    cursor.execute("SELECT canonical_id FROM product_aliases WHERE alias = %s", (alias,))
+    row = cursor.fetchone()
+    if row:
+        return row[0]
+
+    cursor.execute("""
+        INSERT INTO canonical_products (name) VALUES (%s)
+        ON CONFLICT (name) DO UPDATE SET name = EXCLUDED.name
+        RETURNING id
+    """, (alias,))
+    canonical_id = cursor.fetchone()[0]
+    cursor.execute("""
+        INSERT INTO product_aliases (alias, canonical_id) VALUES (%s, %s)
+        ON CONFLICT (alias) DO UPDATE SET alias = EXCLUDED.alias
+        RETURNING canonical_id
+    """, (alias, canonical_id))
+    return cursor.fetchone()[0]
+
+
+@app.cli.command("import-product-synonyms")
+@click.argument("json_path")
+def import_product_synonyms(json_path):
+    """Load {"canonical": ["alias", ...]} synonyms from a JSON file into product_aliases."""
+    with open(json_path) as f:
+        synonyms = json.load(f)
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    store_product_synonyms(cursor, synonyms, overwrite=True)
+    conn.commit()
+    cursor.close()
+
+    reload_product_synonyms(conn=conn)
+    compare_cache.clear()
+    invalidate_price_snapshot()
+    click.echo(f"Imported synonyms for {len(synonyms)} products")
+
+
+# In-memory price snapshot
+#
+# Each worker keeps every product's (canonical product, store, name, price) in
+# columnar arrays sorted by canonical ID, so compare-prices and optimize-stops
+# read prices from memory instead of joining products and stores per request.
+# A snapshot older than PRICE_SNAPSHOT_MAX_AGE seconds is brought up to date
+# before it is read by fetching only the rows written by transactions that
+# had not committed when the last refresh ran: every write stamps the row's
+# changed_xid with its transaction ID, and each refresh remembers
+# pg_current_snapshot() from before its reads. Unlike a timestamp this
+# follows commit order, so a long transaction that commits late is still
+# picked up. Deleted rows don't show up that way, so the snapshot is rebuilt
+# from scratch every
+# PRICE_SNAPSHOT_REBUILD_INTERVAL seconds. If a refresh fails the request falls
+# back to SQL rather than serve older prices. PRICE_SNAPSHOT_MAX_AGE=0 turns
+# the snapshot off.
+PRICE_SNAPSHOT_MAX_AGE = float(os.getenv("PRICE_SNAPSHOT_MAX_AGE", "5"))
+PRICE_SNAPSHOT_REBUILD_INTERVAL = float(os.getenv("PRICE_SNAPSHOT_REBUILD_INTERVAL", "600"))
+
+
+class PriceSnapshot:
+    """Prices of all products as parallel arrays sorted by canonical ID.
+
+    Snapshots are never modified once built; refresh() returns a new one, so
+    readers can keep using the one they got while a refresh runs.
+    """
+
+    def __init__(self, product_ids, canonical_ids, store_ids, prices, names,
+                 stores, canonical_id_of, watermark, built_at):
+        self.product_ids = product_ids
+        self.canonical_ids = canonical_ids
+        self.store_ids = store_ids
+        self.prices = prices
+        self.names = names
+        self.stores = stores  # store ID -> (name, zip_code, latitude, longitude)
+        self.canonical_id_of = canonical_id_of  # canonical name -> ID
+        self.watermark = watermark  # pg_current_snapshot() taken before the last reads
+        self.built_at = built_at  # when the last full load ran
+        self.refreshed_at = time.time()
+
+    @classmethod
+    def load(cls, conn):
+        """Build a snapshot from the full tables."""
+        empty = cls(
+            np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+            np.empty(0), np.empty(0, dtype=object), {}, {}, None, time.time()
+        )
+        return empty.refresh(conn)
 
+    def refresh(self, conn):
+        """A new snapshot with the rows committed since this one's watermark applied."""
         cur = conn.cursor()
+        # Taken before the reads: anything committed later is read again next time
+        cur.execute("SELECT pg_current_snapshot()::text")
+        watermark = cur.fetchone()[0]
 
-        # Get all possible names for each item
-        all_item_names = []
-        for item in items:
-            synonyms = get_product_synonyms(item)
-            all_item_names.extend(synonyms)
+        if self.watermark is None:
+            changed_after, params = "", None
+        else:
+            # Written by a transaction still running (or not yet started) at the watermark
+            changed_after = """
+                WHERE changed_xid >= pg_snapshot_xmin(%(seen)s::pg_snapshot)
+                  AND NOT pg_visible_in_snapshot(changed_xid, %(seen)s::pg_snapshot)
+            """
+            params = {"seen": self.watermark}
+
+        cur.execute("SELECT id, canonical_id, store_id, name, price FROM products" + changed_after, params)
+        product_rows = cur.fetchall()
+        cur.execute("SELECT id, name, zip_code, latitude, longitude FROM stores" + changed_after, params)
+        store_rows = cur.fetchall()
+
+        canonical_id_of = self.canonical_id_of
+        known = set(canonical_id_of.values())
+        missing = sorted({row[1] for row in product_rows if row[1] is not None} - known)
+        if params is None:
+            cur.execute("SELECT name, id FROM canonical_products")
+            canonical_id_of = dict(cur.fetchall())
+        elif missing:
+            cur.execute("SELECT name, id FROM canonical_products WHERE id = ANY(%s)", (missing,))
+            canonical_id_of = {**canonical_id_of, **dict(cur.fetchall())}
+        cur.close()
 
-        # Create a placeholder string for the SQL IN clause
-        items_placeholder = ','.join(['%s'] * len(all_item_names))
+        stores = dict(self.stores)
+        stores.update((row[0], tuple(row[1:5])) for row in store_rows)
 
-        query = f"""
-            SELECT p.name, s.name as store_name, p.price, s.zip_code
-            FROM products p
+        # Drop the old version of every changed product, then add the current ones back
+        product_ids, canonical_ids, store_ids, prices, names = (
+            self.product_ids, self.canonical_ids, self.store_ids, self.prices, self.names
+        )
+        if product_rows:
+            keep = ~np.isin(product_ids, [row[0] for row in product_rows])
+            current = [row for row in product_rows if row[1] is not None and row[4] is not None]
+            product_ids = np.concatenate([product_ids[keep], np.array([r[0] for r in current], dtype=np.int64)])
+            canonical_ids = np.concatenate([canonical_ids[keep], np.array([r[1] for r in current], dtype=np.int64)])
+            store_ids = np.concatenate([store_ids[keep], np.array([r[2] for r in current], dtype=np.int64)])
+            prices = np.concatenate([prices[keep], np.array([float(r[4]) for r in current])])
+            added_names = np.empty(len(current), dtype=object)
+            added_names[:] = [r[3] for r in current]
+            names = np.concatenate([names[keep], added_names])
+
+            order = np.argsort(canonical_ids, kind="stable")
+            product_ids, canonical_ids, store_ids, prices, names = (
+                product_ids[order], canonical_ids[order], store_ids[order], prices[order], names[order]
+            )
+
+        return PriceSnapshot(product_ids, canonical_ids, store_ids, prices, names,
+                             stores, canonical_id_of, watermark, self.built_at)
+
+    def _positions(self, canonical_name, store_ids=None):
+        canonical_id = self.canonical_id_of.get(canonical_name)
+        if canonical_id is None:
+            return np.empty(0, dtype=np.int64)
+        start = np.searchsorted(self.canonical_ids, canonical_id, side="left")
+        end = np.searchsorted(self.canonical_ids, canonical_id, side="right")
+        positions = np.arange(start, end)
+        if store_ids is not None:
+            positions = positions[np.isin(self.store_ids[positions], list(store_ids))]
+        return positions
+
+    def compare_rows(self, canonical_names):
+        """(canonical name, store_id, product name, store name, price, lat, lng) rows
+        for `canonical_names`, ordered by product name and price like the SQL."""
+        rows = []
+        for canonical in canonical_names:
+            for i in self._positions(canonical):
+                store_name, _, lat, lng = self.stores[self.store_ids[i]]
+                rows.append((canonical, int(self.store_ids[i]), self.names[i], store_name,
+                             float(self.prices[i]), lat, lng))
+        rows.sort(key=lambda row: (row[2], row[4]))
+        return rows
+
+    def price_rows(self, aliases, alias_index, store_ids=None):
+        """(store_id, product name, price, store name, zip_code, lat, lng, alias) rows
+        for every product that `aliases` refer to (through `alias_index`), optionally
+        only at `store_ids`."""
+        rows = []
+        for alias in aliases:
+            for i in self._positions(alias_index.get(alias, alias), store_ids):
+                store_name, zip_code, lat, lng = self.stores[self.store_ids[i]]
+                rows.append((int(self.store_ids[i]), self.names[i], float(self.prices[i]),
+                             store_name, zip_code, lat, lng, alias))
+        return rows
+
+
+_price_snapshot = None
+_price_snapshot_lock = threading.Lock()
+
+
+def get_price_snapshot(conn, max_age=None):
+    """This worker's price snapshot, refreshed first if it is older than
+    `max_age` (default PRICE_SNAPSHOT_MAX_AGE; 0 means it has to be refreshed
+    after this call started); None when the snapshot is off or can't be refreshed."""
+    global _price_snapshot
+
+    if PRICE_SNAPSHOT_MAX_AGE <= 0:
+        return None
+    # refreshed_at is when a refresh started, so it never overstates how new the prices are
+    newer_than = time.time() - (PRICE_SNAPSHOT_MAX_AGE if max_age is None else max_age)
+    snapshot = _price_snapshot
+    if snapshot is not None and snapshot.refreshed_at >= newer_than:
+        return snapshot
+
+    with _price_snapshot_lock:
+        snapshot = _price_snapshot
+        if snapshot is not None and snapshot.refreshed_at >= newer_than:
+            return snapshot
+        refresh_started = time.time()
+        try:
+            with timed("price_snapshot"):
+                if snapshot is None or time.time() - snapshot.built_at > PRICE_SNAPSHOT_REBUILD_INTERVAL:
+                    snapshot = PriceSnapshot.load(conn)
+                    log.info("Loaded %d prices into the price snapshot", len(snapshot.product_ids))
+                else:
+                    snapshot = snapshot.refresh(conn)
+        except psycopg2.Error as e:
+            conn.rollback()
+            log.warning("Could not refresh the price snapshot: %s", e)
+            return None
+        snapshot.refreshed_at = refresh_started
+        _price_snapshot = snapshot
+        return snapshot
+
+
+def invalidate_price_snapshot(rebuild=False):
+    """Make the next read refresh the snapshot (call after prices or stores change);
+    rebuild=True reloads it from scratch, which also picks up deleted rows."""
+    global _price_snapshot
+    with _price_snapshot_lock:
+        if rebuild:
+            _price_snapshot = None
+        elif _price_snapshot is not None:
+            _price_snapshot.refreshed_at = 0.0
+
+
+# compare-prices results are cached per (canonical item set, ZIP) and tagged
+# with each canonical product name asked for, found or not, so any price
+# upload for one of those products drops them (even at a store the cached
+# result never mentioned, or for a product it didn't find yet). Set
+# COMPARE_CACHE_PATH to share the cache between all workers on the host; a
+# shared entry is then only ever filled from a just-refreshed price snapshot,
+# since this worker's could predate the upload that dropped the entry.
+COMPARE_CACHE_TTL = int(os.getenv("COMPARE_CACHE_TTL", "300"))
+COMPARE_CACHE_SIZE = int(os.getenv("COMPARE_CACHE_SIZE", "1024"))
+COMPARE_CACHE_PATH = os.getenv("COMPARE_CACHE_PATH")
+
+compare_cache = make_cache("compare_prices", COMPARE_CACHE_SIZE, COMPARE_CACHE_TTL, COMPARE_CACHE_PATH)
+
+
+def _compare_canonical_prices(conn, canonical_names, user_coords, snapshot_max_age=None):
+    """Price comparison per canonical product: {canonical name: comparison}."""
+    log.debug("Comparing prices for %s", canonical_names)
+    snapshot = get_price_snapshot(conn, snapshot_max_age)
+    if snapshot is not None:
+        data = snapshot.compare_rows(canonical_names)
+    else:
+        cur = conn.cursor()
+        query = """
+            SELECT c.name, p.store_id, p.name, s.name as store_name, p.price, s.latitude, s.longitude
+            FROM canonical_products c
+            JOIN products p ON p.canonical_id = c.id
             JOIN stores s ON p.store_id = s.id
-            WHERE LOWER(p.name) IN ({items_placeholder})
+            WHERE c.name = ANY(%s)
             ORDER BY p.name, p.price ASC
         """
+        cur.execute(query, (canonical_names,))
+        data = cur.fetchall()
+        cur.close()
+    log.debug("Found %d prices", len(data))
+
+    # Distance to the store of every row in one call (None where unknown)
+    row_distances = [None] * len(data)
+    if user_coords and data:
+        distances = np.round(calculate_distances(
+            user_coords["lat"], user_coords["lng"],
+            [row[5] for row in data], [row[6] for row in data]
+        ), 2)
+        row_distances = [None if np.isnan(d) else float(d) for d in distances]
+
+    # Find the price range for each product
+    comparisons = {}
+    for (canonical, _, product_name, store_name, price, _, _), store_distance in zip(data, row_distances):
+        if canonical not in comparisons:
+            comparisons[canonical] = {
+                "bestStore": store_name,
+                "bestPrice": float(price),  # Convert to float
+                "worstPrice": float(price),  # Convert to float
+                "bestStoreDistance": store_distance,
+                "allPrices": [(store_name, float(price), store_distance)],  # Convert to float
+                "foundAs": product_name  # Track what name the product was found as
+            }
+        else:
+            comparisons[canonical]["allPrices"].append((store_name, float(price), store_distance))
+            if price < comparisons[canonical]["bestPrice"]:
+                comparisons[canonical]["bestPrice"] = float(price)
+                comparisons[canonical]["bestStore"] = store_name
+                comparisons[canonical]["bestStoreDistance"] = store_distance
+            if price > comparisons[canonical]["worstPrice"]:
+                comparisons[canonical]["worstPrice"] = float(price)
 
-        # Convert items to lowercase for case-insensitive comparison
-        query_params = tuple(item.lower() for item in all_item_names)
-        print(f"Executing query with params: {query_params}")  # Debug log
+    return comparisons
 
-        cur.execute(query, query_params)
-        data = cur.fetchall()
-        print(f"Query returned {len(data)} rows")  # Debug log
 
-        cur.close()
-        conn.close()
+@app.route('/api/compare-prices', methods=['POST'])
+def compare_prices():
+    try:
+        data = request.get_json()
 
-        # Process data into best price format with actual savings calculation
-        comparisons = {}
-        total_best_price = 0
+        items = data.get('items', [])
+        user_zip = data.get('userZip')
 
-        # Get user coordinates if ZIP provided
-        user_coords = get_zip_coordinates(user_zip) if user_zip else None
-
-        # First pass to find the price range for each product
-        for product_name, store_name, price, store_zip in data:
-            store_distance = None
-            if user_coords and store_zip:
-                store_coords = get_zip_coordinates(store_zip)
-                if store_coords:
-                    store_distance = calculate_distance(
-                        user_coords["lat"], user_coords["lng"],
-                        store_coords["lat"], store_coords["lng"]
-                    )
+        log.debug("Comparing %d items for ZIP %s", len(items), user_zip)
 
-            # Find the original item name that matches this product
-            original_item = None
-            for item in items:
-                if product_name.lower() in get_product_synonyms(item):
-                    original_item = item
-                    break
+        if not items:
+            return jsonify({"error": "No items provided"}), 400
 
-            if original_item not in comparisons:
-                comparisons[original_item] = {
-                    "bestStore": store_name,
-                    "bestPrice": float(price),  # Convert to float
-                    "worstPrice": float(price),  # Convert to float
-                    "bestStoreDistance": store_distance,
-                    "allPrices": [(store_name, float(price), store_distance)],  # Convert to float
-                    "foundAs": product_name  # Track what name the product was found as
-                }
-            else:
-                comparisons[original_item]["allPrices"].append((store_name, float(price), store_distance))
-                if price < comparisons[original_item]["bestPrice"]:
-                    comparisons[original_item]["bestPrice"] = float(price)
-                    comparisons[original_item]["bestStore"] = store_name
-                    comparisons[original_item]["bestStoreDistance"] = store_distance
-                if price > comparisons[original_item]["worstPrice"]:
-                    comparisons[original_item]["worstPrice"] = float(price)
+        # Requested items (one per distinct spelling) and the canonical product each one means
+        item_canonicals = {}
+        for item in items:
+            item_canonicals.setdefault(item.lower().strip(), (item, canonical_product_name(item)))
+        canonical_names = sorted({canonical for _, canonical in item_canonicals.values()})
+
+        zip_key = _zip_to_int(user_zip) if user_zip else None
+        cache_key = json.dumps([canonical_names, zip_key])
+
+        comparisons = compare_cache.get(cache_key) if COMPARE_CACHE_TTL > 0 else None
+        cache_status = "HIT" if comparisons is not None else "MISS"
+
+        if comparisons is None:
+            conn = get_db_connection()
+            if not conn:
+                return jsonify({"error": "Database connection failed"}), 500
+
+            # Get user coordinates if ZIP provided
+            user_coords = get_zip_coordinates(user_zip) if user_zip else None
+
+            shared = COMPARE_CACHE_TTL > 0 and COMPARE_CACHE_PATH
+            comparisons = _compare_canonical_prices(conn, canonical_names, user_coords, 0 if shared else None)
+            if COMPARE_CACHE_TTL > 0:
+                compare_cache.set(cache_key, comparisons, tags=canonical_names)
 
         # Calculate savings and format response
         result = []
-        for item, data in comparisons.items():
+        total_best_price = 0
+        for item, canonical in item_canonicals.values():
+            data = comparisons.get(canonical)
+            if data is None:
+                continue
             savings = data["worstPrice"] - data["bestPrice"]
             total_best_price += data["bestPrice"]
 
@@ -498,310 +2072,715 @@ def compare_prices():
             "items": result,
             "totalBestPrice": round(total_best_price, 2)
         }
-        print("Sending response:", response_data)  # Debug log
-        return jsonify(response_data)
+        log.debug("compare-prices %s: %d of %d items found", cache_status, len(result), len(item_canonicals))
+        response = jsonify(response_data)
+        response.headers["X-Cache"] = cache_status
+        return response
 
     except Exception as e:
-        print(f"Error in compare_prices: {str(e)}")
-        print("Traceback:", traceback.format_exc())
+        log.exception("Error in compare_prices: %s", e)
         return jsonify({"error": str(e)}), 500
 
 
-def optimize_shopping_stops(items, user_zip):
-    try:
-        print(f"Optimizing shopping stops for items: {items}")
-        print(f"User ZIP: {user_zip}")
-
-        if not items:
-            return {"error": "No items provided"}, 400
+def fetch_price_matrix(conn, items, store_ids=None):
+    """Prices of `items` at every store (or just `store_ids`) as a PriceMatrix.
 
-        if not user_zip:
-            return {"error": "ZIP code is required for optimization"}, 400
+    Requested items are matched through their aliases' canonical product IDs;
+    returns None when nothing matches.
+    """
+    # One column per distinct requested item, named by its first spelling
+    item_for_alias = {}
+    for item in items:
+        item_for_alias.setdefault(item.lower().strip(), item)
+
+    log.debug("Fetching prices for %d items%s", len(item_for_alias),
+              "" if store_ids is None else f" at {len(store_ids)} stores")
+
+    snapshot = get_price_snapshot(conn)
+    if snapshot is not None:
+        rows = snapshot.price_rows(list(item_for_alias), product_alias_index(conn), store_ids)
+    else:
+        query = """
+            SELECT p.store_id, p.name as product_name, p.price, s.name as store_name,
+                   s.zip_code, s.latitude, s.longitude, a.alias
+            FROM product_aliases a
+            JOIN products p ON p.canonical_id = a.canonical_id
+            JOIN stores s ON p.store_id = s.id
+            WHERE a.alias = ANY(%s)
+        """
+        params = [list(item_for_alias)]
+        if store_ids is not None:
+            query += " AND p.store_id = ANY(%s)"
+            params.append(list(store_ids))
 
-        conn = get_db_connection()
         cursor = conn.cursor()
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+        cursor.close()
+    log.debug("Found %d price entries", len(rows))
 
-        # Get coordinates for user's ZIP code
-        user_coords = get_zip_coordinates(user_zip)
-        if not user_coords:
-            return {"error": "Invalid ZIP code"}, 400
+    if not rows:
+        return None
+    return PriceMatrix.from_rows(
+        [row[:7] + (item_for_alias[row[7]],) for row in rows],
+        list(item_for_alias.values())
+    )
 
-        # Get all possible names for each item including synonyms
-        all_item_names = []
-        for item in items:
-            synonyms = get_product_synonyms(item)
-            all_item_names.extend(synonyms)
-
-        # Get prices for all items at all stores
-        placeholders = ','.join(['%s'] * len(all_item_names))
-        query = f"""
-            SELECT p.store_id, p.name as product_name, p.price, s.name as store_name, s.zip_code
-            FROM products p
-            JOIN stores s ON p.store_id = s.id
-            WHERE LOWER(p.name) IN ({placeholders})
-        """
-        print(f"Executing query: {query}")
-        print(f"With parameters: {[item.lower() for item in all_item_names]}")
 
-        cursor.execute(query, [item.lower() for item in all_item_names])
-        prices = cursor.fetchall()
-        print(f"Found {len(prices)} price entries")
+def optimize_shopping_stops(items, user_zip, radius=None, max_stores=None,
+                            cost_per_mile=None, stop_penalty=None):
+    """Work out which stores to visit for `items`.
 
-        if not prices:
-            return {"error": "No items found in any stores"}, 404
+    radius (miles) and max_stores limit the candidate stores to the ones
+    nearest the user before any prices are fetched. cost_per_mile and
+    stop_penalty weigh travel against item prices in the joint strategy.
+    """
+    try:
+        log.debug("Optimizing shopping stops for %d items near %s", len(items), user_zip)
 
-        # Group prices by store
-        store_prices = {}
-        for price in prices:
-            store_id = price[0]
-            if store_id not in store_prices:
-                store_prices[store_id] = {
-                    'name': price[3],
-                    'zip_code': price[4],
-                    'items': {}
-                }
-            store_prices[store_id]['items'][price[1]] = float(price[2])  # Convert price to float
-
-        print(f"Found {len(store_prices)} stores with items")
-        for store_id, store_data in store_prices.items():
-            print(f"Store {store_data['name']} has {len(store_data['items'])} items")
-
-        # Calculate distances from user's location to each store
-        for store_id, store_data in store_prices.items():
-            store_coords = get_zip_coordinates(store_data['zip_code'])
-            if store_coords:
-                store_data['distance'] = calculate_distance(
-                    user_coords["lat"], user_coords["lng"],
-                    store_coords["lat"], store_coords["lng"]
-                )
-            else:
-                store_data['distance'] = float('inf')
-
-        # Strategy 1: Price-optimized (best price for each item)
-        price_optimized = find_price_optimized_stops(store_prices, items)
-        print("Price optimized result:", price_optimized)
-
-        # Strategy 2: Distance-optimized (closest stores first)
-        distance_optimized = find_distance_optimized_stops(store_prices, items)
-        print("Distance optimized result:", distance_optimized)
-
-        # Strategy 3: Convenience-optimized (minimum stops)
-        convenience_optimized = find_optimal_stops(store_prices, items)
-        print("Convenience optimized result:", convenience_optimized)
-
-        # Format response with all three strategies
-        response = {
-            "price_optimized": {
-                "stores": price_optimized["stores"],
-                "total_cost": float(price_optimized["total_cost"]),  # Ensure it's a number
-                "total_distance": float(price_optimized["total_distance"]),  # Ensure it's a number
-                "item_breakdown": price_optimized["item_breakdown"]
-            },
-            "distance_optimized": {
-                "stores": distance_optimized["stores"],
-                "total_cost": float(distance_optimized["total_cost"]),  # Ensure it's a number
-                "total_distance": float(distance_optimized["total_distance"]),  # Ensure it's a number
-                "item_breakdown": distance_optimized["item_breakdown"]
-            },
-            "convenience_optimized": {
-                "stores": convenience_optimized["stores"],
-                "total_cost": float(convenience_optimized["total_cost"]),  # Ensure it's a number
-                "total_distance": float(convenience_optimized["total_distance"]),  # Ensure it's a number
-                "item_breakdown": convenience_optimized["item_breakdown"]
-            }
-        }
+        if not items:
+            return {"error": "No items provided"}, 400
 
-        print("Final optimization response:", response)
-        return response
+        if not user_zip:
+            return {"error": "ZIP code is required for optimization"}, 400
 
-    except Exception as e:
-        print(f"Error in optimize_shopping_stops: {str(e)}")
-        print("Traceback:", traceback.format_exc())
-        return {"error": str(e)}, 500
-    finally:
-        if 'conn' in locals():
-            conn.close()
+        conn = get_db_connection()
 
+        # Get coordinates for user's ZIP code
+        user_coords = get_zip_coordinates(user_zip)
+        if not user_coords:
+            return {"error": "Invalid ZIP code"}, 400
 
-def find_price_optimized_stops(store_prices, items):
-    """Find the best price for each item, regardless of store."""
-    result = {
-        "stores": [],
-        "total_cost": 0,
-        "total_distance": 0,
-        "item_breakdown": {}
-    }
+        # Prune far-away stores using the spatial index before looking at prices
+        nearby_store_ids = None
+        if radius is not None or max_stores is not None:
+            nearby_store_ids = get_store_index(conn).nearby_store_ids(
+                user_coords["lat"], user_coords["lng"], radius=radius, limit=max_stores
+            )
+            if not nearby_store_ids:
+                return {"error": "No stores found near this ZIP code"}, 404
+
+        # Get prices for all items at all (nearby) stores
+        matrix = fetch_price_matrix(conn, items, nearby_store_ids)
+        if matrix is None:
+            return {"error": "No items found in any stores"}, 404
+        log.debug("Found %d stores with items", len(matrix.store_ids))
 
-    print(f"Finding price-optimized stops for items: {items}")
-    print(f"Available stores: {[store_data['name'] for store_data in store_prices.values()]}")
+        response = solve_shopping_stops(matrix, user_coords, cost_per_mile, stop_penalty)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Optimized stops: %s", {
+                name: {"stores": plan["stores"], "total_cost": plan["total_cost"]}
+                for name, plan in response.items()
+            })
+        return response
 
-    # Find best price for each item
-    for item in items:
-        best_price = float('inf')
-        best_store = None
-        found_as = None
-
-        # Get all possible names for this item
-        item_synonyms = get_product_synonyms(item)
-        print(f"Searching for {item} with synonyms: {item_synonyms}")
-
-        for store_id, store_data in store_prices.items():
-            # Create case-insensitive mapping of items
-            store_items = {k.lower(): (k, v) for k, v in store_data['items'].items()}
-            
-            # Check each synonym
-            for synonym in item_synonyms:
-                if synonym.lower() in store_items:
-                    original_name, price = store_items[synonym.lower()]
-                    if price < best_price:
-                        best_price = price
-                        best_store = store_id
-                        found_as = original_name
-                        print(f"Found {item} as {original_name} at {store_data['name']} for ${price}")
-
-        if best_store is not None:
-            if best_store not in result["stores"]:
-                result["stores"].append(best_store)
-            result["total_cost"] += best_price
-            result["item_breakdown"][item] = {
-                "store": store_prices[best_store]["name"],
-                "price": best_price,
-                "found_as": found_as
-            }
-            print(f"Best price for {item} found at {store_prices[best_store]['name']} for ${best_price}")
+    except Exception as e:
+        log.exception("Error in optimize_shopping_stops: %s", e)
+        return {"error": str(e)}, 500
 
-    # Calculate total distance
-    for store_id in result["stores"]:
-        result["total_distance"] += store_prices[store_id]["distance"]
 
-    print(f"Price-optimized result: {result}")
-    return result
+# Route planning
+#
+# The stores a strategy picks are visited as a round trip from the user's ZIP.
+# Up to ROUTE_EXACT_MAX_STOPS stops the visiting order is solved exactly with
+# Held-Karp (O(2^n n^2), vectorized per subset size); longer trips start from
+# a nearest-neighbour tour improved by 2-opt and or-opt moves until nothing
+# improves or ROUTE_HEURISTIC_BUDGET seconds pass.
+ROUTE_EXACT_MAX_STOPS = int(os.getenv("ROUTE_EXACT_MAX_STOPS", "12"))
+ROUTE_HEURISTIC_BUDGET = float(os.getenv("ROUTE_HEURISTIC_BUDGET", "0.1"))
 
 
-def find_distance_optimized_stops(store_prices, items):
-    """Find stores to visit based on distance, getting items from closest stores first."""
-    result = {
-        "stores": [],
-        "total_cost": 0,
-        "total_distance": 0,
-        "item_breakdown": {}
-    }
+def distance_matrix(lats, lngs):
+    """Pairwise haversine distances in miles between all the given points."""
+    lats = np.asarray(lats, dtype=float)
+    lngs = np.asarray(lngs, dtype=float)
+    return calculate_distances(lats[:, None], lngs[:, None], lats[None, :], lngs[None, :])
 
-    print(f"Finding distance-optimized stops for items: {items}")
 
-    # Sort stores by distance
-    sorted_stores = sorted(
-        store_prices.items(),
-        key=lambda x: x[1]['distance']
-    )
+def _held_karp_tour(matrix):
+    """Shortest round trip from node 0 through every other node (exact)."""
+    n = len(matrix) - 1
+    if n == 0:
+        return []
+    full = 1 << n
+    masks = np.arange(full)
+    popcount = np.zeros(full, dtype=np.int64)
+    for j in range(n):
+        popcount += (masks >> j) & 1
+
+    # dp[mask, j]: shortest path from home through the stops in mask, ending at stop j
+    dp = np.full((full, n), np.inf)
+    parent = np.full((full, n), -1, dtype=np.int64)
+    for j in range(n):
+        dp[1 << j, j] = matrix[0, j + 1]
+
+    for size in range(2, n + 1):
+        layer = masks[popcount == size]
+        for j in range(n):
+            subsets = layer[(layer >> j) & 1 == 1]
+            previous = subsets ^ (1 << j)
+            candidates = dp[previous] + matrix[1:, j + 1]
+            best = np.argmin(candidates, axis=1)
+            dp[subsets, j] = candidates[np.arange(len(subsets)), best]
+            parent[subsets, j] = best
+
+    mask = full - 1
+    j = int(np.argmin(dp[mask] + matrix[1:, 0]))
+    tour = []
+    while j >= 0:
+        tour.append(j + 1)
+        mask, j = mask ^ (1 << j), int(parent[mask, j])
+    return tour[::-1]
+
+
+def _two_opt_pass(matrix, path):
+    """Reverse every segment whose reversal shortens the tour; True if any did."""
+    improved = False
+    for i in range(1, len(path) - 2):
+        for k in range(i + 1, len(path) - 1):
+            a, b, c, d = path[i - 1], path[i], path[k], path[k + 1]
+            if matrix[a, c] + matrix[b, d] < matrix[a, b] + matrix[c, d] - 1e-9:
+                path[i:k + 1] = path[i:k + 1][::-1]
+                improved = True
+    return improved
+
+
+def _or_opt_move(matrix, path):
+    """Move the first run of 1-3 stops that is cheaper elsewhere; True if one moved."""
+    for length in (1, 2, 3):
+        for i in range(1, len(path) - length):
+            segment = path[i:i + length]
+            before, after = path[i - 1], path[i + length]
+            saved = matrix[before, segment[0]] + matrix[segment[-1], after] - matrix[before, after]
+            rest = path[:i] + path[i + length:]
+            for j in range(len(rest) - 1):
+                if j == i - 1:
+                    continue
+                a, b = rest[j], rest[j + 1]
+                for placed in (segment, segment[::-1]):
+                    if matrix[a, placed[0]] + matrix[placed[-1], b] - matrix[a, b] < saved - 1e-9:
+                        path[:] = rest[:j + 1] + placed + rest[j + 1:]
+                        return True
+    return False
+
+
+def _heuristic_tour(matrix, deadline):
+    """Nearest-neighbour round trip from node 0, polished with 2-opt and or-opt."""
+    unvisited = set(range(1, len(matrix)))
+    path = [0]
+    while unvisited:
+        nearest = min(unvisited, key=lambda node: matrix[path[-1], node])
+        path.append(nearest)
+        unvisited.remove(nearest)
+    path.append(0)
+
+    while time.perf_counter() < deadline:
+        if not (_two_opt_pass(matrix, path) | _or_opt_move(matrix, path)):
+            break
+    return path[1:-1]
+
+
+def _solve_tour(matrix):
+    """Visiting order (node numbers) for the round trip from node 0 of `matrix`."""
+    if len(matrix) - 1 <= ROUTE_EXACT_MAX_STOPS:
+        return _held_karp_tour(matrix)
+    return _heuristic_tour(matrix, time.perf_counter() + ROUTE_HEURISTIC_BUDGET)
+
+
+@timed("route")
+def plan_route(lat, lng, lats, lngs):
+    """Order to visit the points (lats[i], lngs[i]) on a round trip from (lat, lng).
+
+    Returns (order, legs, unrouted): indices into lats/lngs in visiting order
+    and the length of every leg, home to first stop through last stop back
+    home. Stops without coordinates can't be routed; their indices are
+    returned in `unrouted` instead.
+    """
+    lats = np.asarray(lats, dtype=float)
+    lngs = np.asarray(lngs, dtype=float)
+    known = np.flatnonzero(~(np.isnan(lats) | np.isnan(lngs)))
+    unknown = np.flatnonzero(np.isnan(lats) | np.isnan(lngs))
+
+    matrix = distance_matrix(np.append(lat, lats[known]), np.append(lng, lngs[known]))
+    tour = _solve_tour(matrix)
+
+    path = [0, *tour, 0]
+    legs = [round(float(matrix[a, b]), 2) for a, b in zip(path, path[1:])] if tour else []
+    order = [int(known[node - 1]) for node in tour]
+    return order, legs, [int(i) for i in unknown]
+
+
+class PriceMatrix:
+    """Prices of the requested items at each store.
+
+    `prices` is a (stores x items) float array with NaN where a store doesn't
+    carry the item, and `found_as` holds the product name each price was found
+    as. Store metadata are parallel arrays, so the strategies below work on
+    store positions (rows) and only turn them into IDs and names at the end.
+    """
+
+    def __init__(self, store_ids, names, zip_codes, lats, lngs, items, prices, found_as):
+        self.store_ids = store_ids
+        self.names = names
+        self.zip_codes = zip_codes
+        self.lats = np.asarray(lats, dtype=float)
+        self.lngs = np.asarray(lngs, dtype=float)
+        self.items = items
+        self.prices = prices
+        self.found_as = found_as
+
+    @classmethod
+    def from_rows(cls, rows, items):
+        """Build from (store_id, product_name, price, store_name, zip_code, lat, lng, item)
+        rows, keeping the cheapest match per store and item."""
+        stores = {}
+        for row in rows:
+            stores.setdefault(row[0], row)
+        row_of = {store_id: i for i, store_id in enumerate(stores)}
+        column_of = {item: j for j, item in enumerate(items)}
+
+        prices = np.full((len(stores), len(items)), np.nan)
+        found_as = np.empty(prices.shape, dtype=object)
+        for store_id, product_name, price, *_, item in rows:
+            i, j = row_of[store_id], column_of[item]
+            price = float(price)
+            if not price >= prices[i, j]:  # also true while the cell is NaN
+                prices[i, j] = price
+                found_as[i, j] = product_name
+
+        first = list(stores.values())
+        return cls(
+            list(stores), [row[3] for row in first], [row[4] for row in first],
+            [row[5] for row in first], [row[6] for row in first],
+            list(items), prices, found_as
+        )
 
-    remaining_items = set(items)
-    print(f"Remaining items: {remaining_items}")
+    def select_items(self, items, store_ids=None, labels=None):
+        """The sub-matrix for `items` (a subset of self.items), optionally only at
+        `store_ids`, without stores that carry none of them. `labels` renames
+        the item columns."""
+        columns = [self.items.index(item) for item in items]
+        prices = self.prices[:, columns]
+        keep = ~np.isnan(prices).all(axis=1)
+        if store_ids is not None:
+            keep &= np.isin(self.store_ids, list(store_ids))
+        rows = np.flatnonzero(keep)
+        return PriceMatrix(
+            [self.store_ids[i] for i in rows], [self.names[i] for i in rows],
+            [self.zip_codes[i] for i in rows], self.lats[rows], self.lngs[rows],
+            list(labels or items), prices[rows], self.found_as[np.ix_(rows, columns)]
+        )
 
-    # Try to get items from closest stores first
-    for store_id, store_data in sorted_stores:
-        if not remaining_items:
-            break
+    def distances_from(self, lat, lng):
+        """Miles from (lat, lng) to every store, inf where a store has no coordinates."""
+        distances = np.round(calculate_distances(lat, lng, self.lats, self.lngs), 2)
+        return np.where(np.isnan(distances), np.inf, distances)
+
+    def plan(self, positions, user_coords):
+        """Strategy result for visiting the stores at `positions`: each item is
+        bought at the cheapest of them and the stores are put in round-trip order."""
+        result = {
+            "stores": [],
+            "total_cost": 0,
+            "total_distance": 0,
+            "item_breakdown": {},
+            "route": {"legs": [], "unrouted": []}
+        }
+        positions = list(positions)
+        if not positions:
+            return result
+
+        candidate_prices = np.where(np.isnan(self.prices[positions]), np.inf, self.prices[positions])
+        cheapest = np.argmin(candidate_prices, axis=0)
+        used = []
+        for column in np.flatnonzero(np.isfinite(candidate_prices.min(axis=0))):
+            row = positions[cheapest[column]]
+            if row not in used:
+                used.append(row)
+            price = float(self.prices[row, column])
+            result["total_cost"] += price
+            result["item_breakdown"][self.items[column]] = {
+                "store": self.names[row],
+                "price": price,
+                "found_as": self.found_as[row, column]
+            }
 
-        # Create case-insensitive mapping of items
-        store_items = {k.lower(): (k, v) for k, v in store_data['items'].items()}
-        
-        # Check each remaining item and its synonyms
-        found_items = set()
-        for item in list(remaining_items):
-            item_synonyms = get_product_synonyms(item)
-            for synonym in item_synonyms:
-                if synonym.lower() in store_items:
-                    original_name, price = store_items[synonym.lower()]
-                    found_items.add(item)
-                    if item not in result["item_breakdown"]:
-                        result["item_breakdown"][item] = {
-                            "store": store_data["name"],
-                            "price": price,
-                            "found_as": original_name
-                        }
-                    result["total_cost"] += price
-                    print(f"Found {item} as {original_name} at {store_data['name']} for ${price}")
-                    break
+        # Stores without coordinates are still listed, after the routed ones
+        order, legs, unrouted = plan_route(user_coords["lat"], user_coords["lng"], self.lats[used], self.lngs[used])
+        result["stores"] = [self.store_ids[used[i]] for i in order + unrouted]
+        result["total_distance"] = round(sum(legs), 2)
+        result["route"] = {"legs": legs, "unrouted": [self.store_ids[used[i]] for i in unrouted]}
+        return result
 
-        if found_items:
-            result["stores"].append(store_id)
-            result["total_distance"] += store_data["distance"]
-            remaining_items -= found_items
 
-    print(f"Distance-optimized result: {result}")
-    return result
+# Strategies
+#
+# Each takes a PriceMatrix (plus the stores' distances from the user) and
+# returns the store positions to visit; PriceMatrix.plan turns those into the
+# response.
 
+@timed("solve_price")
+def find_price_optimized_stops(matrix):
+    """Find the best price for each item, regardless of store."""
+    prices = np.where(np.isnan(matrix.prices), np.inf, matrix.prices)
+    stocked = np.isfinite(prices).any(axis=0)
+    return list(dict.fromkeys(np.argmin(prices, axis=0)[stocked].tolist()))
 
-def find_optimal_stops(store_prices, items):
-    """Find the minimum number of stores to visit."""
-    result = {
-        "stores": [],
-        "total_cost": 0,
-        "total_distance": 0,
-        "item_breakdown": {}
-    }
 
-    print(f"Finding convenience-optimized stops for items: {items}")
+@timed("solve_distance")
+def find_distance_optimized_stops(matrix, distances):
+    """Find stores to visit based on distance, getting items from closest stores first."""
+    order = np.argsort(distances, kind="stable")
+    available = ~np.isnan(matrix.prices[order])
+    stocked = available.any(axis=0)
+    # Nearest store carrying each item, then those stores nearest first
+    return order[np.unique(np.argmax(available, axis=0)[stocked])].tolist()
+
+
+# Time budget (seconds) for the exact minimum-stop search before it falls back to greedy
+CONVENIENCE_SOLVER_BUDGET = float(os.getenv("CONVENIENCE_SOLVER_BUDGET", "0.2"))
+
+
+def _greedy_min_stops(available, distances):
+    """Greedy set cover: repeatedly take the store covering the most remaining items."""
+    remaining = available.any(axis=0)
+    chosen = []
+    while remaining.any():
+        coverage = (available & remaining).sum(axis=1)
+        pos = int(np.lexsort((distances, -coverage))[0])
+        chosen.append(pos)
+        remaining &= ~available[pos]
+    return chosen
+
+
+def _exact_min_stops(masks, prices, distances, full, max_stops, deadline):
+    """Fewest stores whose item bitmasks cover `full`, ties broken on total cost
+    then total distance.
+
+    Iterative deepening on the number of stops; at each depth it branches on
+    the stores that carry the lowest uncovered item. Raises TimeoutError once
+    `deadline` (perf_counter) passes.
+    """
+    max_cover = max(bin(mask).count("1") for mask in masks)
+    stores_with_item = {}
+    for bit in range(full.bit_length()):
+        stores_with_item[bit] = sorted(
+            (s for s, mask in enumerate(masks) if mask >> bit & 1),
+            key=lambda s: -bin(masks[s]).count("1")
+        )
 
-    # First, find stores that have the most items
-    store_coverage = {}
-    for store_id, store_data in store_prices.items():
-        # Create case-insensitive mapping of items
-        store_items = {k.lower(): (k, v) for k, v in store_data['items'].items()}
-        coverage = 0
-        for item in items:
-            item_synonyms = get_product_synonyms(item)
-            if any(synonym.lower() in store_items for synonym in item_synonyms):
-                coverage += 1
-        if coverage > 0:
-            store_coverage[store_id] = coverage
-
-    print(f"Store coverage: {store_coverage}")
-
-    # Sort stores by coverage (descending) and then by distance
-    sorted_stores = sorted(
-        store_coverage.items(),
-        key=lambda x: (-x[1], store_prices[x[0]]['distance'])
-    )
+    best = None
+    seen = set()
+    nodes = 0
+
+    def search(chosen, covered, depth):
+        nonlocal best, nodes
+        nodes += 1
+        if nodes % 1024 == 0 and time.perf_counter() > deadline:
+            raise TimeoutError
+        if covered == full:
+            key = frozenset(chosen)
+            if key in seen:
+                return
+            seen.add(key)
+            cost = round(float(prices[chosen].min(axis=0).sum()), 2)
+            distance = float(distances[chosen].sum())
+            if best is None or (cost, distance) < best[:2]:
+                best = (cost, distance, list(chosen))
+            return
+        uncovered = full & ~covered
+        if len(chosen) + -(-bin(uncovered).count("1") // max_cover) > depth:
+            return
+        bit = (uncovered & -uncovered).bit_length() - 1
+        for s in stores_with_item[bit]:
+            chosen.append(s)
+            search(chosen, covered | masks[s], depth)
+            chosen.pop()
+
+    lower_bound = -(-bin(full).count("1") // max_cover)
+    for depth in range(lower_bound, max_stops + 1):
+        search([], 0, depth)
+        if best is not None:
+            return best[2]
+    return None
+
+
+@timed("solve_convenience")
+def find_optimal_stops(matrix, distances):
+    """Find the minimum number of stores to visit.
+
+    Solved exactly as a set cover over item bitmasks (ties go to the cheaper,
+    then shorter, plan); falls back to the greedy cover when the search runs
+    past CONVENIENCE_SOLVER_BUDGET.
+    """
+    available = ~np.isnan(matrix.prices)
+    available = available[:, available.any(axis=0)]
+    if not available.size:
+        return []
 
-    remaining_items = set(items)
-    print(f"Remaining items: {remaining_items}")
+    masks = [sum(1 << int(bit) for bit in np.flatnonzero(row)) for row in available]
+    prices = np.where(available, matrix.prices[:, ~np.isnan(matrix.prices).all(axis=0)], np.inf)
+    full = (1 << available.shape[1]) - 1
 
-    # Try to get items from stores with the most coverage first
-    for store_id, _ in sorted_stores:
-        if not remaining_items:
+    greedy = _greedy_min_stops(available, distances)
+    try:
+        deadline = time.perf_counter() + CONVENIENCE_SOLVER_BUDGET
+        return _exact_min_stops(masks, prices, distances, full, len(greedy), deadline)
+    except TimeoutError:
+        log.info("Exact stop search exceeded %ss, using greedy cover", CONVENIENCE_SOLVER_BUDGET)
+        return greedy
+
+
+# Joint strategy weights: dollars per mile driven and per extra stop, overridable per request
+JOINT_COST_PER_MILE = float(os.getenv("JOINT_COST_PER_MILE", "0.5"))
+JOINT_STOP_PENALTY = float(os.getenv("JOINT_STOP_PENALTY", "1.0"))
+JOINT_SOLVER_BUDGET = float(os.getenv("JOINT_SOLVER_BUDGET", "0.3"))
+
+
+@timed("solve_joint")
+def find_joint_optimized_stops(matrix, distances, user_coords,
+                               cost_per_mile=JOINT_COST_PER_MILE, stop_penalty=JOINT_STOP_PENALTY,
+                               seeds=()):
+    """Stores minimizing item cost + cost_per_mile * round trip + stop_penalty * stops.
+
+    The best of `seeds` (store positions from the other strategies), the
+    cheapest store per item and a greedy build, improved by local search
+    (adding, dropping and swapping stores), is the plan to beat. Stores that
+    can't be part of a better plan are dropped (see below), then branch and
+    bound over subsets of the rest, nearest stores first, proves the plan
+    optimal or improves on it until JOINT_SOLVER_BUDGET runs out. A node's
+    bound is the cheapest price still reachable for every item, plus the
+    longest home -> store -> store -> home triangle among the chosen stores
+    (no round trip through them is shorter) or the round trip to the nearest
+    store carrying an uncovered item, plus a stop per chosen store and one
+    more if items are still uncovered. A store is only added if it lowers
+    some item's price. Stores without coordinates are left out since their
+    travel can't be priced.
+    """
+    deadline = time.perf_counter() + JOINT_SOLVER_BUDGET
+    build_deadline = deadline - JOINT_SOLVER_BUDGET / 2  # at least half the budget is left for the search
+    carried = ~np.isnan(matrix.prices)
+    stocked = np.flatnonzero(np.isfinite(distances) & carried.any(axis=1))
+    if not len(stocked):
+        return []
+    stocked = stocked[np.argsort(distances[stocked], kind="stable")]
+
+    # Per-store price vectors over the items these stores can cover (inf where missing)
+    covered = carried[stocked].any(axis=0)
+    prices = np.where(carried[np.ix_(stocked, covered)], matrix.prices[np.ix_(stocked, covered)], np.inf)
+    cheapest = prices.min(axis=0)
+    home_distance = distances[stocked]
+    lats = np.append(user_coords["lat"], matrix.lats[stocked])  # node 0 is home, node k + 1 is store k
+    lngs = np.append(user_coords["lng"], matrix.lngs[stocked])
+
+    routes = {}
+
+    def route_length(chosen):
+        key = frozenset(chosen)
+        if key not in routes:
+            if len(chosen) <= 2:
+                between = calculate_distances(lats[chosen[0] + 1], lngs[chosen[0] + 1],
+                                              lats[chosen[-1] + 1], lngs[chosen[-1] + 1])
+                routes[key] = home_distance[chosen[0]] + float(between) + home_distance[chosen[-1]]
+            else:
+                nodes = [0] + [k + 1 for k in chosen]
+                sub = distance_matrix(lats[nodes], lngs[nodes])
+                path = [0, *_solve_tour(sub), 0]
+                routes[key] = float(sub[path[:-1], path[1:]].sum())
+        return routes[key]
+
+    best = [np.inf, None]
+
+    def consider(chosen, chosen_prices):
+        travel = route_length(chosen)
+        value = chosen_prices.sum() + cost_per_mile * travel + stop_penalty * len(chosen)
+        if value < best[0]:
+            best[0], best[1] = value, sorted(chosen)
+        return travel
+
+    def reachable(stores):
+        """The stores that could be in a plan better than the best one.
+
+        Such a store buys at least one item, so the plan costs at least the
+        cheapest basket, plus what that store charges over the cheapest price
+        for the item, a round trip to it and a stop.
+        """
+        slack = best[0] - cheapest.sum() - stop_penalty - cost_per_mile * 2 * home_distance[stores]
+        useful = ((prices[stores] - cheapest) < slack[:, None]).any(axis=1)
+        return np.union1d(stores[useful], best[1] or [])
+
+    index_of = {int(pos): k for k, pos in enumerate(stocked)}
+    starts = [sorted({index_of[pos] for pos in seed if pos in index_of}) for seed in seeds]
+    starts.append(sorted(set(np.argmin(prices, axis=0).tolist())))  # cheapest store per item
+    for chosen in starts:
+        if chosen and np.isfinite(prices[chosen].min(axis=0)).all():
+            consider(chosen, prices[chosen].min(axis=0))
+    active = reachable(np.arange(len(stocked)))
+
+    def extensions(base, base_prices, outside):
+        """Item cost (prices + stops) and a travel lower bound of `base` plus each store in `outside`."""
+        item_cost = np.minimum(base_prices, prices[outside]).sum(axis=1) + stop_penalty * (len(base) + 1)
+        travel = 2 * np.maximum(home_distance[base].max(initial=0), home_distance[outside])
+        return item_cost, travel
+
+    # Greedy build: add whichever store lowers the cost most, pricing an item
+    # nobody chosen carries yet as a separate trip to its nearest store
+    nearest_carrier = np.where(np.isfinite(prices[active]), home_distance[active][:, None], np.inf).min(axis=0)
+    separate_trip = cheapest + cost_per_mile * 2 * nearest_carrier + stop_penalty
+    greedy, greedy_prices, greedy_value = [], np.full(prices.shape[1], np.inf), separate_trip.sum()
+    while time.perf_counter() < build_deadline:
+        outside = np.setdiff1d(active, greedy)
+        if not len(outside):
+            break
+        item_cost, travel = extensions(greedy, np.minimum(greedy_prices, separate_trip), outside)
+        lower = item_cost + cost_per_mile * travel
+        step = (np.inf, None)
+        for i in np.argsort(lower, kind="stable"):
+            if lower[i] >= step[0] or (step[1] is not None and time.perf_counter() > build_deadline):
+                break
+            chosen = greedy + [int(outside[i])]
+            step = min(step, (item_cost[i] + cost_per_mile * route_length(chosen), chosen), key=lambda s: s[0])
+        if np.isfinite(greedy_prices).all() and step[0] >= greedy_value:
+            break
+        greedy_value, greedy = step
+        greedy_prices = prices[greedy].min(axis=0)
+    if greedy and np.isfinite(greedy_prices).all():
+        consider(greedy, greedy_prices)
+
+    # Local search: apply add, drop and swap moves (the best-looking first)
+    # until none of them beats the best plan
+    improved = True
+    while improved and time.perf_counter() < build_deadline:
+        improved, current = False, best[1]
+        moves = []
+        outside = np.setdiff1d(active, current)
+        for base in [current] + [[c for c in current if c != k] for k in current]:
+            base_prices = prices[base].min(axis=0) if base else np.full(prices.shape[1], np.inf)
+            if len(base) < len(current) and base:
+                moves.append((base_prices.sum() + stop_penalty * len(base)
+                              + cost_per_mile * 2 * home_distance[base].max(), base))
+            item_cost, travel = extensions(base, base_prices, outside)
+            lower = item_cost + cost_per_mile * travel
+            moves += [(lower[i], base + [int(outside[i])]) for i in np.flatnonzero(lower < best[0])]
+        moves.sort(key=lambda move: move[0])
+        for lower, move in moves:
+            if lower >= best[0] - 1e-9 or time.perf_counter() > build_deadline:
+                break
+            move_prices = prices[move].min(axis=0)
+            if np.isfinite(move_prices).all():
+                value = best[0]
+                consider(move, move_prices)
+                improved |= best[0] < value
+
+    # Branch and bound over the stores still worth searching after the better
+    # incumbent, nearest first, minus those another store at the same spot
+    # (stores are often geocoded to their ZIP's centroid) dominates by being
+    # no dearer on any item: swapping it in never makes a plan worse
+    active = np.intersect1d(active, reachable(active))
+    _, spot = np.unique(np.column_stack([lats[active + 1], lngs[active + 1]]), axis=0, return_inverse=True)
+    spot = spot.ravel()
+    dominated = np.zeros(len(active), dtype=bool)
+    for same in np.split(np.argsort(spot, kind="stable"), np.flatnonzero(np.diff(np.sort(spot))) + 1):
+        if len(same) == 1:
+            continue
+        for s in same:
+            others = same[(same != s) & ~dominated[same]]
+            if active[s] not in best[1]:
+                dominated[s] = (prices[active[others]] <= prices[active[s]]).all(axis=1).any()
+    active = active[~dominated]
+    n = len(active)
+    search_prices, search_home = prices[active], home_distance[active]
+    search_lats, search_lngs = lats[active + 1], lngs[active + 1]
+
+    # cheapest_from[k]: best price per item among stores k.. (row n is all inf);
+    # nearest_from[k]: home distance of the nearest store k.. carrying each item
+    cheapest_from = np.vstack([
+        np.minimum.accumulate(search_prices[::-1], axis=0)[::-1], np.full(prices.shape[1], np.inf)
+    ])
+    nearest_from = np.vstack([
+        np.minimum.accumulate(np.where(np.isfinite(search_prices), search_home[:, None], np.inf)[::-1], axis=0)[::-1],
+        np.full(prices.shape[1], np.inf)
+    ])
+
+    def bound(k, chosen, chosen_prices, travel):
+        """Lower bound for every plan extending `chosen` with stores k.."""
+        uncovered = ~np.isfinite(chosen_prices)
+        if uncovered.any():
+            travel = max(travel, 2 * nearest_from[k][uncovered].max())
+        return (np.minimum(chosen_prices, cheapest_from[k]).sum()
+                + cost_per_mile * travel + stop_penalty * (len(chosen) + uncovered.any()))
+
+    # Depth-first with an explicit stack (the depth is the number of stores):
+    # (bound, k, chosen, chosen_prices, travel_bound), including store k is explored first
+    stack = [(-np.inf, 0, [], np.full(prices.shape[1], np.inf), 0.0)]
+    visited = 0
+    while stack:
+        node_bound, k, chosen, chosen_prices, travel_bound = stack.pop()
+        if node_bound >= best[0] or k == n:
+            continue
+        visited += 1
+        if visited % 16 == 0 and time.perf_counter() > deadline:
+            log.info("Joint stop search exceeded %ss, using best plan found", JOINT_SOLVER_BUDGET)
             break
 
-        store_data = store_prices[store_id]
-        # Create case-insensitive mapping of items
-        store_items = {k.lower(): (k, v) for k, v in store_data['items'].items()}
-        
-        # Check each remaining item and its synonyms
-        found_items = set()
-        for item in list(remaining_items):
-            item_synonyms = get_product_synonyms(item)
-            for synonym in item_synonyms:
-                if synonym.lower() in store_items:
-                    original_name, price = store_items[synonym.lower()]
-                    found_items.add(item)
-                    if item not in result["item_breakdown"]:
-                        result["item_breakdown"][item] = {
-                            "store": store_data["name"],
-                            "price": price,
-                            "found_as": original_name
-                        }
-                    result["total_cost"] += price
-                    print(f"Found {item} as {original_name} at {store_data['name']} for ${price}")
-                    break
-
-        if found_items:
-            result["stores"].append(store_id)
-            result["total_distance"] += store_data["distance"]
-            remaining_items -= found_items
+        # Skip store k
+        skip_bound = bound(k + 1, chosen, chosen_prices, travel_bound)
+        if skip_bound < best[0]:
+            stack.append((skip_bound, k + 1, chosen, chosen_prices, travel_bound))
+
+        # Include store k, if it beats the chosen stores on any item
+        with_k = np.minimum(chosen_prices, search_prices[k])
+        if (with_k < chosen_prices).any():
+            included = chosen + [k]
+            triangles = search_home[k] + search_home[included] + calculate_distances(
+                search_lats[k], search_lngs[k], search_lats[included], search_lngs[included]
+            )
+            included_travel = max(travel_bound, float(triangles.max()))
+            include_bound = bound(k + 1, included, with_k, included_travel)
+            if include_bound < best[0]:
+                if np.isfinite(with_k).all():
+                    travel = consider([int(active[c]) for c in included], with_k)
+                    included_travel = max(included_travel, travel)
+                    include_bound = bound(k + 1, included, with_k, included_travel)
+                stack.append((include_bound, k + 1, included, with_k, included_travel))
+
+    return [int(stocked[k]) for k in best[1]]
+
+
+def solve_shopping_stops(matrix, user_coords, cost_per_mile=None, stop_penalty=None):
+    """Run every strategy on `matrix` for a user at `user_coords`; the optimize-stops response."""
+    if cost_per_mile is None:
+        cost_per_mile = JOINT_COST_PER_MILE
+    if stop_penalty is None:
+        stop_penalty = JOINT_STOP_PENALTY
+
+    # Calculate distances from user's location to each store
+    distances = matrix.distances_from(user_coords["lat"], user_coords["lng"])
+
+    # Strategy 1: Price-optimized (best price for each item)
+    price_stops = find_price_optimized_stops(matrix)
+    # Strategy 2: Distance-optimized (closest stores first)
+    distance_stops = find_distance_optimized_stops(matrix, distances)
+    # Strategy 3: Convenience-optimized (minimum stops)
+    convenience_stops = find_optimal_stops(matrix, distances)
+    # Strategy 4: Joint (item cost + travel cost + a penalty per stop)
+    joint_stops = find_joint_optimized_stops(
+        matrix, distances, user_coords, cost_per_mile=cost_per_mile, stop_penalty=stop_penalty,
+        seeds=[price_stops, distance_stops, convenience_stops]
+    )
 
-    print(f"Convenience-optimized result: {result}")
-    return result
+    # Each strategy's stores in the shortest round-trip order
+    response = {
+        "price_optimized": matrix.plan(price_stops, user_coords),
+        "distance_optimized": matrix.plan(distance_stops, user_coords),
+        "convenience_optimized": matrix.plan(convenience_stops, user_coords),
+        "joint_optimized": matrix.plan(joint_stops, user_coords)
+    }
+    joint = response["joint_optimized"]
+    joint["objective"] = round(
+        joint["total_cost"] + cost_per_mile * joint["total_distance"] + stop_penalty * len(joint["stores"]), 2
+    )
+    return response
 
 
 @app.route('/api/optimize-stops', methods=['POST'])
@@ -810,26 +2789,357 @@ def optimize_stops():
     items = data.get('items', [])
     user_zip = data.get('userZip')
 
-    result = optimize_shopping_stops(items, user_zip)
+    try:
+        radius = _parse_positive_arg(data.get('radius'), float)
+        max_stores = _parse_positive_arg(data.get('maxStores'), int)
+        cost_per_mile = _parse_positive_arg(data.get('costPerMile'), float)
+        stop_penalty = _parse_positive_arg(data.get('stopPenalty'), float)
+    except (TypeError, ValueError):
+        return jsonify({"error": "radius, maxStores, costPerMile and stopPenalty must be positive numbers"}), 400
+
+    result = optimize_shopping_stops(
+        items, user_zip, radius=radius, max_stores=max_stores,
+        cost_per_mile=cost_per_mile, stop_penalty=stop_penalty
+    )
     if isinstance(result, tuple):
         return jsonify(result[0]), result[1]
     return jsonify(result)
 
 
-@app.route('/api/recipe-search', methods=['POST'])
-def recipe_search():
+# Batch optimization
+#
+# Nightly jobs score thousands of saved lists at once. The baskets share one
+# price query over the union of their items (and nearby stores), ZIPs are
+# geocoded once each, and the per-basket solves are spread over a process
+# pool. Results come back in input order as each one is ready.
+#
+# The pool is shared by every request in the worker process, so BATCH_WORKERS
+# caps the solver processes however many batches run at once. It is started
+# on first use with forkserver (spawn where that's unavailable), never fork:
+# a forked child could inherit a lock held by another request thread. Solver
+# timings recorded in the pool are sent back and added to /metrics.
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "0")) or os.cpu_count()
+BATCH_PARALLEL_MIN = int(os.getenv("BATCH_PARALLEL_MIN", "8"))  # smaller batches are solved inline
+BATCH_START_METHOD = os.getenv(
+    "BATCH_START_METHOD", "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+_batch_pool = None
+_batch_pool_pid = None
+_batch_pool_lock = threading.Lock()
+
+
+def _get_batch_pool():
+    """The process-wide solver pool, started on first use (and again in a forked worker)."""
+    global _batch_pool, _batch_pool_pid
+
+    if _batch_pool is not None and _batch_pool_pid == os.getpid():
+        return _batch_pool
+
+    with _batch_pool_lock:
+        if _batch_pool is None or _batch_pool_pid != os.getpid():
+            _batch_pool = ProcessPoolExecutor(
+                BATCH_WORKERS, mp_context=multiprocessing.get_context(BATCH_START_METHOD)
+            )
+            _batch_pool_pid = os.getpid()
+            log.info("Batch solver pool ready (%d %s processes)", BATCH_WORKERS, BATCH_START_METHOD)
+    return _batch_pool
+
+
+def _discard_batch_pool(pool):
+    """Forget a broken pool so the next batch starts a new one."""
+    global _batch_pool
+    with _batch_pool_lock:
+        if _batch_pool is pool:
+            _batch_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _solve_batch_job(job):
+    """Solve one prepared basket."""
+    index, basket_id, matrix, user_coords, cost_per_mile, stop_penalty = job
     try:
-        data = request.get_json()
-        query = data.get('query')
+        result = solve_shopping_stops(matrix, user_coords, cost_per_mile, stop_penalty)
+        return {"index": index, "id": basket_id, "result": result}
+    except Exception as e:
+        return {"index": index, "id": basket_id, "error": str(e), "status": 500}
+
+
+def _solve_pooled_batch_job(job, route):
+    """_solve_batch_job in a pool process, with the phase timings it recorded there."""
+    _request_timing.set((route, None))
+    result = _solve_batch_job(job)
+    return result, phase_duration.drain()
+
+
+def _prepare_batch(conn, baskets, radius, max_stores, cost_per_mile, stop_penalty):
+    """Validate baskets and fetch what they need; a job tuple or an error per basket."""
+    entries = []
+    coords_by_zip = {}
+    nearby_by_zip = {}
+    for index, basket in enumerate(baskets):
+        basket = basket if isinstance(basket, dict) else {}
+        basket_id = basket.get("id")
+        items = basket.get("items") or []
+        user_zip = basket.get("userZip")
+        if not items:
+            entries.append({"index": index, "id": basket_id, "error": "No items provided", "status": 400})
+            continue
+        if not user_zip:
+            entries.append({"index": index, "id": basket_id, "error": "ZIP code is required for optimization", "status": 400})
+            continue
+
+        # Geocode (and prune stores for) each ZIP once
+        if user_zip not in coords_by_zip:
+            coords_by_zip[user_zip] = get_zip_coordinates(user_zip)
+            if coords_by_zip[user_zip] and (radius is not None or max_stores is not None):
+                nearby_by_zip[user_zip] = get_store_index(conn).nearby_store_ids(
+                    coords_by_zip[user_zip]["lat"], coords_by_zip[user_zip]["lng"],
+                    radius=radius, limit=max_stores
+                )
+        if not coords_by_zip[user_zip]:
+            entries.append({"index": index, "id": basket_id, "error": "Invalid ZIP code", "status": 400})
+            continue
+        if nearby_by_zip.get(user_zip) == []:
+            entries.append({"index": index, "id": basket_id, "error": "No stores found near this ZIP code", "status": 404})
+            continue
+        entries.append((index, basket_id, items, user_zip))
+
+    # One price query for every basket's items at every store any basket may visit
+    pending = [entry for entry in entries if isinstance(entry, tuple)]
+    all_items = [item for entry in pending for item in entry[2]]
+    store_ids = None
+    if nearby_by_zip:
+        store_ids = sorted({store_id for ids in nearby_by_zip.values() for store_id in ids})
+    matrix = fetch_price_matrix(conn, all_items, store_ids) if pending else None
+
+    column_for = {}
+    if matrix is not None:
+        column_for = {item.lower().strip(): item for item in matrix.items}
+
+    jobs = []
+    for entry in entries:
+        if not isinstance(entry, tuple):
+            jobs.append(entry)
+            continue
+        index, basket_id, items, user_zip = entry
+        labels = {}
+        for item in items:
+            labels.setdefault(item.lower().strip(), item)
+        basket_matrix = None
+        if matrix is not None:
+            basket_matrix = matrix.select_items(
+                [column_for[key] for key in labels], store_ids=nearby_by_zip.get(user_zip),
+                labels=list(labels.values())
+            )
+        if basket_matrix is None or not basket_matrix.store_ids:
+            jobs.append({"index": index, "id": basket_id, "error": "No items found in any stores", "status": 404})
+            continue
+        jobs.append((index, basket_id, basket_matrix, coords_by_zip[user_zip], cost_per_mile, stop_penalty))
+    return jobs
+
+
+def _solve_batch(jobs, route):
+    """Yield every job's result in input order, solving in the process pool for big batches."""
+    solvable = [job for job in jobs if isinstance(job, tuple)]
+    if len(solvable) < BATCH_PARALLEL_MIN or BATCH_WORKERS <= 1:
+        for job in jobs:
+            yield _solve_batch_job(job) if isinstance(job, tuple) else job
+        return
+
+    pool = _get_batch_pool()
+    chunksize = max(1, len(solvable) // (BATCH_WORKERS * 4))
+    solved = pool.map(_solve_pooled_batch_job, solvable, [route] * len(solvable), chunksize=chunksize)
+    try:
+        for job in jobs:
+            if not isinstance(job, tuple):
+                yield job
+                continue
+            result, timings = next(solved)
+            phase_duration.merge(timings)
+            yield result
+    except BrokenProcessPool:
+        _discard_batch_pool(pool)
+        raise
+    finally:
+        solved.close()  # a client that went away leaves nothing queued
 
-        if not query:
-            return jsonify({'error': 'No search query provided'}), 400
 
-        # Generate recipe using OpenAI
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": """You are a helpful recipe assistant. Provide recipes in a structured JSON format with:
+def optimize_shopping_stops_batch(baskets, radius=None, max_stores=None,
+                                  cost_per_mile=None, stop_penalty=None, conn=None):
+    """optimize_shopping_stops for many baskets ({"id", "items", "userZip"} dicts).
+
+    All database work happens before this returns; the returned iterator then
+    yields {"index", "id", "result"} or {"index", "id", "error", "status"} per
+    basket, in input order.
+    """
+    route, _ = _request_timing.get()
+    if conn is not None:
+        return _solve_batch(_prepare_batch(conn, baskets, radius, max_stores, cost_per_mile, stop_penalty), route)
+    if has_app_context():
+        conn = get_db_connection()
+        if not conn:
+            raise RuntimeError("Database connection failed")
+        return _solve_batch(_prepare_batch(conn, baskets, radius, max_stores, cost_per_mile, stop_penalty), route)
+    with db_connection() as conn:
+        jobs = _prepare_batch(conn, baskets, radius, max_stores, cost_per_mile, stop_penalty)
+    return _solve_batch(jobs, route)
+
+
+@app.route('/api/optimize-stops/batch', methods=['POST'])
+def optimize_stops_batch():
+    data = request.get_json(silent=True) or {}
+    baskets = data.get('baskets')
+    if not isinstance(baskets, list) or not baskets:
+        return jsonify({"error": "baskets must be a non-empty list"}), 400
+
+    try:
+        radius = _parse_positive_arg(data.get('radius'), float)
+        max_stores = _parse_positive_arg(data.get('maxStores'), int)
+        cost_per_mile = _parse_positive_arg(data.get('costPerMile'), float)
+        stop_penalty = _parse_positive_arg(data.get('stopPenalty'), float)
+    except (TypeError, ValueError):
+        return jsonify({"error": "radius, maxStores, costPerMile and stopPenalty must be positive numbers"}), 400
+
+    try:
+        results = optimize_shopping_stops_batch(
+            baskets, radius=radius, max_stores=max_stores,
+            cost_per_mile=cost_per_mile, stop_penalty=stop_penalty
+        )
+    except Exception as e:
+        log.exception("Error in optimize_stops_batch: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+    # One JSON object per line, sent as each basket is solved
+    lines = (json.dumps(result) + "\n" for result in results)
+    return Response(stream_with_context(lines), mimetype="application/x-ndjson")
+
+
+@app.cli.command("optimize-baskets")
+@click.argument("baskets_path")
+@click.option("--radius", type=float, help="Only consider stores within this many miles")
+@click.option("--max-stores", type=int, help="Only consider this many nearest stores")
+def optimize_baskets(baskets_path, radius, max_stores):
+    """Optimize a JSON list of {"id", "items", "userZip"} baskets, writing NDJSON to stdout."""
+    with open(baskets_path) as f:
+        baskets = json.load(f)
+    for result in optimize_shopping_stops_batch(baskets, radius=radius, max_stores=max_stores):
+        click.echo(json.dumps(result))
+
+
+# External calls (OpenAI, YouTube)
+#
+# Slow upstream calls run on a bounded thread pool so independent ones overlap
+# and none of them can hold a request past its deadline: every wait is capped
+# by the call's own timeout and by what is left of the request's overall budget.
+EXTERNAL_CALL_WORKERS = int(os.getenv("EXTERNAL_CALL_WORKERS", "16"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "30"))
+YOUTUBE_TIMEOUT = float(os.getenv("YOUTUBE_TIMEOUT", "8"))
+RECIPE_DEADLINE = float(os.getenv("RECIPE_DEADLINE", "45"))  # seconds per recipe/meal-plan request
+
+openai_api = Upstream("openai", OPENAI_TIMEOUT, concurrency=8, rate=3, burst=10)
+youtube_api = Upstream("youtube", YOUTUBE_TIMEOUT, concurrency=6, rate=5, burst=20)
+
+_external_pool = None
+_external_pool_pid = None
+_external_pool_lock = threading.Lock()
+
+
+def _get_external_pool():
+    """The process's thread pool for external calls, (re)created after a fork."""
+    global _external_pool, _external_pool_pid
+    if _external_pool_pid != os.getpid():
+        with _external_pool_lock:
+            if _external_pool_pid != os.getpid():
+                _external_pool = ThreadPoolExecutor(EXTERNAL_CALL_WORKERS, thread_name_prefix="external")
+                _external_pool_pid = os.getpid()
+    return _external_pool
+
+
+def submit_external(fn, *args, **kwargs):
+    """Run fn(*args, **kwargs) on the external-call pool; returns a Future.
+
+    The call runs in a copy of the caller's context, so its timings count
+    towards the submitting request."""
+    return _get_external_pool().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def wait_external(future, deadline, default=None):
+    """The future's result, or `default` if it isn't ready by `deadline` (a
+    time.monotonic() value: the earlier of the call's own timeout, counted
+    from when it was submitted, and the request's overall deadline)."""
+    try:
+        return future.result(timeout=max(0.0, deadline - time.monotonic()))
+    except FuturesTimeoutError:
+        future.cancel()
+        log.warning("External call timed out: %s", future)
+        return default
+
+
+# Generated recipes and meal plans are memoized on disk, keyed on a hash of the
+# normalized inputs plus the model settings and prompt version, so identical
+# requests skip the LLM (and the parsing) entirely. RECIPE_CACHE_FUZZY also
+# matches recipe queries with the same set of meaningful words
+# ("Dal Tadka recipe" / "tadka dal").
+RECIPE_MODEL = "gpt-3.5-turbo"
+RECIPE_TEMPERATURE = 0.7
+RECIPE_PROMPT_VERSION = 1  # bump when the prompts change
+RECIPE_CACHE_TTL = int(os.getenv("RECIPE_CACHE_TTL", str(7 * 24 * 3600)))  # 0 disables
+RECIPE_CACHE_SIZE = int(os.getenv("RECIPE_CACHE_SIZE", "5000"))
+RECIPE_CACHE_PATH = os.getenv(
+    "RECIPE_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "recipe_cache.sqlite3")
+)
+RECIPE_CACHE_FUZZY = os.getenv("RECIPE_CACHE_FUZZY", "false").lower() == "true"
+RECIPE_QUERY_STOPWORDS = frozenset({
+    "a", "an", "and", "the", "for", "of", "with", "to", "how", "make", "recipe", "recipes", "easy", "best"
+})
+
+recipe_cache = SQLiteTTLCache(RECIPE_CACHE_PATH, RECIPE_CACHE_SIZE, RECIPE_CACHE_TTL, table="recipe_cache")
+
+
+def _recipe_cache_key(kind, *inputs):
+    """Content hash of normalized inputs and the settings that shape the LLM's answer."""
+    payload = json.dumps([kind, RECIPE_MODEL, RECIPE_TEMPERATURE, RECIPE_PROMPT_VERSION, *inputs])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _recipe_query_keys(query):
+    """Cache keys for a recipe query: exact (case/whitespace-insensitive), then fuzzy if enabled."""
+    keys = [_recipe_cache_key("recipe", " ".join(query.lower().split()))]
+    if RECIPE_CACHE_FUZZY:
+        tokens = sorted(set(re.findall(r"[a-z0-9]+", query.lower())) - RECIPE_QUERY_STOPWORDS)
+        if tokens:
+            keys.append(_recipe_cache_key("recipe-tokens", tokens))
+    return keys
+
+
+def _recipe_cache_get(keys):
+    """First cached value under any of `keys`; cache errors count as a miss."""
+    if RECIPE_CACHE_TTL <= 0:
+        return None
+    try:
+        for key in keys:
+            value = recipe_cache.get(key)
+            if value is not None:
+                return value
+    except sqlite3.Error as e:
+        log.warning("Recipe cache read failed: %s", e)
+    return None
+
+
+def _recipe_cache_set(keys, value):
+    if RECIPE_CACHE_TTL <= 0:
+        return
+    try:
+        for key in keys:
+            recipe_cache.set(key, value)
+    except sqlite3.Error as e:
+        log.warning("Recipe cache write failed: %s", e)
+
+
+def _recipe_messages(query):
+    return [
+        {"role": "system", "content": """You are a helpful recipe assistant. Provide recipes in a structured JSON format with:
                 - name: The recipe name
                 - ingredients: An array of clean ingredient names (just the ingredient, no measurements or descriptions)
                 - instructions: An array of cooking steps
@@ -846,52 +3156,301 @@ def recipe_search():
                     "ingredients": ["drumsticks", "carrots", "potatoes", "eggplant", "onions", "tomatoes", "ginger", "garlic", "turmeric", "cumin"],
                     "instructions": ["Chop all vegetables...", "Heat oil in a pan..."]
                 }"""},
-                {"role": "user",
-                 "content": f"Give me a recipe for {query}. List each vegetable and ingredient separately without any grouping or categories."}
-            ],
-            temperature=0.7
+        {"role": "user",
+         "content": f"Give me a recipe for {query}. List each vegetable and ingredient separately without any grouping or categories."}
+    ]
+
+
+def _parse_recipe(content):
+    """Parse the LLM's answer into {name, ingredients, instructions}."""
+    # Parse the response
+    try:
+        recipe_data = json.loads(content)
+    except json.JSONDecodeError:
+        # If the response isn't valid JSON, try to extract the recipe data
+        recipe_data = {
+            "name": "",
+            "ingredients": [],
+            "instructions": []
+        }
+
+        # Try to find the recipe name
+        name_match = re.search(r'"name":\s*"([^"]+)"', content)
+        if name_match:
+            recipe_data["name"] = name_match.group(1)
+
+        # Try to find ingredients array
+        ingredients_match = re.search(r'"ingredients":\s*\[(.*?)\]', content, re.DOTALL)
+        if ingredients_match:
+            ingredients_str = ingredients_match.group(1)
+            recipe_data["ingredients"] = [ing.strip(' "') for ing in ingredients_str.split(',')]
+
+        # Try to find instructions array
+        instructions_match = re.search(r'"instructions":\s*\[(.*?)\]', content, re.DOTALL)
+        if instructions_match:
+            instructions_str = instructions_match.group(1)
+            recipe_data["instructions"] = [inst.strip(' "') for inst in instructions_str.split(',')]
+
+    return recipe_data
+
+
+def _generate_recipe(query):
+    """Ask the LLM for a recipe and parse it into {name, ingredients, instructions}."""
+    with timed("openai"):
+        response = openai_api.call(
+            openai.ChatCompletion.create,
+            model=RECIPE_MODEL,
+            messages=_recipe_messages(query),
+            temperature=RECIPE_TEMPERATURE,
+            request_timeout=OPENAI_TIMEOUT
         )
+    return _parse_recipe(response.choices[0].message.content)
 
-        # Parse the response
-        try:
-            recipe_data = json.loads(response.choices[0].message.content)
-        except json.JSONDecodeError:
-            # If the response isn't valid JSON, try to extract the recipe data
-            content = response.choices[0].message.content
-            recipe_data = {
-                "name": "",
-                "ingredients": [],
-                "instructions": []
-            }
 
-            # Try to find the recipe name
-            name_match = re.search(r'"name":\s*"([^"]+)"', content)
-            if name_match:
-                recipe_data["name"] = name_match.group(1)
-
-            # Try to find ingredients array
-            ingredients_match = re.search(r'"ingredients":\s*\[(.*?)\]', content, re.DOTALL)
-            if ingredients_match:
-                ingredients_str = ingredients_match.group(1)
-                recipe_data["ingredients"] = [ing.strip(' "') for ing in ingredients_str.split(',')]
-
-            # Try to find instructions array
-            instructions_match = re.search(r'"instructions":\s*\[(.*?)\]', content, re.DOTALL)
-            if instructions_match:
-                instructions_str = instructions_match.group(1)
-                recipe_data["instructions"] = [inst.strip(' "') for inst in instructions_str.split(',')]
-
-        # Search for YouTube videos
-        video_links = search_youtube_videos(f"{query} recipe")
+# Streaming mode
+#
+# With {"stream": true} in the body (or ?stream=1) the recipe endpoints answer
+# with one event per line as things happen: LLM tokens as they arrive, each
+# video as soon as its lookup finishes, then a final "done" event carrying the
+# same payload as the non-streaming response. Clients that send
+# Accept: text/event-stream get the same events as SSE.
+
+def _wants_stream(data):
+    return data.get('stream') is True or request.args.get('stream', '').lower() in ('1', 'true')
+
+
+def _streaming_response(events):
+    sse = "text/event-stream" in request.headers.get("Accept", "")
+
+    def generate():
+        for event in events:
+            if sse:
+                yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+            else:
+                yield json.dumps(event) + "\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream" if sse else "application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+def _stream_chat(messages):
+    """Yield the LLM's answer piece by piece as it is generated."""
+    with timed("openai"), openai_api.request(check_duration=False):
+        for chunk in openai.ChatCompletion.create(
+            model=RECIPE_MODEL,
+            messages=messages,
+            temperature=RECIPE_TEMPERATURE,
+            request_timeout=OPENAI_TIMEOUT,
+            stream=True
+        ):
+            text = chunk["choices"][0]["delta"].get("content")
+            if text:
+                yield text
+
+
+def _recipe_events(query, videos, cache_keys, started, deadline):
+    """Streamed /api/recipe-search: tokens, the videos, then the parsed recipe."""
+    try:
+        video_links = None
+        recipe_data = _recipe_cache_get(cache_keys)
+        if recipe_data is None:
+            chunks = []
+            for text in _stream_chat(_recipe_messages(query)):
+                chunks.append(text)
+                yield {"type": "token", "text": text}
+                if video_links is None and videos.done():
+                    video_links = videos.result()
+                    yield {"type": "videos", "videoLinks": video_links}
+                if time.monotonic() > deadline:
+                    yield {"type": "error", "error": "Recipe generation timed out"}
+                    return
+            recipe_data = _parse_recipe("".join(chunks))
+            _recipe_cache_set(cache_keys, recipe_data)
+
+        if video_links is None:
+            video_links = wait_external(videos, min(deadline, started + YOUTUBE_TIMEOUT), default=[])
+            yield {"type": "videos", "videoLinks": video_links}
+
         recipe_data["videoLinks"] = video_links
+        yield {"type": "done", "recipe": recipe_data}
 
-        return jsonify(recipe_data)
+    except Exception as e:
+        log.exception("Error in streamed recipe search: %s", e)
+        yield {"type": "error", "error": "Failed to generate recipe"}
+
+
+def _meal_plan_events(preferences, ingredients, cache_keys, deadline):
+    """Streamed /api/meal-prep-suggestion: tokens, a video per meal as each
+    lookup finishes (searches start as soon as a meal's line is complete),
+    then the full plan."""
+    searches = {}  # meal -> Future of its video search
+    emitted = set()
+
+    def search(meal):
+        if meal not in searches:
+            searches[meal] = submit_external(search_youtube_videos, f"{meal} recipe", max_results=1)
+
+    def video_event(meal):
+        emitted.add(meal)
+        search_results = searches[meal].result()
+        if search_results:
+            return {"type": "video", "meal": meal, "video": search_results[0]}
+        return None
+
+    try:
+        plan = _recipe_cache_get(cache_keys)
+        if plan is not None:
+            yield {"type": "token", "text": plan["suggestion"]}
+            for meal in plan["meals"]:
+                search(meal)
+        else:
+            extractor = MealNameExtractor()
+            chunks = []
+            for text in _stream_chat(_meal_plan_messages(preferences, ingredients)):
+                chunks.append(text)
+                yield {"type": "token", "text": text}
+                for meal in extractor.feed(text):
+                    search(meal)
+                for meal in [m for m in searches if m not in emitted and searches[m].done()]:
+                    event = video_event(meal)
+                    if event:
+                        yield event
+                if time.monotonic() > deadline:
+                    yield {"type": "error", "error": "Meal prep suggestion timed out"}
+                    return
+            for meal in extractor.finish():
+                search(meal)
+
+            meal_plan_text = "".join(chunks).strip()
+            plan = {"suggestion": meal_plan_text, "meals": extract_meal_names(meal_plan_text)}
+            _recipe_cache_set(cache_keys, plan)
+
+        # The rest of the videos, in the order their lookups finish
+        pending = {searches[meal]: meal for meal in searches if meal not in emitted}
+        try:
+            video_deadline = min(deadline, time.monotonic() + YOUTUBE_TIMEOUT)
+            for future in as_completed(pending, timeout=max(0.0, video_deadline - time.monotonic())):
+                event = video_event(pending[future])
+                if event:
+                    yield event
+        except FuturesTimeoutError:
+            log.warning("Video lookups timed out for: %s", [meal for meal in searches if meal not in emitted])
+
+        meal_videos = []
+        for meal in plan["meals"]:
+            if meal in emitted and searches[meal].result():
+                meal_videos.append({"meal": meal, "video": searches[meal].result()[0]})
+        yield {"type": "done", "suggestion": plan["suggestion"], "videos": meal_videos}
 
     except Exception as e:
-        print(f"Error in recipe search: {str(e)}")
+        log.exception("Error streaming meal prep suggestion: %s", e)
+        yield {"type": "error", "error": "Failed to generate meal prep suggestion"}
+
+
+@app.route('/api/recipe-search', methods=['POST'])
+def recipe_search():
+    try:
+        data = request.get_json()
+        query = data.get('query')
+
+        if not query:
+            return jsonify({'error': 'No search query provided'}), 400
+
+        started = time.monotonic()
+        deadline = started + RECIPE_DEADLINE
+        cache_keys = _recipe_query_keys(query)
+
+        # The video search doesn't depend on the recipe, so run both at once
+        videos = submit_external(search_youtube_videos, f"{query} recipe")
+
+        if _wants_stream(data):
+            return _streaming_response(_recipe_events(query, videos, cache_keys, started, deadline))
+
+        recipe_data = _recipe_cache_get(cache_keys)
+        cache_status = "HIT" if recipe_data is not None else "MISS"
+        if recipe_data is None:
+            recipe = submit_external(_generate_recipe, query)
+            recipe_data = wait_external(recipe, min(deadline, started + OPENAI_TIMEOUT))
+            if recipe_data is None:
+                videos.cancel()
+                return jsonify({'error': 'Recipe generation timed out'}), 504
+            _recipe_cache_set(cache_keys, recipe_data)
+
+        recipe_data["videoLinks"] = wait_external(videos, min(deadline, started + YOUTUBE_TIMEOUT), default=[])
+
+        response = jsonify(recipe_data)
+        response.headers["X-Cache"] = cache_status
+        return response
+
+    except UpstreamUnavailable as e:
+        log.warning("Recipe search refused: %s", e)
+        return jsonify({'error': 'Recipe generation is temporarily unavailable'}), 503
+    except Exception as e:
+        log.exception("Error in recipe search: %s", e)
         return jsonify({'error': 'Failed to generate recipe'}), 500
 
 
+def _meal_plan_messages(preferences, ingredients):
+    preferences_str = ", ".join(preferences)
+    ingredients_str = ", ".join(ingredients)
+
+    return [
+        {"role": "system", "content": """You are a helpful meal planner. Create a 3-day meal prep plan based on the user's dietary preferences and available ingredients.
+
+            Respond in friendly text format, structured clearly with Day 1, Day 2, Day 3, Day 4 and Day 5.
+            List Breakfast, Lunch, Dinner ideas under each day.
+            Keep it realistic for meal prepping.
+            Meals should match the dietary preferences."""},
+                    {"role": "user", "content": f"""Create a 5-day meal prep plan for a {preferences_str} diet using these ingredients: {ingredients_str}.
+            Do not add ingredients not listed unless absolutely necessary."""}
+    ]
+
+
+def _meal_plan_cache_keys(preferences, ingredients):
+    """Same plan for the same preference and ingredient sets, whatever their order or case."""
+    return [_recipe_cache_key(
+        "meal-plan",
+        sorted({" ".join(p.lower().split()) for p in preferences}),
+        sorted({" ".join(i.lower().split()) for i in ingredients})
+    )]
+
+
+def _generate_meal_plan(preferences, ingredients):
+    """Ask the LLM for a meal prep plan; returns its text."""
+    with timed("openai"):
+        response = openai_api.call(
+            openai.ChatCompletion.create,
+            model=RECIPE_MODEL,
+            messages=_meal_plan_messages(preferences, ingredients),
+            temperature=RECIPE_TEMPERATURE,
+            request_timeout=OPENAI_TIMEOUT
+        )
+    return response.choices[0].message.content.strip()
+
+
+def find_meal_videos(meal_names, deadline):
+    """One video per meal, searched concurrently; meals whose search fails or
+    misses the deadline are left out."""
+    searches = {}
+    for meal in meal_names:
+        if meal not in searches:
+            searches[meal] = submit_external(search_youtube_videos, f"{meal} recipe", max_results=1)
+    deadline = min(deadline, time.monotonic() + YOUTUBE_TIMEOUT)
+
+    meal_videos = []
+    for meal in meal_names:
+        search_results = wait_external(searches[meal], deadline, default=[])
+        if search_results:
+            meal_videos.append({
+                "meal": meal,
+                "video": search_results[0]
+            })
+    return meal_videos
+
+
 @app.route('/api/meal-prep-suggestion', methods=['POST'])
 def meal_prep_suggestion():
     try:
@@ -902,80 +3461,213 @@ def meal_prep_suggestion():
         if not preferences or not ingredients:
             return jsonify({'error': 'Missing preferences or ingredients'}), 400
 
-        preferences_str = ", ".join(preferences)
-        ingredients_str = ", ".join(ingredients)
+        started = time.monotonic()
+        deadline = started + RECIPE_DEADLINE
 
-        # Generate meal prep suggestion using OpenAI
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": """You are a helpful meal planner. Create a 3-day meal prep plan based on the user's dietary preferences and available ingredients.
+        cache_keys = _meal_plan_cache_keys(preferences, ingredients)
+        if _wants_stream(data):
+            return _streaming_response(_meal_plan_events(preferences, ingredients, cache_keys, deadline))
 
-            Respond in friendly text format, structured clearly with Day 1, Day 2, Day 3, Day 4 and Day 5.
-            List Breakfast, Lunch, Dinner ideas under each day.
-            Keep it realistic for meal prepping.
-            Meals should match the dietary preferences."""},
-                            {"role": "user", "content": f"""Create a 5-day meal prep plan for a {preferences_str} diet using these ingredients: {ingredients_str}.
-            Do not add ingredients not listed unless absolutely necessary."""}
-            ],
-            temperature=0.7
-        )
+        plan = _recipe_cache_get(cache_keys)
+        cache_status = "HIT" if plan is not None else "MISS"
+        if plan is None:
+            # Generate meal prep suggestion using OpenAI
+            meal_plan_text = wait_external(
+                submit_external(_generate_meal_plan, preferences, ingredients),
+                min(deadline, started + OPENAI_TIMEOUT)
+            )
+            if meal_plan_text is None:
+                return jsonify({'error': 'Meal prep suggestion timed out'}), 504
 
-        meal_plan_text = response.choices[0].message.content.strip()
+            # Extract possible meal names (simple parsing)
+            plan = {"suggestion": meal_plan_text, "meals": extract_meal_names(meal_plan_text)}
+            _recipe_cache_set(cache_keys, plan)
 
         # --- Auto-Generate YouTube videos ---
-        # Extract possible meal names (simple parsing)
-        meal_names = extract_meal_names(meal_plan_text)
-
-        # Search YouTube for each meal
-        meal_videos = []
-        for meal in meal_names:
-            search_results = search_youtube_videos(f"{meal} recipe", max_results=1)
-            if search_results:
-                meal_videos.append({
-                    "meal": meal,
-                    "video": search_results[0]
-                })
+        # Search YouTube for all the meals at once
+        meal_videos = find_meal_videos(plan["meals"], deadline)
 
-        return jsonify({
-            'suggestion': meal_plan_text,
+        response = jsonify({
+            'suggestion': plan["suggestion"],
             'videos': meal_videos
         })
+        response.headers["X-Cache"] = cache_status
+        return response
 
+    except UpstreamUnavailable as e:
+        log.warning("Meal prep suggestion refused: %s", e)
+        return jsonify({'error': 'Meal prep suggestions are temporarily unavailable'}), 503
     except Exception as e:
-        print(f"Error generating meal prep suggestion: {str(e)}")
+        log.exception("Error generating meal prep suggestion: %s", e)
         return jsonify({'error': 'Failed to generate meal prep suggestion'}), 500
 
+def _meal_name_from_line(line):
+    """The meal on a "Breakfast: ..." / "Lunch: ..." / "Dinner: ..." line, else None."""
+    line = line.strip()
+    if line.lower().startswith(('breakfast:', 'lunch:', 'dinner:')):
+        # Extract meal name after the colon
+        parts = line.split(':', 1)
+        if len(parts) > 1:
+            meal_name = parts[1].strip()
+            if meal_name:
+                return meal_name
+    return None
+
+
+class MealNameExtractor:
+    """extract_meal_names for text that arrives in pieces.
+
+    feed() returns the meal names on lines completed by each piece; finish()
+    returns the one on the last, unterminated line.
+    """
+
+    def __init__(self):
+        self._partial = ""
+
+    def feed(self, text):
+        lines = (self._partial + text).split('\n')
+        self._partial = lines.pop()
+        return [name for name in map(_meal_name_from_line, lines) if name]
+
+    def finish(self):
+        line, self._partial = self._partial, ""
+        name = _meal_name_from_line(line)
+        return [name] if name else []
+
+
 def extract_meal_names(meal_plan_text):
     """Extract likely meal names from meal plan text."""
-    meal_names = []
-    lines = meal_plan_text.split('\n')
-    for line in lines:
-        line = line.strip()
-        if line.lower().startswith(('breakfast:', 'lunch:', 'dinner:')):
-            # Extract meal name after the colon
-            parts = line.split(':', 1)
-            if len(parts) > 1:
-                meal_name = parts[1].strip()
-                if meal_name:
-                    meal_names.append(meal_name)
-    return meal_names
-
+    extractor = MealNameExtractor()
+    return extractor.feed(meal_plan_text) + extractor.finish()
+
+
+# YouTube lookups are cached per (normalized query, max_results). Concurrent
+# lookups of the same query share one scrape (waiting at most YOUTUBE_TIMEOUT
+# for it; a scrape older than that no longer counts as in flight), and empty
+# or failed lookups are remembered briefly so a broken query isn't retried on
+# every request. Lookups youtube_api refused locally aren't remembered.
+# YOUTUBE_WARM_MEALS (comma separated meal names) are looked up at startup.
+YOUTUBE_CACHE_TTL = int(os.getenv("YOUTUBE_CACHE_TTL", str(24 * 3600)))  # 0 disables
+YOUTUBE_NEGATIVE_TTL = int(os.getenv("YOUTUBE_NEGATIVE_TTL", "300"))
+YOUTUBE_CACHE_SIZE = int(os.getenv("YOUTUBE_CACHE_SIZE", "2000"))
+YOUTUBE_CACHE_PATH = os.getenv("YOUTUBE_CACHE_PATH")
+YOUTUBE_WARM_MEALS = [meal.strip() for meal in os.getenv("YOUTUBE_WARM_MEALS", "").split(",") if meal.strip()]
+
+youtube_cache = make_cache("youtube_videos", YOUTUBE_CACHE_SIZE, YOUTUBE_CACHE_TTL, YOUTUBE_CACHE_PATH)
+_youtube_inflight = {}  # cache key -> (Future of the lookup in progress, time.monotonic() it started)
+_youtube_inflight_lock = threading.Lock()
+_youtube_session = requests.Session()
+
+
+class BoundedYoutubeSearch(YoutubeSearch):
+    """YoutubeSearch whose results page fetch gives up after `timeout` seconds.
+
+    The library retries `requests.get(url)`, without a timeout, until the
+    page has results in it, so a stalled scrape would never return.
+    """
+
+    def __init__(self, search_terms, max_results=None, timeout=None):
+        self.timeout = YOUTUBE_TIMEOUT if timeout is None else timeout
+        super().__init__(search_terms, max_results=max_results)
+
+    def _search(self):
+        url = f"https://youtube.com/results?search_query={up.quote_plus(self.search_terms)}"
+        deadline = time.monotonic() + self.timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"no YouTube results page for {self.search_terms!r} within {self.timeout}s")
+            response = _youtube_session.get(url, timeout=remaining).text
+            if "ytInitialData" in response:
+                break
+        results = self._parse_html(response)
+        return results if self.max_results is None else results[:self.max_results]
+
+
+def _fetch_youtube_videos(query, max_results):
+    results = youtube_api.call(lambda: BoundedYoutubeSearch(query, max_results=max_results).to_dict())
+    return [
+        {
+            "title": result["title"],
+            "url": f"https://www.youtube.com/watch?v={result['id']}"
+        }
+        for result in results
+    ]
 
 
+@timed("youtube")
 def search_youtube_videos(query, max_results=2):
+    if YOUTUBE_CACHE_TTL <= 0:
+        try:
+            return _fetch_youtube_videos(query, max_results)
+        except Exception as e:
+            log.warning("Error searching YouTube videos for %r: %s", query, e)
+            return []
+
+    key = f"{' '.join(query.lower().split())}|{max_results}"
+    videos = youtube_cache.get(key)
+    if videos is not None:
+        return videos
+
+    # Single flight: the first caller fetches, concurrent callers wait for its result
+    with _youtube_inflight_lock:
+        flight, started = _youtube_inflight.get(key, (None, 0.0))
+        leader = flight is None or time.monotonic() - started > YOUTUBE_TIMEOUT
+        if leader:
+            flight = Future()
+            _youtube_inflight[key] = (flight, time.monotonic())
+    if not leader:
+        try:
+            return flight.result(timeout=YOUTUBE_TIMEOUT)
+        except FuturesTimeoutError:
+            log.warning("Timed out waiting for the YouTube lookup of %r", query)
+            return []
+
+    videos, remember = [], True
     try:
-        results = YoutubeSearch(query, max_results=max_results).to_dict()
-        return [
-            {
-                "title": result["title"],
-                "url": f"https://www.youtube.com/watch?v={result['id']}"
-            }
-            for result in results
-        ]
+        videos = _fetch_youtube_videos(query, max_results)
+    except UpstreamUnavailable as e:
+        # Refused locally (rate limit, breaker, saturation): YouTube wasn't asked, so don't remember it
+        remember = False
+        log.warning("Skipped searching YouTube videos for %r: %s", query, e)
     except Exception as e:
-        print(f"Error searching YouTube videos: {str(e)}")
-        return []
+        log.warning("Error searching YouTube videos for %r: %s", query, e)
+    finally:
+        try:
+            if remember:
+                youtube_cache.set(key, videos, ttl=YOUTUBE_CACHE_TTL if videos else YOUTUBE_NEGATIVE_TTL)
+        except sqlite3.Error as e:
+            log.warning("YouTube cache write failed: %s", e)
+        with _youtube_inflight_lock:
+            if _youtube_inflight.get(key, (None,))[0] is flight:
+                del _youtube_inflight[key]
+        flight.set_result(videos)
+    return videos
+
+
+def warm_youtube_cache(meal_names, max_results=1):
+    """Look up "<meal> recipe" for every meal in the background, as meal plans do."""
+    return [
+        submit_external(search_youtube_videos, f"{meal} recipe", max_results=max_results)
+        for meal in meal_names
+    ]
+
+
+@app.cli.command("warm-youtube-cache")
+@click.argument("meal_names", nargs=-1)
+@click.option("--file", "names_path", help="File with one meal name per line")
+def warm_youtube_cache_command(meal_names, names_path):
+    """Pre-fetch recipe videos for popular meals (useful with YOUTUBE_CACHE_PATH)."""
+    meal_names = list(meal_names)
+    if names_path:
+        with open(names_path) as f:
+            meal_names += [line.strip() for line in f if line.strip()]
+    found = sum(1 for lookup in warm_youtube_cache(meal_names) if lookup.result())
+    click.echo(f"Found videos for {found} of {len(meal_names)} meals")
+
+
+if YOUTUBE_WARM_MEALS and not SOLVER_PROCESS:
+    warm_youtube_cache(YOUTUBE_WARM_MEALS)
 
 
 @app.route('/')
@@ -983,9 +3675,65 @@ def home():
     return jsonify({"message": "Grocery Smart API is running!"})
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Request/phase histograms and upstream counters for this worker, in the Prometheus text format."""
+    lines = []
+    for histogram in METRICS:
+        lines.extend(histogram.render())
+
+    upstreams = {name: upstream.metrics() for name, upstream in UPSTREAMS.items()}
+    counters = ["calls", "successes", "failures", "slow_calls", "rejected_circuit_open",
+                "rejected_rate_limited", "rejected_saturated", "circuit_opened"]
+    for key in counters:
+        name = f"grocery_smart_upstream_{key}_total"
+        lines.append(f"# TYPE {name} counter")
+        lines.extend(f"{name}{{{_metric_labels(['upstream'], [upstream])}}} {stats[key]}"
+                     for upstream, stats in upstreams.items())
+    lines.append("# TYPE grocery_smart_upstream_in_flight gauge")
+    lines.extend(f"grocery_smart_upstream_in_flight{{{_metric_labels(['upstream'], [upstream])}}} {stats['in_flight']}"
+                 for upstream, stats in upstreams.items())
+    lines.append("# TYPE grocery_smart_upstream_circuit_state gauge")
+    for upstream, stats in upstreams.items():
+        for state in ("closed", "open", "half_open"):
+            labels = _metric_labels(["upstream", "state"], [upstream, state])
+            lines.append(f"grocery_smart_upstream_circuit_state{{{labels}}} {int(stats['state'] == state)}")
+
+    return Response("\n".join(lines) + "\n", content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.route('/health/upstreams', methods=['GET'])
+def upstream_health():
+    """Per-upstream call counts, rejections, saturation and circuit state for this worker."""
+    return jsonify({name: upstream.metrics() for name, upstream in UPSTREAMS.items()})
+
+
+# Schema setup and migrations run once per deploy (`flask --app app init-db`,
+# the Procfile's release step), not on import: every gunicorn worker would
+# otherwise run the DDL at boot, racing the others and locking products and
+# stores each time. Runs are serialized by an advisory lock all the same.
+SCHEMA_LOCK_ID = 7_310_442  # pg_advisory_xact_lock key for init_db
+
+
 def init_db():
-    conn = get_db_connection()
+    if not DB_CONFIG:
+        log.warning("DATABASE_URL is not set, skipping database setup")
+        return
+    with db_connection() as conn:
+        _create_schema(conn)
+        reload_product_synonyms(conn=conn)
+
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Create the app's tables and run its migrations."""
+    init_db()
+    click.echo("Database is up to date")
+
+
+def _create_schema(conn):
     cursor = conn.cursor()
+    cursor.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK_ID,))
 
     # Create users table
     cursor.execute('''
@@ -1009,12 +3757,245 @@ def init_db():
         )
     ''')
 
+    # Store coordinates are geocoded once (on create or by backfill-store-coordinates)
+    cursor.execute('''
+        ALTER TABLE stores
+            ADD COLUMN IF NOT EXISTS latitude DOUBLE PRECISION,
+            ADD COLUMN IF NOT EXISTS longitude DOUBLE PRECISION
+    ''')
+
+    # Canonical products and the names (aliases) they go by
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS canonical_products (
+            id SERIAL PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS product_aliases (
+            alias TEXT PRIMARY KEY,
+            canonical_id INTEGER NOT NULL REFERENCES canonical_products(id)
+        )
+    ''')
+    cursor.execute('''
+        ALTER TABLE products
+            ADD COLUMN IF NOT EXISTS canonical_id INTEGER REFERENCES canonical_products(id)
+    ''')
+    store_product_synonyms(cursor, PRODUCT_SYNONYMS)
+    _migrate_product_lookups(cursor)
+    _migrate_updated_at(cursor)
+    _migrate_store_listings(cursor)
+
+    # Give products uploaded before canonical IDs existed one; names that
+    # aren't a known alias become canonical products of their own
+    cursor.execute('''
+        INSERT INTO canonical_products (name)
+        SELECT DISTINCT p.normalized_name FROM products p
+        WHERE p.canonical_id IS NULL
+          AND NOT EXISTS (SELECT 1 FROM product_aliases a WHERE a.alias = p.normalized_name)
+        ON CONFLICT (name) DO NOTHING
+    ''')
+    cursor.execute('''
+        INSERT INTO product_aliases (alias, canonical_id)
+        SELECT name, id FROM canonical_products
+        ON CONFLICT (alias) DO NOTHING
+    ''')
+    cursor.execute('''
+        UPDATE products p
+        SET canonical_id = a.canonical_id
+        FROM product_aliases a
+        WHERE p.canonical_id IS NULL AND a.alias = p.normalized_name
+    ''')
+
     conn.commit()
-    conn.close()
+    cursor.close()
+
+
+# Products that have a newer row at the same store with the same name (ignoring
+# case and surrounding whitespace) and quantity: (id, store_id, name, newer id)
+DUPLICATE_PRODUCTS_QUERY = '''
+    SELECT p.id, p.store_id, p.name, MAX(newer.id) AS newer_id
+    FROM products p
+    JOIN products newer
+      ON newer.store_id = p.store_id
+     AND LOWER(TRIM(newer.name)) = LOWER(TRIM(p.name))
+     AND newer.quantity IS NOT DISTINCT FROM p.quantity
+     AND newer.id > p.id
+    GROUP BY p.id, p.store_id, p.name
+'''
+
+
+def _migrate_product_lookups(cursor):
+    """Index products for case-insensitive name lookups and canonical-ID price lookups."""
+    # LOWER(TRIM(name)) kept by Postgres itself, so it can't drift from name
+    cursor.execute('''
+        ALTER TABLE products
+            ADD COLUMN IF NOT EXISTS normalized_name TEXT GENERATED ALWAYS AS (LOWER(TRIM(name))) STORED
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS products_normalized_name_idx ON products (normalized_name)')
+
+    # One row per (store, name, quantity). Rows from before this index that
+    # differ only in case/whitespace have to be removed first (dedupe-products)
+    cursor.execute("SELECT to_regclass('products_store_name_quantity_key')")
+    if cursor.fetchone()[0] is None:
+        cursor.execute(f"SELECT COUNT(*) FROM ({DUPLICATE_PRODUCTS_QUERY}) duplicates")
+        duplicates = cursor.fetchone()[0]
+        if duplicates:
+            raise RuntimeError(
+                f"Found {duplicates} duplicate products (an older row for the same store, name ignoring case "
+                "and whitespace, and quantity), so products_store_name_quantity_key can't be created. List them "
+                "with `flask --app app dedupe-products --dry-run` and delete them with "
+                "`flask --app app dedupe-products`"
+            )
+        cursor.execute('''
+            CREATE UNIQUE INDEX products_store_name_quantity_key
+            ON products (store_id, normalized_name, quantity)
+        ''')
 
+    # Covers the compare/optimize price joins without touching the table
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS products_canonical_price_idx
+        ON products (canonical_id, store_id) INCLUDE (price, name)
+    ''')
+
+
+def _migrate_updated_at(cursor):
+    """Stamp every insert and update of products and stores with its time and
+    transaction ID (changed_xid, for the price snapshot's incremental refresh)."""
+    # Bumping a store's content_version alone doesn't count as a change to the store row
+    cursor.execute('''
+        CREATE OR REPLACE FUNCTION set_updated_at() RETURNS trigger AS $$
+        BEGIN
+            IF to_jsonb(NEW) - 'content_version' - 'updated_at' - 'changed_xid'
+                    IS DISTINCT FROM to_jsonb(OLD) - 'content_version' - 'updated_at' - 'changed_xid' THEN
+                NEW.updated_at = now();
+                NEW.changed_xid = pg_current_xact_id();
+            END IF;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+    for table in ("products", "stores"):
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now()')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {table}_updated_at_idx ON {table} (updated_at)')
+        cursor.execute(
+            f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS changed_xid XID8 NOT NULL DEFAULT pg_current_xact_id()'
+        )
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {table}_changed_xid_idx ON {table} (changed_xid)')
+        cursor.execute(f'''
+            CREATE OR REPLACE TRIGGER {table}_set_updated_at
+            BEFORE UPDATE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION set_updated_at()
+        ''')
+
+
+def _migrate_store_listings(cursor):
+    """Per-store content versions for /store/<id> ETags, keyset paging and clean flyer URLs."""
+    cursor.execute('ALTER TABLE stores ADD COLUMN IF NOT EXISTS content_version BIGINT NOT NULL DEFAULT 0')
+    cursor.execute('CREATE INDEX IF NOT EXISTS products_store_id_idx ON products (store_id, id)')
+
+    # One bump per statement and store, so a bulk upload doesn't update the store row once per product
+    cursor.execute('''
+        CREATE OR REPLACE FUNCTION bump_store_content_version() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE stores SET content_version = content_version + 1
+                WHERE id IN (SELECT store_id FROM new_rows);
+            ELSIF TG_OP = 'UPDATE' THEN
+                UPDATE stores SET content_version = content_version + 1
+                WHERE id IN (SELECT store_id FROM new_rows UNION SELECT store_id FROM old_rows);
+            ELSE
+                UPDATE stores SET content_version = content_version + 1
+                WHERE id IN (SELECT store_id FROM old_rows);
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+    transition_tables = {
+        "INSERT": "NEW TABLE AS new_rows",
+        "UPDATE": "OLD TABLE AS old_rows NEW TABLE AS new_rows",
+        "DELETE": "OLD TABLE AS old_rows"
+    }
+    for table in ("products", "flyers"):
+        for event, tables in transition_tables.items():
+            cursor.execute(f'''
+                CREATE OR REPLACE TRIGGER {table}_{event.lower()}_store_version
+                AFTER {event} ON {table}
+                REFERENCING {tables}
+                FOR EACH STATEMENT EXECUTE FUNCTION bump_store_content_version()
+            ''')
+
+    # Flyer URLs used to be stored with doubled slashes and cleaned up on every read
+    cursor.execute("SELECT id, image_url FROM flyers WHERE image_url ~ '[^:]//'")
+    fixes = [(normalize_flyer_url(url), flyer_id) for flyer_id, url in cursor.fetchall()]
+    if fixes:
+        cursor.executemany("UPDATE flyers SET image_url = %s WHERE id = %s", fixes)
+        log.info("Normalized %d flyer URLs", len(fixes))
+
+
+@app.cli.command("backfill-store-coordinates")
+@click.option("--all", "refresh_all", is_flag=True, help="Re-geocode stores that already have coordinates")
+def backfill_store_coordinates(refresh_all):
+    """Fill stores.latitude/longitude from each store's ZIP code."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    if refresh_all:
+        cursor.execute("SELECT id, zip_code FROM stores ORDER BY id")
+    else:
+        cursor.execute("SELECT id, zip_code FROM stores WHERE latitude IS NULL OR longitude IS NULL ORDER BY id")
+    stores = cursor.fetchall()
+
+    updated, missing = 0, []
+    for store_id, zip_code in stores:
+        coords = get_zip_coordinates(zip_code) if zip_code else None
+        if not coords:
+            missing.append(store_id)
+            continue
+        cursor.execute(
+            "UPDATE stores SET latitude = %s, longitude = %s WHERE id = %s",
+            (coords["lat"], coords["lng"], store_id)
+        )
+        updated += 1
 
-# Initialize database
-init_db()
+    conn.commit()
+    cursor.close()
+    invalidate_store_index()
+    invalidate_price_snapshot()
+    compare_cache.clear()  # cached distances may have changed
+
+    click.echo(f"Geocoded {updated} of {len(stores)} stores")
+    if missing:
+        click.echo(f"Could not geocode store IDs: {', '.join(map(str, missing))}")
+
+
+@app.cli.command("dedupe-products")
+@click.option("--dry-run", is_flag=True, help="Only list the duplicates")
+def dedupe_products(dry_run):
+    """Delete products that duplicate a newer row at the same store, then set up the database."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+
+    cursor.execute(DUPLICATE_PRODUCTS_QUERY + " ORDER BY p.store_id, p.id")
+    duplicates = cursor.fetchall()
+    for product_id, store_id, name, newer_id in duplicates:
+        click.echo(f"Store {store_id}: product {product_id} ({name!r}) duplicates product {newer_id}")
+
+    if dry_run:
+        conn.rollback()
+        cursor.close()
+        click.echo(f"Found {len(duplicates)} duplicate products")
+        return
+
+    cursor.execute("DELETE FROM products WHERE id = ANY(%s)", ([row[0] for row in duplicates],))
+    conn.commit()
+    cursor.close()
+    click.echo(f"Deleted {len(duplicates)} duplicate products")
+
+    init_db()
+    invalidate_price_snapshot(rebuild=True)
+    compare_cache.clear()  # cached comparisons may list deleted rows
 
 
 # User Authentication Endpoints
@@ -1039,9 +4020,9 @@ def register():
             (username, email, password_hash)
         )
         conn.commit()
-        conn.close()
         return jsonify({'message': 'User registered successfully'}), 201
-    except sqlite3.IntegrityError:
+    except psycopg2.IntegrityError:
+        conn.rollback()
         return jsonify({'error': 'Username or email already exists'}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -1061,7 +4042,6 @@ def login():
         cursor = conn.cursor()
         cursor.execute('SELECT id, username, password_hash FROM users WHERE email = %s', (email,))
         user = cursor.fetchone()
-        conn.close()
 
         if not user or not check_password_hash(user[2], password):
             return jsonify({'error': 'Invalid email or password'}), 401
@@ -1070,14 +4050,11 @@ def login():
         session_token = secrets.token_hex(32)
         expires_at = datetime.now() + timedelta(days=7)
 
-        conn = get_db_connection()
-        cursor = conn.cursor()
         cursor.execute(
             'INSERT INTO user_sessions (user_id, session_token, expires_at) VALUES (%s, %s, %s)',
             (user[0], session_token, expires_at)
         )
         conn.commit()
-        conn.close()
 
         return jsonify({
             'message': 'Login successful',
@@ -1101,7 +4078,6 @@ def logout():
         cursor = conn.cursor()
         cursor.execute('DELETE FROM user_sessions WHERE session_token = %s', (session_token,))
         conn.commit()
-        conn.close()
         return jsonify({'message': 'Logged out successfully'}), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -1125,7 +4101,6 @@ def verify_session():
             WHERE s.session_token = %s AND s.expires_at > CURRENT_TIMESTAMP
         ''', (session_token,))
         user = cursor.fetchone()
-        conn.close()
 
         if not user:
             return jsonify({'error': 'Invalid or expired session'}), 401
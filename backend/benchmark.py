@@ -0,0 +1,463 @@
+"""Benchmarks for the price comparison, store search and optimizer hot paths.
+
+Generates a synthetic catalog (stores clustered around metro-area ZIPs,
+products sold under their PRODUCT_SYNONYMS aliases, per-store price levels)
+and reports latency percentiles and throughput for
+
+* each optimizer strategy, building the price matrix and route planning,
+  in-process and without a database
+* POST /api/compare-prices, POST /api/optimize-stops, GET /stores/by-distance
+  and POST /api/recipe-search through the Flask test client, against the
+  PostgreSQL database given with --database-url. There is no SQLite stand-in:
+  the app's SQL is PostgreSQL's (psycopg2, generated columns, and the
+  transaction-ID snapshot functions of PostgreSQL 13+), so without a
+  database only the strategies are measured
+
+for every combination of --stores and --baskets. Geocoding only uses the
+bundled ZIP centroids and the OpenAI/YouTube calls return canned answers, so
+runs are offline and repeatable for a given --seed. The database is wiped and
+refilled for every store count: use a throwaway database whose name contains
+"bench".
+
+    python benchmark.py --stores 100,1000 --baskets 3,10 --save-baseline bench.json
+    python benchmark.py --stores 100,1000 --baskets 3,10 --baseline bench.json
+
+With --baseline the run exits non-zero if any p50/p90 got slower than the
+baseline by more than --tolerance.
+"""
+import csv
+import json
+import os
+import platform
+import sys
+import time
+import types
+import urllib.parse as up
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+import numpy as np
+import psycopg2  # type: ignore
+from psycopg2.extras import execute_values  # type: ignore
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ZIP_CENTROIDS_PATH = os.path.join(HERE, "data", "zip_centroids.csv")
+
+# The tables the app expects to exist already (in production they are managed
+# in Supabase); init_db() adds everything else
+BASE_SCHEMA = """
+    DROP TABLE IF EXISTS user_sessions, users, flyers, products, product_aliases, canonical_products, stores CASCADE;
+    CREATE TABLE stores (
+        id SERIAL PRIMARY KEY,
+        name TEXT NOT NULL,
+        zip_code TEXT
+    );
+    CREATE TABLE products (
+        id SERIAL PRIMARY KEY,
+        name TEXT NOT NULL,
+        store_id INTEGER REFERENCES stores(id),
+        price NUMERIC(10, 2),
+        quantity TEXT
+    );
+    CREATE TABLE flyers (
+        id SERIAL PRIMARY KEY,
+        store_id INTEGER REFERENCES stores(id),
+        image_url TEXT,
+        uploaded_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+CANNED_RECIPE = """Name: Benchmark Curry
+Ingredients:
+- 1 onion
+- 2 tomatoes
+- 1 tsp cumin
+Instructions:
+1. Fry the onion.
+2. Add the tomatoes and cumin.
+3. Simmer for 10 minutes."""
+
+
+def _parse_sizes(_ctx, _param, value):
+    try:
+        sizes = [int(size) for size in value.split(",") if size.strip()]
+    except ValueError:
+        raise click.BadParameter("expected comma separated integers")
+    if not sizes or min(sizes) < 1:
+        raise click.BadParameter("expected positive integers")
+    return sizes
+
+
+def load_zip_centroids():
+    """(zip, lat, lng) for every ZIP in the bundled centroid file, in ZIP order."""
+    with open(ZIP_CENTROIDS_PATH, newline="") as f:
+        return [(row["zip"], float(row["lat"]), float(row["lng"])) for row in csv.DictReader(f)]
+
+
+# Synthetic data
+
+def product_catalog(synonyms, count):
+    """`count` products as [canonical name, alias, ...]: the PRODUCT_SYNONYMS
+    entries first, then generated products with two aliases each."""
+    catalog = [[canonical, *aliases] for canonical, aliases in synonyms.items()]
+    for i in range(len(catalog), count):
+        catalog.append([f"item {i}", f"item-{i}", f"loose item {i}"])
+    return catalog[:count]
+
+
+def generate_dataset(rng, zips, catalog, store_count, coverage, metros):
+    """Synthetic stores and price rows.
+
+    Stores cluster around `metros` randomly chosen ZIPs (neighbouring ZIP codes
+    are close together, so a normal spread in ZIP order gives a metro area).
+    Every store carries a `coverage` share of the catalog, each product under
+    one of its names in random case. A price is the product's base price times
+    the store's price level, with a little noise.
+    """
+    centers = rng.choice(len(zips), size=min(metros, len(zips)), replace=False)
+
+    def zip_near(center, spread):
+        return zips[int(np.clip(round(center + rng.normal(0, spread)), 0, len(zips) - 1))]
+
+    stores = []
+    for i in range(store_count):
+        zip_code, lat, lng = zip_near(centers[rng.integers(len(centers))], 40)
+        stores.append((f"Store {i + 1}", zip_code, lat, lng))
+
+    base_prices = rng.lognormal(np.log(3.0), 0.6, size=len(catalog))
+    price_levels = np.clip(rng.normal(1.0, 0.12, size=store_count), 0.7, 1.4)
+
+    products = []  # (name, store position, price, product index)
+    for store in range(store_count):
+        for product in np.flatnonzero(rng.random(len(catalog)) < coverage):
+            names = catalog[product]
+            name = names[rng.integers(len(names))]
+            if rng.random() < 0.3:
+                name = name.title()
+            price = max(0.25, round(float(base_prices[product] * price_levels[store] * rng.normal(1.0, 0.05)), 2))
+            products.append((name, store, price, int(product)))
+
+    user_zips = [zip_near(centers[rng.integers(len(centers))], 20)[0] for _ in range(256)]
+    return {"stores": stores, "products": products, "user_zips": user_zips}
+
+
+def generate_baskets(rng, catalog, basket_size, count):
+    """Shopping lists of `basket_size` distinct products, each under a random one of its names."""
+    baskets = []
+    for _ in range(count):
+        picks = rng.choice(len(catalog), size=min(basket_size, len(catalog)), replace=False)
+        baskets.append([(catalog[p][rng.integers(len(catalog[p]))], int(p)) for p in picks])
+    return baskets
+
+
+def reset_database(database_url, sslmode):
+    conn = psycopg2.connect(database_url, sslmode=sslmode)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(BASE_SCHEMA)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def load_dataset(grocery, dataset, catalog):
+    """Replace the catalog in the app's database with `dataset`."""
+    with grocery.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("TRUNCATE flyers, products, stores RESTART IDENTITY CASCADE")
+        grocery.store_product_synonyms(cursor, {names[0]: names[1:] for names in catalog})
+        store_ids = [row[0] for row in execute_values(
+            cursor,
+            "INSERT INTO stores (name, zip_code, latitude, longitude) VALUES %s RETURNING id",
+            dataset["stores"], page_size=1000, fetch=True
+        )]
+        execute_values(
+            cursor,
+            "INSERT INTO products (name, store_id, price, quantity) VALUES %s",
+            [(name, store_ids[store], price, "1 unit") for name, store, price, _ in dataset["products"]],
+            page_size=5000
+        )
+        conn.commit()
+        cursor.close()
+
+        # Point the new products at their canonical IDs and refresh the app's views
+        grocery._create_schema(conn)
+        grocery.reload_product_synonyms(conn=conn)
+        with conn.cursor() as cursor:
+            cursor.execute("ANALYZE")
+        conn.commit()
+    grocery.invalidate_store_index()
+    grocery.invalidate_price_snapshot(rebuild=True)
+    grocery.compare_cache.clear()
+
+
+def stub_external_calls(grocery):
+    """Canned OpenAI and YouTube answers, so recipe requests never leave the process."""
+    def create(**kwargs):
+        if kwargs.get("stream"):
+            return iter([{"choices": [{"delta": {"content": line + "\n"}}]} for line in CANNED_RECIPE.split("\n")])
+        message = types.SimpleNamespace(content=CANNED_RECIPE)
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)])
+
+    class YoutubeSearch:
+        def __init__(self, query, max_results=2):
+            self.query = query
+            self.max_results = max_results
+
+        def to_dict(self):
+            return [{"title": f"{self.query} {i}", "id": f"bench{i}"} for i in range(self.max_results)]
+
+    grocery.openai.ChatCompletion.create = create
+    grocery.BoundedYoutubeSearch = YoutubeSearch
+
+
+# Measurement
+
+def summarize(workload, store_count, basket_size, latencies, wall, errors=0):
+    ms = np.asarray(latencies) * 1000
+    return {
+        "workload": workload,
+        "stores": store_count,
+        "basket": basket_size,
+        "n": len(ms),
+        "errors": errors,
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p90_ms": round(float(np.percentile(ms, 90)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "max_ms": round(float(ms.max()), 3),
+        "mean_ms": round(float(ms.mean()), 3),
+        "throughput_rps": round(len(ms) / wall, 1) if wall > 0 else None
+    }
+
+
+def bench_strategies(grocery, dataset, catalog, baskets, store_count, basket_size):
+    """Time each optimizer step on price matrices built straight from the dataset."""
+    stores = dataset["stores"]
+    rows_of = {}
+    for name, store, price, product in dataset["products"]:
+        zip_code, lat, lng = stores[store][1:]
+        rows_of.setdefault(product, []).append((store + 1, name, price, stores[store][0], zip_code, lat, lng))
+
+    steps = ["price_matrix", "price_optimized", "distance_optimized", "convenience_optimized",
+             "joint_optimized", "route_planning"]
+    timings = {step: [] for step in steps}
+    for i, basket in enumerate(baskets):
+        user_zip = dataset["user_zips"][i % len(dataset["user_zips"])]
+        user_coords = grocery.get_zip_coordinates(user_zip)
+        items = [name for name, _ in basket]
+        rows = [row + (name,) for name, product in basket for row in rows_of.get(product, ())]
+        if not rows:
+            continue
+
+        t0 = time.perf_counter()
+        matrix = grocery.PriceMatrix.from_rows(rows, items)
+        distances = matrix.distances_from(user_coords["lat"], user_coords["lng"])
+        t1 = time.perf_counter()
+        price_stops = grocery.find_price_optimized_stops(matrix)
+        t2 = time.perf_counter()
+        distance_stops = grocery.find_distance_optimized_stops(matrix, distances)
+        t3 = time.perf_counter()
+        convenience_stops = grocery.find_optimal_stops(matrix, distances)
+        t4 = time.perf_counter()
+        joint_stops = grocery.find_joint_optimized_stops(
+            matrix, distances, user_coords, seeds=[price_stops, distance_stops, convenience_stops]
+        )
+        t5 = time.perf_counter()
+        for stops in (price_stops, distance_stops, convenience_stops, joint_stops):
+            matrix.plan(stops, user_coords)
+        t6 = time.perf_counter()
+
+        for step, elapsed in zip(steps, (t1 - t0, t2 - t1, t3 - t2, t4 - t3, t5 - t4, t6 - t5)):
+            timings[step].append(elapsed)
+
+    # Steps run back to back, so a step's throughput is how many it could do per second on its own
+    return [
+        summarize(f"strategy:{step}", store_count, basket_size, timings[step], sum(timings[step]))
+        for step in steps if timings[step]
+    ]
+
+
+def bench_endpoint(grocery, workload, store_count, basket_size, requests_to_send, concurrency):
+    """Send (method, url, json) requests through the test client; latency per request."""
+    def send(spec):
+        method, url, body = spec
+        client = grocery.app.test_client()
+        t0 = time.perf_counter()
+        response = client.open(url, method=method, json=body)
+        response.get_data()
+        return time.perf_counter() - t0, response.status_code
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(concurrency) as pool:
+            results = list(pool.map(send, requests_to_send))
+    else:
+        results = [send(spec) for spec in requests_to_send]
+    wall = time.perf_counter() - started
+
+    errors = sum(1 for _, status in results if status >= 400)
+    return summarize(workload, store_count, basket_size, [elapsed for elapsed, _ in results], wall, errors)
+
+
+def bench_endpoints(grocery, dataset, baskets_by_size, store_count, requests, warmup, concurrency):
+    user_zips = dataset["user_zips"]
+    results = []
+
+    def run(workload, basket_size, specs):
+        for spec in specs[:warmup]:
+            grocery.app.test_client().open(spec[1], method=spec[0], json=spec[2])
+        results.append(bench_endpoint(grocery, workload, store_count, basket_size, specs, concurrency))
+
+    for basket_size, baskets in baskets_by_size.items():
+        bodies = [
+            {"items": [name for name, _ in basket], "userZip": user_zips[i % len(user_zips)]}
+            for i, basket in enumerate(baskets)
+        ]
+        run("endpoint:compare-prices", basket_size, [("POST", "/api/compare-prices", body) for body in bodies])
+        run("endpoint:optimize-stops", basket_size, [("POST", "/api/optimize-stops", body) for body in bodies])
+
+    run("endpoint:stores-by-distance", None,
+        [("GET", f"/stores/by-distance/{user_zips[i % len(user_zips)]}?limit=20", None) for i in range(requests)])
+    run("endpoint:recipe-search", None,
+        [("POST", "/api/recipe-search", {"query": f"dish {i}"}) for i in range(requests)])
+    return results
+
+
+# Reporting
+
+def print_results(results):
+    header = f"{'workload':<36}{'stores':>8}{'basket':>8}{'n':>7}{'err':>5}" \
+             f"{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'req/s':>10}"
+    click.echo(header)
+    click.echo("-" * len(header))
+    for r in results:
+        click.echo(
+            f"{r['workload']:<36}{r['stores']:>8}{r['basket'] if r['basket'] is not None else '-':>8}"
+            f"{r['n']:>7}{r['errors']:>5}{r['p50_ms']:>10.2f}{r['p90_ms']:>10.2f}{r['p99_ms']:>10.2f}"
+            f"{r['max_ms']:>10.2f}{r['throughput_rps'] or 0:>10.1f}"
+        )
+
+
+def compare_to_baseline(results, baseline, tolerance, floor_ms):
+    """Lines describing every p50/p90 that is more than `tolerance` (and floor_ms) slower than the baseline."""
+    previous = {(r["workload"], r["stores"], r["basket"]): r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        before = previous.get((r["workload"], r["stores"], r["basket"]))
+        if before is None:
+            continue
+        for key in ("p50_ms", "p90_ms"):
+            if r[key] > before[key] * (1 + tolerance) and r[key] - before[key] > floor_ms:
+                regressions.append(
+                    f"{r['workload']} stores={r['stores']} basket={r['basket']}: "
+                    f"{key} {before[key]:.2f} -> {r[key]:.2f} ms (+{(r[key] / before[key] - 1) * 100:.0f}%)"
+                )
+    return regressions
+
+
+@click.command()
+@click.option("--database-url", envvar="BENCH_DATABASE_URL",
+              help="Throwaway PostgreSQL 13+ database for the endpoint benchmarks (skipped when unset).")
+@click.option("--sslmode", default="disable", show_default=True, help="sslmode for --database-url.")
+@click.option("--stores", "store_counts", default="50,500", show_default=True, callback=_parse_sizes,
+              help="Comma separated store counts.")
+@click.option("--baskets", "basket_sizes", default="3,8,15", show_default=True, callback=_parse_sizes,
+              help="Comma separated basket sizes.")
+@click.option("--products", default=300, show_default=True, help="Distinct products in the catalog.")
+@click.option("--coverage", default=0.4, show_default=True, help="Share of the catalog each store carries.")
+@click.option("--metros", default=8, show_default=True, help="Metro areas the stores cluster around.")
+@click.option("--requests", default=200, show_default=True, help="Measured requests per workload.")
+@click.option("--warmup", default=10, show_default=True, help="Unmeasured requests per workload.")
+@click.option("--concurrency", default=1, show_default=True, help="Endpoint requests in flight at once.")
+@click.option("--seed", default=42, show_default=True)
+@click.option("--output", type=click.Path(dir_okay=False), help="Write the results as JSON.")
+@click.option("--save-baseline", type=click.Path(dir_okay=False), help="Write the results as the new baseline.")
+@click.option("--baseline", type=click.Path(exists=True, dir_okay=False), help="Compare against this baseline.")
+@click.option("--tolerance", default=0.2, show_default=True, help="Allowed slowdown against the baseline.")
+@click.option("--floor-ms", default=0.5, show_default=True, help="Ignore slowdowns smaller than this.")
+@click.option("--force", is_flag=True, help="Allow a database whose name doesn't contain \"bench\".")
+def main(database_url, sslmode, store_counts, basket_sizes, products, coverage, metros, requests, warmup,
+         concurrency, seed, output, save_baseline, baseline, tolerance, floor_ms, force):
+    if database_url:
+        database_name = up.urlparse(database_url).path.lstrip("/")
+        if "bench" not in database_name and not force:
+            raise click.UsageError(f"refusing to wipe database {database_name!r}; use a *bench* database or --force")
+        reset_database(database_url, sslmode)
+
+    # Configure the app before importing it: its settings are read at import time
+    os.environ.update({
+        "DATABASE_URL": database_url or "",
+        "DB_SSLMODE": sslmode,
+        "DB_POOL_MAX": str(max(10, concurrency + 2)),
+        "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"),
+        "ZIP_API_FALLBACK": "false",
+        "COMPARE_CACHE_TTL": "0",
+        "RECIPE_CACHE_TTL": "0",
+        "YOUTUBE_CACHE_TTL": "0",
+        "YOUTUBE_WARM_MEALS": "",
+        "UPSTREAM_OPENAI_RATE": "1e9",
+        "UPSTREAM_OPENAI_BURST": "1e9",
+        "UPSTREAM_YOUTUBE_RATE": "1e9",
+        "UPSTREAM_YOUTUBE_BURST": "1e9"
+    })
+    # Not used by anything benchmarked, but the Supabase client needs them to import
+    os.environ.setdefault("SUPABASE_URL", "http://localhost:54321")
+    os.environ.setdefault("SUPABASE_KEY", "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoiYW5vbiJ9.benchmark")  # must look like a JWT
+    sys.path.insert(0, HERE)
+    import app as grocery
+    stub_external_calls(grocery)
+    if database_url:
+        grocery.init_db()
+
+    rng = np.random.default_rng(seed)
+    zips = load_zip_centroids()
+    catalog = product_catalog(grocery.PRODUCT_SYNONYMS, products)
+    baskets_by_size = {size: generate_baskets(rng, catalog, size, requests) for size in basket_sizes}
+
+    results = []
+    for store_count in store_counts:
+        click.echo(f"Generating {store_count} stores x {products} products ...", err=True)
+        dataset = generate_dataset(rng, zips, catalog, store_count, coverage, metros)
+        for basket_size, baskets in baskets_by_size.items():
+            results.extend(bench_strategies(grocery, dataset, catalog, baskets, store_count, basket_size))
+        if database_url:
+            load_dataset(grocery, dataset, catalog)
+            results.extend(bench_endpoints(grocery, dataset, baskets_by_size, store_count, requests, warmup, concurrency))
+    if not database_url:
+        click.echo("No --database-url given, endpoint benchmarks skipped (they need PostgreSQL)", err=True)
+
+    print_results(results)
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "machine": {"python": platform.python_version(), "platform": platform.platform(),
+                    "cpus": os.cpu_count()},
+        "settings": {"stores": store_counts, "baskets": basket_sizes, "products": products,
+                     "coverage": coverage, "metros": metros, "requests": requests,
+                     "concurrency": concurrency, "seed": seed},
+        "results": results
+    }
+    for path in (output, save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2)
+            click.echo(f"Wrote {path}", err=True)
+
+    if baseline:
+        with open(baseline) as f:
+            previous = json.load(f)
+        changed = [key for key in ("products", "coverage", "metros", "concurrency", "seed")
+                   if previous["settings"].get(key) != report["settings"][key]]
+        if changed:
+            click.echo(f"Warning: {', '.join(changed)} differ from the baseline run", err=True)
+        regressions = compare_to_baseline(results, previous, tolerance, floor_ms)
+        if regressions:
+            click.echo(f"{len(regressions)} regression(s) against {baseline}:", err=True)
+            for line in regressions:
+                click.echo(f"  {line}", err=True)
+            sys.exit(1)
+        click.echo(f"No regressions against {baseline}", err=True)
+
+
+if __name__ == "__main__":
+    main()
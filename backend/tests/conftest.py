@@ -0,0 +1,78 @@
+"""Test setup: the app is imported once, against TEST_DATABASE_URL if it is set.
+
+Tests that take the `db` fixture are skipped without a database. The database
+is wiped first, so point TEST_DATABASE_URL at a throwaway one:
+
+    TEST_DATABASE_URL=postgresql://postgres@localhost/grocery_test python -m pytest backend/tests
+"""
+import os
+import sys
+
+import psycopg2  # type: ignore
+import pytest
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+TEST_SSLMODE = os.getenv("TEST_DB_SSLMODE", "disable")
+
+sys.path.insert(0, BACKEND)
+
+
+@pytest.fixture(scope="session")
+def grocery():
+    """The app module, configured for tests."""
+    from benchmark import BASE_SCHEMA
+
+    if TEST_DATABASE_URL:
+        conn = psycopg2.connect(TEST_DATABASE_URL, sslmode=TEST_SSLMODE)
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(BASE_SCHEMA)
+            conn.commit()
+        finally:
+            conn.close()
+
+    # Settings are read at import time
+    os.environ.update({
+        "DATABASE_URL": TEST_DATABASE_URL or "",
+        "DB_SSLMODE": TEST_SSLMODE,
+        "LOG_LEVEL": "WARNING",
+        "ZIP_API_FALLBACK": "false",
+        "COMPARE_CACHE_TTL": "0",
+        "YOUTUBE_WARM_MEALS": ""
+    })
+    os.environ.setdefault("SUPABASE_URL", "http://localhost:54321")
+    os.environ.setdefault("SUPABASE_KEY", "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoiYW5vbiJ9.tests")  # must look like a JWT
+    import app
+    if TEST_DATABASE_URL:
+        app.init_db()
+    return app
+
+
+@pytest.fixture
+def db(grocery):
+    """The app module with empty store and product tables."""
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    with grocery.db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("TRUNCATE flyers, products, stores RESTART IDENTITY CASCADE")
+        conn.commit()
+    grocery.invalidate_price_snapshot(rebuild=True)
+    grocery.compare_cache.clear()
+    return grocery
+
+
+@pytest.fixture
+def connect():
+    """Open extra connections to the test database (closed after the test)."""
+    conns = []
+
+    def connect():
+        conn = psycopg2.connect(TEST_DATABASE_URL, sslmode=TEST_SSLMODE)
+        conns.append(conn)
+        return conn
+
+    yield connect
+    for conn in conns:
+        conn.close()
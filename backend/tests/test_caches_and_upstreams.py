@@ -0,0 +1,137 @@
+import time
+
+import pytest
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_cache(request, grocery, tmp_path):
+    def make_cache(maxsize=10, ttl=60):
+        path = str(tmp_path / "cache.sqlite3") if request.param == "sqlite" else None
+        return grocery.make_cache("test_cache", maxsize, ttl, path)
+    return make_cache
+
+
+def test_cache_entries_expire(make_cache):
+    cache = make_cache(ttl=0.05)
+    cache.set("short", [1])
+    cache.set("long", [2], ttl=60)
+    assert cache.get("short") == [1]
+
+    time.sleep(0.1)
+
+    assert cache.get("short") is None
+    assert cache.get("long") == [2]
+
+
+def test_cache_evicts_the_least_recently_used_entry(make_cache):
+    cache = make_cache(maxsize=2)
+    cache.set("a", 1)
+    time.sleep(0.01)
+    cache.set("b", 2)
+    time.sleep(0.01)
+    assert cache.get("a") == 1  # now "b" is the least recently used
+    time.sleep(0.01)
+
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+
+
+def test_cache_invalidates_every_entry_with_a_tag(make_cache):
+    cache = make_cache()
+    cache.set("onion+okra", 1, tags=["onion", "okra"])
+    cache.set("onion", 2, tags=["onion"])
+    cache.set("paneer", 3, tags=["paneer"])
+
+    cache.invalidate_tag("okra", "ghee")
+    assert (cache.get("onion+okra"), cache.get("onion"), cache.get("paneer")) == (None, 2, 3)
+
+    # Re-setting an entry replaces its tags
+    cache.set("paneer", 4, tags=["cottage cheese"])
+    cache.invalidate_tag("paneer")
+    assert cache.get("paneer") == 4
+
+    cache.invalidate_tag("onion")
+    assert cache.get("onion") is None
+
+
+@pytest.fixture
+def upstream(grocery, monkeypatch):
+    monkeypatch.setattr(grocery, "UPSTREAMS", {})
+
+    def upstream(**settings):
+        settings = {"timeout": 1.0, "concurrency": 2, "rate": 1000, "burst": 1000, "failure_threshold": 2,
+                    "reset_timeout": 0.1, "queue_timeout": 0.01, **settings}
+        return grocery.Upstream("test_upstream", settings.pop("timeout"), **settings)
+    return upstream
+
+
+def _fail():
+    raise ConnectionError("upstream down")
+
+
+def test_breaker_opens_after_consecutive_failures_and_fails_fast(grocery, upstream):
+    api = upstream()
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            api.call(_fail)
+    assert api.metrics()["state"] == "open"
+
+    with pytest.raises(grocery.UpstreamUnavailable, match="circuit is open"):
+        api.call(lambda: "never called")
+    assert api.metrics()["rejected_circuit_open"] == 1
+    assert api.metrics()["calls"] == 2
+
+
+def test_breaker_lets_one_probe_through_when_half_open(grocery, upstream):
+    api = upstream()
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            api.call(_fail)
+    time.sleep(0.15)
+
+    with api.request():
+        assert api.metrics()["state"] == "half_open"
+        with pytest.raises(grocery.UpstreamUnavailable, match="half-open"):
+            api.call(lambda: "a second probe")
+    assert api.metrics()["state"] == "closed"
+    assert api.call(lambda: "ok") == "ok"
+
+
+def test_breaker_reopens_when_the_probe_fails(grocery, upstream):
+    api = upstream(failure_threshold=3)
+    for _ in range(3):
+        with pytest.raises(ConnectionError):
+            api.call(_fail)
+    time.sleep(0.15)
+
+    with pytest.raises(ConnectionError):
+        api.call(_fail)
+
+    assert api.metrics()["state"] == "open"
+    with pytest.raises(grocery.UpstreamUnavailable, match="circuit is open"):
+        api.call(lambda: "never called")
+
+
+def test_slow_calls_count_as_failures(upstream):
+    api = upstream(timeout=0.01, failure_threshold=1)
+
+    assert api.call(lambda: time.sleep(0.03) or "late") == "late"
+
+    metrics = api.metrics()
+    assert (metrics["slow_calls"], metrics["failures"], metrics["state"]) == (1, 1, "open")
+
+
+def test_rate_limit_and_concurrency_limit_reject_locally(grocery, upstream):
+    api = upstream(rate=0.001, burst=1)
+    api.call(lambda: None)
+    with pytest.raises(grocery.UpstreamUnavailable, match="rate limit"):
+        api.call(lambda: None)
+
+    api = upstream(concurrency=1)
+    with api.request():
+        with pytest.raises(grocery.UpstreamUnavailable, match="concurrency limit"):
+            api.call(lambda: None)
+    metrics = api.metrics()
+    assert (metrics["rejected_saturated"], metrics["in_flight"], metrics["state"]) == (1, 0, "closed")
@@ -0,0 +1,54 @@
+import pytest
+
+
+def _seed_duplicates(conn):
+    """Drop the unique index (as on a database from before it) and add three
+    spellings of one product at store 1 plus a different quantity."""
+    with conn.cursor() as cursor:
+        cursor.execute("DROP INDEX products_store_name_quantity_key")
+        cursor.execute("INSERT INTO stores (name, zip_code) VALUES ('Patel Brothers', '02139')")
+        cursor.execute("""
+            INSERT INTO products (name, store_id, price, quantity)
+            VALUES ('Okra', 1, 2.00, '1 lb'), ('okra ', 1, 1.90, '1 lb'), ('OKRA', 1, 1.80, '1 lb'),
+                   ('okra', 1, 3.50, '2 lb')
+        """)
+    conn.commit()
+
+
+def _products(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT id, name, quantity FROM products ORDER BY id")
+        return cursor.fetchall()
+
+
+def test_startup_refuses_to_delete_duplicate_products(db):
+    with db.db_connection() as conn:
+        _seed_duplicates(conn)
+        try:
+            with pytest.raises(RuntimeError, match="Found 2 duplicate products .* dedupe-products"):
+                db.init_db()
+            assert len(_products(conn)) == 4
+        finally:
+            with conn.cursor() as cursor:
+                cursor.execute("TRUNCATE products RESTART IDENTITY CASCADE")
+            conn.commit()
+            db.init_db()
+
+
+def test_dedupe_products_keeps_the_newest_row(db):
+    with db.db_connection() as conn:
+        _seed_duplicates(conn)
+
+    runner = db.app.test_cli_runner()
+    dry_run = runner.invoke(args=["dedupe-products", "--dry-run"])
+    assert "Found 2 duplicate products" in dry_run.output
+
+    result = runner.invoke(args=["dedupe-products"])
+    assert result.exit_code == 0, result.output
+    assert "Deleted 2 duplicate products" in result.output
+
+    with db.db_connection() as conn:
+        assert _products(conn) == [(3, "OKRA", "1 lb"), (4, "okra", "2 lb")]
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT to_regclass('products_store_name_quantity_key') IS NOT NULL")
+            assert cursor.fetchone()[0]
@@ -0,0 +1,63 @@
+import pytest
+
+
+def test_parse_fields_keeps_the_allowed_order(grocery):
+    allowed, default = grocery.STORE_FIELDS, grocery.STORE_DEFAULT_FIELDS
+
+    assert grocery._parse_fields(None, allowed, default) == ["id", "name", "zip_code"]
+    assert grocery._parse_fields("longitude, name,latitude", allowed, default) == ["name", "latitude", "longitude"]
+    assert grocery._parse_fields("name,name,", allowed, default) == ["name"]
+
+
+@pytest.mark.parametrize("value", ["address", "name,address", ",", " "])
+def test_parse_fields_rejects_unknown_or_empty_fields(grocery, value):
+    with pytest.raises(ValueError):
+        grocery._parse_fields(value, grocery.STORE_FIELDS, grocery.STORE_DEFAULT_FIELDS)
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("", (None, None)),
+    ("limit=5", (5, None)),
+    ("limit=5&after=12", (5, 12)),
+    ("after=0", (None, 0)),
+    ("limit=1000000", (1000, None)),
+])
+def test_parse_page_args(grocery, monkeypatch, query, expected):
+    monkeypatch.setattr(grocery, "STORE_PAGE_MAX", 1000)
+    with grocery.app.test_request_context(f"/stores?{query}"):
+        assert grocery._parse_page_args() == expected
+
+
+@pytest.mark.parametrize("path", ["/stores", "/store/1"])
+@pytest.mark.parametrize("query", [
+    "limit=0", "limit=-1", "limit=ten", "limit=2.5", "after=-3", "after=abc", "fields=address", "fields=,"
+])
+def test_listings_reject_bad_arguments_before_touching_the_database(grocery, monkeypatch, path, query):
+    def no_database():
+        raise AssertionError("the database shouldn't be needed")
+
+    monkeypatch.setattr(grocery, "get_db_connection", no_database)
+
+    response = grocery.app.test_client().get(f"{path}?{query}")
+
+    assert response.status_code == 400
+    assert "fields must be some of" in response.get_json()["error"]
+
+
+def test_store_fields_project_the_listing(db):
+    with db.db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO stores (name, zip_code, latitude, longitude)
+                VALUES ('Patel Brothers', '02139', 42.37, -71.11), ('Apna Store', '02141', 42.37, -71.08)
+            """)
+            cursor.execute("INSERT INTO products (name, store_id, price, quantity) VALUES ('Okra', 1, 2.49, '1 lb')")
+        conn.commit()
+    client = db.app.test_client()
+
+    assert client.get("/stores?fields=zip_code,name").get_json() == [
+        {"name": "Patel Brothers", "zip_code": "02139"}, {"name": "Apna Store", "zip_code": "02141"}
+    ]
+    assert client.get("/store/1?fields=products.name,products.price").get_json() == {
+        "products": [{"name": "Okra", "price": "2.49"}]  # NUMERIC, serialized as a string as before
+    }
@@ -0,0 +1,77 @@
+def _prices(snapshot, canonical_name):
+    return sorted((row[1], row[4]) for row in snapshot.compare_rows([canonical_name]))
+
+
+def _seed(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("INSERT INTO stores (name, zip_code) VALUES ('Patel Brothers', '02139'), ('Apna Store', '02141')")
+        cursor.execute("""
+            INSERT INTO products (name, store_id, price, quantity, canonical_id)
+            SELECT 'onion', s, 2.00, '1 lb', (SELECT canonical_id FROM product_aliases WHERE alias = 'onion')
+            FROM generate_series(1, 2) s
+        """)
+    conn.commit()
+
+
+def test_refresh_picks_up_a_long_transaction_that_commits_late(db, connect):
+    setup, long_writer, quick_writer = connect(), connect(), connect()
+    _seed(setup)
+    with db.db_connection() as conn:
+        snapshot = db.PriceSnapshot.load(conn)
+        assert _prices(snapshot, "onion") == [(1, 2.0), (2, 2.0)]
+
+        # Starts first and stays open past a refresh that sees a later commit
+        with long_writer.cursor() as cursor:
+            cursor.execute("UPDATE products SET price = 1.25 WHERE store_id = 1")
+        with quick_writer.cursor() as cursor:
+            cursor.execute("UPDATE products SET price = 1.75 WHERE store_id = 2")
+        quick_writer.commit()
+
+        snapshot = snapshot.refresh(conn)
+        conn.commit()
+        assert _prices(snapshot, "onion") == [(1, 2.0), (2, 1.75)]
+
+        long_writer.commit()
+        snapshot = snapshot.refresh(conn)
+        conn.commit()
+        assert _prices(snapshot, "onion") == [(1, 1.25), (2, 1.75)]
+
+
+def test_refresh_picks_up_store_changes(db, connect):
+    writer = connect()
+    _seed(writer)
+    with db.db_connection() as conn:
+        snapshot = db.PriceSnapshot.load(conn)
+
+        with writer.cursor() as cursor:
+            cursor.execute("UPDATE stores SET name = 'Patel Bros' WHERE id = 1")
+        writer.commit()
+        snapshot = snapshot.refresh(conn)
+        conn.commit()
+        assert snapshot.stores[1][0] == "Patel Bros"
+        assert _prices(snapshot, "onion") == [(1, 2.0), (2, 2.0)]
+
+
+def test_shared_compare_cache_is_refilled_with_the_new_price(db, connect, monkeypatch, tmp_path):
+    monkeypatch.setattr(db, "COMPARE_CACHE_TTL", 300)
+    monkeypatch.setattr(db, "COMPARE_CACHE_PATH", str(tmp_path / "cache.sqlite3"))
+    monkeypatch.setattr(db, "compare_cache", db.make_cache("compare_prices", 100, 300, db.COMPARE_CACHE_PATH))
+    monkeypatch.setattr(db, "PRICE_SNAPSHOT_MAX_AGE", 60)
+    writer = connect()
+    _seed(writer)
+    client = db.app.test_client()
+
+    def best_price():
+        return client.post("/api/compare-prices", json={"items": ["onion"]}).get_json()["items"][0]["bestPrice"]
+
+    assert best_price() == 2.0
+
+    # Another worker uploads a new price and drops the shared entry; this
+    # worker's snapshot is still well within PRICE_SNAPSHOT_MAX_AGE
+    with writer.cursor() as cursor:
+        cursor.execute("UPDATE products SET price = 1.50 WHERE store_id = 2")
+    writer.commit()
+    db.compare_cache.invalidate_tag("onion")
+
+    assert best_price() == 1.5
+    assert best_price() == 1.5  # and that's what went back into the cache
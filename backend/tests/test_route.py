@@ -0,0 +1,63 @@
+import json
+
+import numpy as np
+
+
+def _strict_json(text):
+    """Parse JSON the way browsers do: NaN and Infinity are errors."""
+    def reject(constant):
+        raise ValueError(f"{constant} is not valid JSON")
+    return json.loads(text, parse_constant=reject)
+
+
+def test_plan_route_lists_stores_without_coordinates_separately(grocery):
+    order, legs, unrouted = grocery.plan_route(42.36, -71.10, [42.37, np.nan, 42.35], [-71.11, np.nan, -71.09])
+
+    assert sorted(order) == [0, 2]
+    assert unrouted == [1]
+    assert len(legs) == 3
+    assert all(np.isfinite(legs))
+
+
+def test_plan_leaves_stores_without_coordinates_out_of_the_route(grocery):
+    matrix = grocery.PriceMatrix(
+        [1, 2], ["Patel Brothers", "No Address Mart"], ["02139", None], [42.37, None], [-71.11, None],
+        ["onion", "okra"], np.array([[2.0, np.nan], [np.nan, 3.0]]),
+        np.array([["Onion", None], [None, "Okra"]], dtype=object)
+    )
+
+    result = matrix.plan([0, 1], {"lat": 42.36, "lng": -71.10})
+
+    assert result["stores"] == [1, 2]
+    assert result["route"]["unrouted"] == [2]
+    assert len(result["route"]["legs"]) == 2
+    assert _strict_json(json.dumps(result))["total_distance"] == sum(result["route"]["legs"])
+
+
+def test_optimize_stops_response_is_valid_json_with_a_store_without_coordinates(db):
+    with db.db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO stores (name, zip_code, latitude, longitude)
+                VALUES ('Patel Brothers', '02139', 42.37, -71.11), ('No Address Mart', NULL, NULL, NULL)
+            """)
+            cursor.execute("""
+                INSERT INTO products (name, store_id, price, quantity)
+                VALUES ('onion', 1, 2.00, '1 lb'), ('okra', 2, 3.00, '1 lb')
+            """)
+            cursor.execute("""
+                UPDATE products p SET canonical_id = a.canonical_id
+                FROM product_aliases a WHERE a.alias = p.normalized_name
+            """)
+        conn.commit()
+    db.invalidate_price_snapshot(rebuild=True)
+
+    response = db.app.test_client().post(
+        "/api/optimize-stops", json={"items": ["onion", "okra"], "userZip": "02139"}
+    )
+
+    assert response.status_code == 200
+    body = _strict_json(response.get_data(as_text=True))
+    price = body["price_optimized"]
+    assert price["stores"] == [1, 2]
+    assert price["route"]["unrouted"] == [2]
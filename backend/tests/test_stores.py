@@ -0,0 +1,61 @@
+import math
+import random
+
+import pytest
+
+
+def test_stores_by_distance_without_a_database(grocery, monkeypatch):
+    monkeypatch.setattr(grocery, "get_db_connection", lambda: None)
+
+    response = grocery.app.test_client().get("/stores/by-distance/02139")
+
+    assert response.status_code == 500
+    assert response.get_json() == {"error": "Database connection failed"}
+
+
+def _haversine_miles(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * 3959.87433 * math.asin(math.sqrt(a))
+
+
+def _random_stores(seed, count):
+    """Stores clustered around a few metros plus some scattered across the US."""
+    rng = random.Random(seed)
+    metros = [(42.36, -71.06), (40.71, -74.01), (41.88, -87.63), (37.77, -122.42)]
+    stores = []
+    for store_id in range(1, count + 1):
+        if rng.random() < 0.8:
+            lat, lng = rng.choice(metros)
+            lat, lng = lat + rng.gauss(0, 0.3), lng + rng.gauss(0, 0.3)
+        else:
+            lat, lng = rng.uniform(25, 49), rng.uniform(-124, -67)
+        stores.append((store_id, f"Store {store_id}", "02139", lat, lng))
+    return stores
+
+
+@pytest.mark.parametrize("cell_degrees", [0.05, 0.5, 5.0])
+def test_spatial_index_matches_a_brute_force_scan(grocery, cell_degrees):
+    stores = _random_stores(seed=int(cell_degrees * 100), count=600)
+    index = grocery.StoreSpatialIndex(stores, cell_degrees=cell_degrees)
+    queries = [(42.37, -71.11), (40.0, -100.0), (48.9, -67.1)]
+
+    for lat, lng in queries:
+        ranked = sorted((_haversine_miles(lat, lng, s[3], s[4]), s[0]) for s in stores)
+        for radius, limit in [(None, None), (5, None), (40, None), (None, 1), (None, 25), (40, 10), (1, 10), (None, 1000)]:
+            expected = [(d, store_id) for d, store_id in ranked if radius is None or d <= radius]
+            expected = expected[:limit] if limit is not None else expected
+
+            positions, distances = index.query(lat, lng, radius=radius, limit=limit)
+
+            assert [index.ids[i] for i in positions] == [store_id for _, store_id in expected], (lat, lng, radius, limit)
+            assert distances == pytest.approx([d for d, _ in expected])
+
+
+def test_spatial_index_with_no_stores(grocery):
+    index = grocery.StoreSpatialIndex([])
+
+    positions, distances = index.query(42.37, -71.11, radius=5, limit=3)
+
+    assert len(positions) == 0 and len(distances) == 0
+    assert index.nearby_store_ids(42.37, -71.11, limit=3) == []
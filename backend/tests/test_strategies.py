@@ -0,0 +1,111 @@
+"""The exact solvers against brute force on small random instances."""
+import itertools
+
+import numpy as np
+import pytest
+
+USER = {"lat": 42.36, "lng": -71.10}
+
+
+def _random_matrix(grocery, rng, stores, items, carried=0.5):
+    prices = np.round(rng.uniform(1, 6, (stores, items)), 2)
+    prices[rng.random((stores, items)) >= carried] = np.nan
+    lats = USER["lat"] + rng.uniform(-0.2, 0.2, stores)
+    lngs = USER["lng"] + rng.uniform(-0.2, 0.2, stores)
+    found_as = np.full(prices.shape, "product", dtype=object)
+    return grocery.PriceMatrix(
+        list(range(1, stores + 1)), [f"Store {i}" for i in range(stores)], ["02139"] * stores,
+        lats, lngs, [f"item {j}" for j in range(items)], prices, found_as
+    )
+
+
+def _instances(grocery, seed, count, max_stores=7, max_items=5):
+    rng = np.random.default_rng(seed)
+    for _ in range(count):
+        matrix = _random_matrix(grocery, rng, int(rng.integers(1, max_stores + 1)), int(rng.integers(1, max_items + 1)))
+        if not np.isnan(matrix.prices).all():
+            yield matrix
+
+
+def _covers(matrix):
+    """Every set of store positions carrying all the items any store carries."""
+    carried = ~np.isnan(matrix.prices)
+    needed = carried.any(axis=0)
+    for size in range(1, len(matrix.store_ids) + 1):
+        for stores in itertools.combinations(range(len(matrix.store_ids)), size):
+            if (carried[list(stores)].any(axis=0) >= needed).all():
+                yield list(stores)
+
+
+def test_convenience_strategy_finds_the_fewest_stops_then_the_cheapest(grocery):
+    for matrix in _instances(grocery, seed=1, count=80):
+        distances = matrix.distances_from(USER["lat"], USER["lng"])
+        covers = list(_covers(matrix))
+        fewest = min(len(stores) for stores in covers)
+        cheapest = min(matrix.plan(stores, USER)["total_cost"] for stores in covers if len(stores) == fewest)
+
+        chosen = grocery.find_optimal_stops(matrix, distances)
+
+        assert sorted(chosen) in covers
+        assert len(chosen) == fewest
+        assert matrix.plan(chosen, USER)["total_cost"] == pytest.approx(cheapest)
+
+
+def test_joint_strategy_matches_brute_force(grocery):
+    cost_per_mile, stop_penalty = 0.5, 1.0
+
+    def objective(matrix, stores):
+        plan = matrix.plan(stores, USER)
+        return plan["total_cost"] + cost_per_mile * plan["total_distance"] + stop_penalty * len(plan["stores"])
+
+    for matrix in _instances(grocery, seed=2, count=80):
+        distances = matrix.distances_from(USER["lat"], USER["lng"])
+        best = min(objective(matrix, stores) for stores in _covers(matrix))
+
+        chosen = grocery.find_joint_optimized_stops(matrix, distances, USER, cost_per_mile, stop_penalty)
+
+        assert sorted(chosen) in list(_covers(matrix))
+        # Legs are rounded to cents of a mile in the plan, the solver works unrounded
+        assert objective(matrix, chosen) <= best + 0.05
+
+
+def _shortest_and_length(grocery, lats, lngs, order):
+    """(shortest round trip through every stop by brute force, length of the trip in `order`)."""
+    between = grocery.distance_matrix(np.append(USER["lat"], lats), np.append(USER["lng"], lngs))
+
+    def length(tour):
+        path = [0, *[i + 1 for i in tour], 0]
+        return sum(between[a, b] for a, b in zip(path, path[1:]))
+
+    return min(length(tour) for tour in itertools.permutations(range(len(lats)))), length(order)
+
+
+def test_route_is_the_shortest_round_trip(grocery):
+    rng = np.random.default_rng(3)
+    for stops in range(1, 8):
+        lats = USER["lat"] + rng.uniform(-0.2, 0.2, stops)
+        lngs = USER["lng"] + rng.uniform(-0.2, 0.2, stops)
+
+        order, legs, unrouted = grocery.plan_route(USER["lat"], USER["lng"], lats, lngs)
+
+        assert sorted(order) == list(range(stops)) and unrouted == []
+        assert len(legs) == stops + 1
+        shortest, length = _shortest_and_length(grocery, lats, lngs, order)
+        assert length == pytest.approx(shortest)
+        assert sum(legs) == pytest.approx(shortest, abs=0.01 * len(legs))
+
+
+def test_long_routes_visit_every_stop_once(grocery, monkeypatch):
+    monkeypatch.setattr(grocery, "ROUTE_EXACT_MAX_STOPS", 3)
+    rng = np.random.default_rng(4)
+    for stops in (4, 8, 20):
+        lats = USER["lat"] + rng.uniform(-0.2, 0.2, stops)
+        lngs = USER["lng"] + rng.uniform(-0.2, 0.2, stops)
+
+        order, legs, _ = grocery.plan_route(USER["lat"], USER["lng"], lats, lngs)
+
+        assert sorted(order) == list(range(stops))
+        assert len(legs) == stops + 1
+        if stops <= 8:
+            shortest, length = _shortest_and_length(grocery, lats, lngs, order)
+            assert length <= shortest * 1.1
@@ -0,0 +1,67 @@
+import pandas as pd
+
+
+def _validate(grocery, rows, known_store_ids=(1, 2)):
+    df = pd.DataFrame(rows, columns=["name", "store_id", "price", "quantity"])
+    accepted, rejected = grocery._validate_bulk_products(df, list(known_store_ids))
+    return accepted, dict(zip(rejected["row"], rejected["error"]))
+
+
+def test_validation_rejects_bad_rows_with_a_reason(grocery):
+    accepted, errors = _validate(grocery, [
+        ["Okra", 1, "2.49", "1 lb"],
+        ["", 1, "2.49", "1 lb"],
+        ["Okra", 1, "2.49", "  "],
+        ["Okra", "one", "2.49", "1 lb"],
+        ["Okra", 1.5, "2.49", "1 lb"],
+        ["Okra", 1, "free", "1 lb"],
+        ["Okra", 1, "-1", "1 lb"],
+        ["Okra", 1, "inf", "1 lb"],
+        ["Okra", 1, "nan", "1 lb"],
+        ["Okra", 3, "2.49", "1 lb"],
+    ])
+
+    assert list(accepted["row"]) == [0]
+    assert errors == {
+        1: "missing name", 2: "missing quantity", 3: "invalid store_id", 4: "invalid store_id",
+        5: "invalid price", 6: "invalid price", 7: "invalid price", 8: "invalid price",
+        9: "Store ID does not exist"
+    }
+
+
+def test_validation_strips_names_and_quantities_and_keeps_the_last_duplicate(grocery):
+    accepted, errors = _validate(grocery, [
+        [" Okra ", 1, "2.49", "1 lb "],
+        ["okra", 1, "1.99", "1 lb"],
+        ["Okra", 2, "2.29", "1 lb"],
+    ])
+
+    assert errors == {0: "superseded by a later row for the same product"}
+    assert accepted[["row", "name", "store_id", "price", "quantity"]].values.tolist() == [
+        [1, "okra", 1, 1.99, "1 lb"], [2, "Okra", 2, 2.29, "1 lb"]
+    ]
+
+
+def test_single_upload_rejects_non_finite_prices(grocery):
+    client = grocery.app.test_client()
+    for price in ("inf", "nan", "-1", "free"):
+        response = client.post("/upload_product", json={"name": "Okra", "store_id": 1, "price": price, "quantity": "1 lb"})
+        assert response.status_code == 400
+        assert response.get_json() == {"error": "invalid price"}
+
+
+def test_single_upload_strips_the_quantity_like_bulk_uploads(db):
+    with db.db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("INSERT INTO stores (name, zip_code) VALUES ('Patel Brothers', '02139')")
+        conn.commit()
+    client = db.app.test_client()
+
+    first = client.post("/upload_product", json={"name": "Okra", "store_id": 1, "price": 2.49, "quantity": "1 lb "})
+    second = client.post("/upload_products", json=[{"name": "okra", "store_id": 1, "price": 1.99, "quantity": "1 lb"}])
+
+    assert first.status_code == 201 and second.status_code < 300, second.get_json()
+    with db.db_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT quantity, price FROM products")
+            assert [(quantity, float(price)) for quantity, price in cursor.fetchall()] == [("1 lb", 1.99)]
@@ -0,0 +1,91 @@
+import json
+import threading
+import time
+
+import pytest
+
+
+def test_lookups_stop_waiting_for_a_scrape_that_hangs(grocery, monkeypatch):
+    monkeypatch.setattr(grocery, "YOUTUBE_TIMEOUT", 0.2)
+    release = threading.Event()
+    calls = []
+
+    def fetch(query, max_results):
+        calls.append(query)
+        if len(calls) == 1:
+            release.wait(5)  # the first scrape hangs
+        return [{"title": query, "url": "https://www.youtube.com/watch?v=x"}]
+
+    monkeypatch.setattr(grocery, "_fetch_youtube_videos", fetch)
+    try:
+        leader = threading.Thread(target=grocery.search_youtube_videos, args=("hung dal recipe",))
+        leader.start()
+        time.sleep(0.05)
+
+        # Joins the hung scrape, but only for YOUTUBE_TIMEOUT
+        started = time.monotonic()
+        assert grocery.search_youtube_videos("hung dal recipe") == []
+        assert time.monotonic() - started < 1
+
+        # The stuck scrape no longer counts as in flight, so this one fetches again
+        assert grocery.search_youtube_videos("hung dal recipe")[0]["title"] == "hung dal recipe"
+        assert len(calls) == 2
+    finally:
+        release.set()
+        leader.join()
+
+
+class _Page:
+    def __init__(self, text):
+        self.text = text
+
+
+def test_scrape_gives_up_at_the_timeout(grocery, monkeypatch):
+    def get(url, timeout):
+        assert 0 < timeout <= 0.2
+        time.sleep(0.05)
+        return _Page("<html>consent page</html>")  # never has results, so the library would retry forever
+
+    monkeypatch.setattr(grocery, "YOUTUBE_TIMEOUT", 0.2)
+    monkeypatch.setattr(grocery._youtube_session, "get", get)
+    failures = grocery.youtube_api.metrics()["failures"]
+
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        grocery._fetch_youtube_videos("stalled dal recipe", 2)
+    assert time.monotonic() - started < 0.5
+
+    metrics = grocery.youtube_api.metrics()
+    assert metrics["in_flight"] == 0
+    assert metrics["failures"] == failures + 1
+
+
+def test_scrape_parses_the_results_page(grocery, monkeypatch):
+    videos = [{"videoRenderer": {"videoId": f"v{i}", "title": {"runs": [{"text": f"Dal {i}"}]},
+                                 "longBylineText": {"runs": [{"text": "Chef"}]}}} for i in range(3)]
+    data = {"contents": {"twoColumnSearchResultsRenderer": {"primaryContents": {"sectionListRenderer": {
+        "contents": [{"itemSectionRenderer": {"contents": videos}}]}}}}}
+    monkeypatch.setattr(grocery._youtube_session, "get",
+                        lambda url, timeout: _Page(f"<script>var ytInitialData = {json.dumps(data)};</script>"))
+
+    assert grocery._fetch_youtube_videos("dal recipe", 2) == [
+        {"title": "Dal 0", "url": "https://www.youtube.com/watch?v=v0"},
+        {"title": "Dal 1", "url": "https://www.youtube.com/watch?v=v1"}
+    ]
+
+
+def test_locally_refused_lookups_are_not_cached(grocery, monkeypatch):
+    results = [grocery.UpstreamUnavailable("youtube rate limit exceeded"),
+               [{"title": "Rajma", "url": "https://www.youtube.com/watch?v=r"}]]
+
+    def fetch(query, max_results):
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    monkeypatch.setattr(grocery, "_fetch_youtube_videos", fetch)
+
+    assert grocery.search_youtube_videos("rate limited rajma recipe") == []
+    assert grocery.search_youtube_videos("rate limited rajma recipe")[0]["title"] == "Rajma"
+    assert not results